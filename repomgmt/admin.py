@@ -18,7 +18,8 @@
 from django.contrib import admin
 from repomgmt.models import Architecture, Repository, BuildNode
 from repomgmt.models import Cloud, KeyPair, Series, ChrootTarball
-from repomgmt.models import UploaderKey, UbuntuSeries
+from repomgmt.models import UploaderKey, UbuntuSeries, BuildNodeImage
+from repomgmt.models import BuildQueue, PackageSource, PollCycle
 
 admin.site.register(Architecture)
 admin.site.register(Repository)
@@ -29,3 +30,7 @@ admin.site.register(Series)
 admin.site.register(ChrootTarball)
 admin.site.register(UploaderKey)
 admin.site.register(UbuntuSeries)
+admin.site.register(BuildNodeImage)
+admin.site.register(BuildQueue)
+admin.site.register(PollCycle)
+admin.site.register(PackageSource)
@@ -27,9 +27,10 @@ from tastypie.authorization import DjangoAuthorization
 from tastypie.bundle import Bundle
 from tastypie.constants import ALL_WITH_RELATIONS
 from tastypie.models import create_api_key
-from tastypie.resources import ModelResource
+from tastypie.resources import ModelResource, Resource
 from repomgmt.models import Architecture, Repository, PackageSource, Series
 from repomgmt.models import Subscription, UbuntuSeries
+from repomgmt import tasks
 from tastypie.serializers import Serializer
 from tastypie.exceptions import Unauthorized
 
@@ -352,10 +353,85 @@ class SubscriptionResource(ModelResource):
                      'id': ALL_WITH_RELATIONS}
 
 
+class PushNotificationResource(Resource):
+    """Tells us that a code or packaging branch has changed
+
+    Accepts GitHub style push payloads (as JSON, or form encoded as
+    GitHub's webhooks send them by default) as well as {"url": ...} or
+    {"urls": [...]}, where a URL may carry a '#branch' suffix. The
+    package sources using any of the given branches get polled right
+    away rather than at their next scheduled poll."""
+    class Meta:
+        resource_name = 'push'
+        allowed_methods = ['post']
+        authentication = MultiAuthentication(BasicAuthentication(),
+                                             ApiKeyAuthenticationWithHeaderSupport())
+        serializer = PrettyJSONSerializer()
+
+    def notified_urls(self, data):
+        """Returns a list of (url, branch) pairs. branch may be None
+
+        Returns an empty list if data isn't shaped like a payload we
+        understand."""
+        if not isinstance(data, dict):
+            return []
+
+        urls = []
+        if 'repository' in data and 'ref' in data:
+            branch = data['ref']
+            repo = data['repository']
+            if (not isinstance(branch, basestring) or
+                    not isinstance(repo, dict)):
+                return []
+            if branch.startswith('refs/heads/'):
+                branch = branch[len('refs/heads/'):]
+            for key in ('url', 'git_url', 'clone_url', 'ssh_url'):
+                if repo.get(key):
+                    urls.append((repo[key], branch))
+
+        branch_urls = data.get('urls', [])
+        if not isinstance(branch_urls, list):
+            return []
+        for branch_url in branch_urls + [data.get('url')]:
+            if branch_url:
+                if not isinstance(branch_url, basestring):
+                    return []
+                urls.append((branch_url, None))
+        return urls
+
+    def post_list(self, request, **kwargs):
+        content_type = request.META.get('CONTENT_TYPE', 'application/json')
+        try:
+            if content_type.startswith('application/x-www-form-urlencoded'):
+                data = simplejson.loads(request.POST['payload'])
+            else:
+                data = self.deserialize(request, request.raw_post_data,
+                                        format=content_type)
+        except Exception:
+            return http.HttpBadRequest()
+
+        urls = self.notified_urls(data)
+        if not urls:
+            return http.HttpBadRequest()
+
+        pkg_src_ids = set()
+        for branch_url, branch in urls:
+            for pkg_src in PackageSource.matching_url(branch_url, branch):
+                pkg_src_ids.add(pkg_src.id)
+
+        for pkg_src_id in sorted(pkg_src_ids):
+            tasks.poll_package_source.delay(pkg_src_id)
+
+        return self.create_response(request,
+                                    {'package_sources': sorted(pkg_src_ids)},
+                                    response_class=HttpAccepted)
+
+
 api.register(ArchitectureResource())
 api.register(RepositoryResource())
 api.register(SeriesResource())
 api.register(SubscriptionResource())
 api.register(PackageSourceResource())
+api.register(PushNotificationResource())
 
 models.signals.post_save.connect(create_api_key, sender=User)
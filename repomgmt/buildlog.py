@@ -0,0 +1,225 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""Compressed build log storage
+
+A build log is stored as a series of independent gzip members, each
+holding one block of the log, so the file as a whole is still a valid
+gzip stream that zcat and friends read just fine. A sidecar index holds a
+fixed size record per block with the block's offset in the compressed
+file and in the raw log, so the end of a log can be found without
+reading the rest of it.
+"""
+import gzip
+import os
+import re
+import StringIO
+import struct
+import time
+
+BLOCK_SIZE = 64 * 1024
+
+# Even if a block isn't full, write it out after this many seconds so
+# that the log of a running build stays reasonably current.
+FLUSH_INTERVAL = 10
+
+INDEX_RECORD = struct.Struct('>QQ')
+
+
+def index_path(path):
+    return '%s.idx' % (path,)
+
+
+def compress(data):
+    buf = StringIO.StringIO()
+    fp = gzip.GzipFile(fileobj=buf, mode='wb')
+    fp.write(data)
+    fp.close()
+    return buf.getvalue()
+
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+
+class BuildLogWriter(object):
+    """Appends to the compressed build log at path"""
+    def __init__(self, path, block_size=BLOCK_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+
+        if os.path.exists(path):
+            self.raw_size = BuildLogReader(path).raw_size()
+        else:
+            self.raw_size = 0
+
+        self.fp = open(path, 'ab')
+        self.index_fp = open(index_path(path), 'ab')
+        self.buf = []
+        self.buffered = 0
+        self.last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.flush()
+        else:
+            self.flush_if_stale()
+
+    def flush_if_stale(self):
+        """Flushes if data has been held back for flush_interval seconds
+
+        write() takes care of this while data keeps coming. Call it
+        when the stream goes quiet as well, or whatever came last
+        before the silence doesn't show up until it ends."""
+        if (self.buffered and
+                time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffered:
+            return
+
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buffered = 0
+
+        self.fp.seek(0, os.SEEK_END)
+        offset = self.fp.tell()
+        self.fp.write(compress(data))
+        self.fp.flush()
+
+        # The block is on disk before it's in the index, so readers
+        # never find an index record pointing past the end of the log.
+        self.index_fp.write(INDEX_RECORD.pack(offset, self.raw_size))
+        self.index_fp.flush()
+        self.raw_size += len(data)
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+        self.index_fp.close()
+
+
+class BuildLogReader(object):
+    """Reads the compressed build log at path"""
+    def __init__(self, path):
+        self.path = path
+
+    def block_count(self):
+        return os.path.getsize(index_path(self.path)) / INDEX_RECORD.size
+
+    def _record(self, fp, i):
+        fp.seek(i * INDEX_RECORD.size)
+        return INDEX_RECORD.unpack(fp.read(INDEX_RECORD.size))
+
+    def read_block(self, i):
+        with open(index_path(self.path), 'rb') as index_fp:
+            offset, _ = self._record(index_fp, i)
+            if i + 1 < self.block_count():
+                end, _ = self._record(index_fp, i + 1)
+            else:
+                end = None
+
+        with open(self.path, 'rb') as fp:
+            fp.seek(offset)
+            if end is None:
+                data = fp.read()
+            else:
+                data = fp.read(end - offset)
+        return decompress(data)
+
+    def raw_size(self):
+        n = self.block_count()
+        if n == 0:
+            return 0
+        with open(index_path(self.path), 'rb') as index_fp:
+            _, raw_offset = self._record(index_fp, n - 1)
+        return raw_offset + len(self.read_block(n - 1))
+
+    def tail(self, max_lines):
+        """Returns the last max_lines lines of the log
+
+        Only the blocks holding those lines are read."""
+        blocks = []
+        newlines = 0
+        for i in range(self.block_count() - 1, -1, -1):
+            block = self.read_block(i)
+            blocks.insert(0, block)
+            newlines += block.count('\n')
+            if newlines > max_lines:
+                break
+        return ''.join(''.join(blocks).splitlines(True)[-max_lines:])
+
+    def __iter__(self):
+        for i in range(self.block_count()):
+            yield self.read_block(i)
+
+
+class SbuildSummaryParser(object):
+    """Picks the summary out of sbuild's output as it streams past
+
+    sbuild ends its output with a box headed "Summary", followed by a
+    blank line and a "Key: value" line per field. Only the current
+    partial line is kept in memory."""
+    HEADING_RE = re.compile(r'^\|\s*Summary\s*\|$')
+
+    # Lines to skip between the heading and the fields: the bottom of
+    # the heading box and a blank line.
+    SKIP_LINES = 2
+
+    def __init__(self):
+        self.summary = {}
+        self.partial = ''
+        self.skip = None
+
+    def feed(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._parse_line(line.rstrip('\r'))
+
+    def close(self):
+        if self.partial:
+            self._parse_line(self.partial)
+            self.partial = ''
+        return self.summary
+
+    def _parse_line(self, line):
+        if self.HEADING_RE.match(line.strip()):
+            # A later summary replaces any earlier one
+            self.summary = {}
+            self.skip = self.SKIP_LINES
+        elif self.skip is None:
+            return
+        elif self.skip > 0:
+            self.skip -= 1
+        elif ':' in line:
+            k, v = line.split(':', 1)
+            self.summary[k] = v.strip()
+        else:
+            self.skip = None
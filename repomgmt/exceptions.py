@@ -28,3 +28,19 @@ class CommandFailed(Exception):
         self.stdout = stdout
         self.stderr = stderr
         super(CommandFailed, self).__init__(msg)
+
+
+class CommandTimedOut(CommandFailed):
+    pass
+
+
+class RemoteCommandFailed(Exception):
+    def __init__(self, msg, cmd, returncode):
+        self.cmd = cmd
+        self.returncode = returncode
+        super(RemoteCommandFailed, self).__init__(msg)
+
+
+class RemoteCommandTimedOut(RemoteCommandFailed):
+    def __init__(self, msg, cmd=None):
+        super(RemoteCommandTimedOut, self).__init__(msg, cmd, None)
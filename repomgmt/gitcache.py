@@ -0,0 +1,154 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from contextlib import contextmanager
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from repomgmt import utils
+from repomgmt.exceptions import CommandFailed
+
+logger = logging.getLogger(__name__)
+
+
+class GitCache(object):
+    """The shared git repository that checkouts borrow objects from
+
+    Every remote we've checked out code from is a remote in the cache.
+    Clones are made with --reference to the cache, so only objects the
+    cache doesn't already have get downloaded.
+
+    Locking:
+     * Anything using the cache (including clones referencing it) must
+       happen inside in_use(). maintain() only runs when nothing is.
+     * Fetches from a given remote are serialised, so concurrent
+       builds from the same remote only fetch once.
+     * Changes to the cache's configuration (adding remotes) are
+       serialised."""
+    def __init__(self, path=None):
+        self.path = path or settings.GIT_CACHE_DIR
+
+    def _git(self, *args, **kwargs):
+        return utils.run_cmd(['git'] + list(args), cwd=self.path, **kwargs)
+
+    def _lock(self, name, **kwargs):
+        return utils.file_lock(utils.lock_path('git-cache-%s' % (name,)),
+                               **kwargs)
+
+    @contextmanager
+    def in_use(self):
+        with self._lock('maintenance', blocking=True, shared=True):
+            if not os.path.exists(self.path):
+                with self._lock('config', blocking=True):
+                    if not os.path.exists(self.path):
+                        utils.run_cmd(['git', 'init', self.path])
+            yield self
+
+    @classmethod
+    def remote_name(cls, url):
+        return url.split('#')[0].replace(':', '_').replace('/', '_')
+
+    def has_object(self, revision):
+        try:
+            self._git('cat-file', '-e', '%s^{commit}' % (revision,))
+            return True
+        except CommandFailed:
+            return False
+
+    def ensure_remote(self, url):
+        remote = self.remote_name(url)
+        with self._lock('config', blocking=True):
+            if remote not in self._git('remote').split('\n'):
+                self._git('remote', 'add', remote, url.split('#')[0])
+        return remote
+
+    def ensure_revision(self, url, revision):
+        """Makes sure revision is in the cache, fetching it from url
+        (which may specify a branch with '#branch') if needed"""
+        if self.has_object(revision):
+            return
+
+        remote = self.ensure_remote(url)
+        with self._lock('remote-%s' % (remote,), blocking=True):
+            # Someone else may have fetched it while we waited
+            if self.has_object(revision):
+                return
+
+            if '#' in url:
+                branch = url.split('#')[1]
+            else:
+                branch = 'master'
+
+            logger.info('Fetching %s from %s' % (branch, remote))
+            try:
+                self._git('fetch', remote, '+refs/heads/%s:refs/remotes/%s/%s'
+                                           % (branch, remote, branch))
+            except CommandFailed:
+                # Probably a tag rather than a branch
+                pass
+
+            if not self.has_object(revision):
+                logger.info('%s not on %s, fetching all of %s' %
+                            (revision, branch, remote))
+                self._git('fetch', '--tags', remote)
+                self._git('fetch', remote)
+
+    @property
+    def maintained_stamp(self):
+        return os.path.join(self.path, '.git', 'repomgmt-maintained')
+
+    def last_maintained(self):
+        """Returns when maintain() last ran (as a timestamp), or None"""
+        try:
+            return os.path.getmtime(self.maintained_stamp)
+        except OSError:
+            return None
+
+    def maintain(self):
+        """Repacks the cache (with bitmaps) and prunes unreachable objects
+
+        Returns False if the cache was in use, in which case nothing
+        was done."""
+        if not os.path.exists(self.path):
+            return True
+
+        with self._lock('maintenance') as locked:
+            if not locked:
+                last = self.last_maintained()
+                if last is None:
+                    logger.warning('Git cache in use, not maintaining it '
+                                   'now. It has never been maintained.')
+                else:
+                    logger.warning('Git cache in use, not maintaining it '
+                                   'now. Last maintained %.1f hours ago.' %
+                                   ((time.time() - last) / 3600,))
+                return False
+
+            logger.info('Repacking git cache %s' % (self.path,))
+            # -A rather than -a: unreachable objects are left loose
+            # instead of dropped, so the prune below gets to decide based
+            # on their age.
+            self._git('repack', '-A', '-d', '-b')
+            self._git('prune', '--expire',
+                      getattr(settings, 'GIT_CACHE_PRUNE_EXPIRE',
+                              '2.weeks.ago'))
+            self._git('pack-refs', '--all')
+            open(self.maintained_stamp, 'w').close()
+            return True
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""Forwards a reprepro hook invocation to repo-hook-server
+
+Usage: hookclient.py <socket> <command> [<args>...]
+
+This deliberately only uses the standard library, so that it starts
+quickly. If the hook server can't be reached, it exits with status 75
+so that the calling script can fall back to running the command through
+manage.py.
+"""
+import json
+import os
+import socket
+import sys
+
+UNAVAILABLE = 75
+
+
+def build_request(command, args, environ=os.environ):
+    return {'command': command,
+            'args': args,
+            'cwd': os.getcwd(),
+            'env': dict((k, v) for k, v in environ.items()
+                        if k.startswith('REPREPRO_'))}
+
+
+def send_request(sock, request):
+    sock.sendall(json.dumps(request) + '\n')
+    sock.shutdown(socket.SHUT_WR)
+    data = []
+    while True:
+        s = sock.recv(4096)
+        if not s:
+            break
+        data.append(s)
+    return json.loads(''.join(data))
+
+
+def main(argv):
+    path, command, args = argv[1], argv[2], argv[3:]
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return UNAVAILABLE
+
+    try:
+        reply = send_request(sock, build_request(command, args))
+    finally:
+        sock.close()
+
+    sys.stderr.write(reply['output'])
+    return reply['status']
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
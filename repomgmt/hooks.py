@@ -0,0 +1,208 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import json
+import logging
+import os
+import select
+import socket
+import StringIO
+import traceback
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+
+from repomgmt.models import BuildRecord
+
+logger = logging.getLogger(__name__)
+
+# The commands reprepro's Log: scripts may run through the hook server
+HOOK_COMMANDS = ('repo-create-build-records',
+                 'repo-process-changes',
+                 'repo-import-dsc-to-git',
+                 'repo-record-published-source')
+
+
+class HookServer(object):
+    """Runs reprepro hook commands sent by hookclient.py
+
+    Runs in a single process, so Django and the models only get
+    imported once, rather than once for every event. Database writes
+    from events that queued up behind each other are committed
+    together, once no more events are waiting or
+    settings.HOOK_BATCH_SIZE events have been handled. Clients only get
+    their reply once their event has been committed. On databases
+    without savepoints, each event is committed on its own, since a
+    failing event would otherwise take the whole batch with it.
+    Working out which builds are blocked is left until the batch is
+    committed, so that it's done once per series rather than once per
+    queued build.
+
+    Commands run one at a time, so a slow one (repo-import-dsc-to-git
+    on a big package, say) holds up the hooks of every repository
+    until it's done."""
+    def __init__(self, path):
+        self.path = path
+        self.batch_size = getattr(settings, 'HOOK_BATCH_SIZE', 100)
+        self.client_timeout = getattr(settings, 'HOOK_CLIENT_TIMEOUT', 10)
+        self.uncommitted = 0
+        # (connection, reply) pairs waiting for the next commit
+        self.replies = []
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0660)
+        self.sock.listen(16)
+
+    def serve_forever(self):
+        self.listen()
+        logger.info('Listening for reprepro hooks on %s' % (self.path,))
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        BuildRecord.defer_blocked_updates()
+        try:
+            while True:
+                # The clients are waiting for their replies, so only
+                # keep the batch open while more events are queued up
+                timeout = 0 if self.replies else None
+                r, _, __ = select.select([self.sock], [], [], timeout)
+                if not r:
+                    self.commit()
+                    continue
+
+                conn, _ = self.sock.accept()
+                try:
+                    self.handle(conn)
+                except Exception:
+                    logger.error('Failed to handle hook request',
+                                 exc_info=True)
+                    conn.close()
+
+                if (self.uncommitted >= self.batch_size or
+                        not connection.features.uses_savepoints):
+                    self.commit()
+        finally:
+            self.commit()
+            BuildRecord.flush_blocked_updates(stop=True)
+            transaction.leave_transaction_management()
+            os.unlink(self.path)
+
+    def commit(self):
+        if self.uncommitted:
+            logger.debug('Committing %d events' % (self.uncommitted,))
+            try:
+                BuildRecord.flush_blocked_updates()
+                transaction.commit()
+            except Exception:
+                logger.error('Failed to commit %d events' %
+                             (self.uncommitted,), exc_info=True)
+                transaction.rollback()
+                self.fail_replies(traceback.format_exc())
+            self.uncommitted = 0
+        self.send_replies()
+
+    def fail_replies(self, output):
+        """Turns the pending replies into failures
+
+        For when the events they answer were rolled back."""
+        self.replies = [(conn, {'status': 1,
+                                'output': reply['output'] + output})
+                        for conn, reply in self.replies]
+
+    def send_replies(self):
+        for conn, reply in self.replies:
+            try:
+                conn.sendall(json.dumps(reply))
+            except Exception:
+                logger.error('Failed to send hook reply', exc_info=True)
+            finally:
+                conn.close()
+        self.replies = []
+
+    def handle(self, conn):
+        # Don't let a client that never finishes its request block
+        # everyone else's hooks
+        conn.settimeout(self.client_timeout)
+        data = []
+        while True:
+            s = conn.recv(4096)
+            if not s:
+                break
+            data.append(s)
+        request = json.loads(''.join(data))
+        status, output = self.run(request['command'], request['args'],
+                                  request.get('env', {}),
+                                  request.get('cwd'))
+        # Sent (and conn closed) by the next commit()
+        self.replies.append((conn, {'status': status, 'output': output}))
+
+    def run(self, command, args, env, cwd):
+        if command not in HOOK_COMMANDS:
+            return 1, 'Unknown hook command %r\n' % (command,)
+
+        logger.debug('Running %s %r' % (command, args))
+        output = StringIO.StringIO()
+        old_cwd = os.getcwd()
+        old_env = dict((k, os.environ.get(k)) for k in env)
+        os.environ.update(env)
+        sid = transaction.savepoint()
+        try:
+            if cwd:
+                os.chdir(cwd)
+            call_command(command, *args, stdout=output, stderr=output)
+            status = 0
+        except Exception:
+            logger.info('Hook command %s %r failed' % (command, args),
+                        exc_info=True)
+            output.write(traceback.format_exc())
+            status = 1
+        finally:
+            os.chdir(old_cwd)
+            for k, v in old_env.items():
+                if v is None:
+                    del os.environ[k]
+                else:
+                    os.environ[k] = v
+
+        try:
+            if sid and status == 0:
+                transaction.savepoint_commit(sid)
+            elif sid:
+                transaction.savepoint_rollback(sid)
+            elif status != 0:
+                transaction.rollback()
+                self.uncommitted = 0
+        except Exception:
+            # The command must have ended the transaction behind our
+            # back, taking the savepoint with it. Start afresh.
+            logger.error('Lost the savepoint for %s %r, rolling back %d '
+                         'uncommitted events' % (command, args,
+                                                 self.uncommitted),
+                         exc_info=True)
+            transaction.rollback()
+            self.uncommitted = 0
+            output.write(traceback.format_exc())
+            self.fail_replies('Rolled back after a later hook command '
+                              '(%s %r) failed\n' % (command, args))
+            return 1, output.getvalue()
+
+        self.uncommitted += 1
+        return status, output.getvalue()
@@ -0,0 +1,169 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from repomgmt.models import Repository
+from repomgmt.tasks import process_repository_incoming
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+logger = logging.getLogger(__name__)
+
+
+class IncomingWatcher(object):
+    """Runs processincoming for repositories as uploads complete
+
+    Changes to a repository's incoming directory mark it dirty. Once
+    nothing has changed for settings.INCOMING_SETTLE_TIME seconds, and
+    at least one .changes file there has all of its files uploaded, the
+    repository's incoming queue gets processed. This way, a multi-file
+    upload only triggers one run.
+
+    Uses inotify if pyinotify is installed. Otherwise, the incoming
+    directories are checked for changes every
+    settings.INCOMING_POLL_INTERVAL seconds. Either way, every
+    repository is swept every settings.INCOMING_SWEEP_INTERVAL seconds
+    in case an event was missed."""
+    def __init__(self):
+        self.settle_time = getattr(settings, 'INCOMING_SETTLE_TIME', 2)
+        self.poll_interval = getattr(settings, 'INCOMING_POLL_INTERVAL', 5)
+        self.sweep_interval = getattr(settings, 'INCOMING_SWEEP_INTERVAL',
+                                      300)
+        self.dirty = {}
+        self.snapshots = {}
+        self.last_sweep = None
+
+    def repositories(self):
+        return dict((repo.reprepro_incomingdir, repo)
+                    for repo in Repository.objects.all())
+
+    def touch(self, incomingdir, now=None):
+        self.dirty[incomingdir] = now or time.time()
+
+    def snapshot(self, incomingdir):
+        try:
+            names = os.listdir(incomingdir)
+        except OSError:
+            return None
+        snapshot = set()
+        for name in names:
+            try:
+                st = os.stat(os.path.join(incomingdir, name))
+            except OSError:
+                continue
+            snapshot.add((name, st.st_size, st.st_mtime))
+        return frozenset(snapshot)
+
+    def scan(self, now=None):
+        """Marks incoming directories that changed since the last scan
+
+        Only used if pyinotify isn't available."""
+        for incomingdir in self.repositories():
+            snapshot = self.snapshot(incomingdir)
+            if snapshot != self.snapshots.get(incomingdir):
+                self.snapshots[incomingdir] = snapshot
+                self.touch(incomingdir, now)
+
+    def process(self, repo):
+        if not repo.complete_uploads():
+            return False
+        logger.info('Processing incoming for %s' % (repo.name,))
+        try:
+            if not process_repository_incoming(repo.name):
+                # Someone else holds the lock, so try again later
+                self.touch(repo.reprepro_incomingdir)
+                return False
+        except Exception, e:
+            logger.error('Error processing incoming for %s', repo.name,
+                         exc_info=e)
+        return True
+
+    def process_settled(self, now=None):
+        """Processes the dirty repositories that have settled down
+
+        Returns the repositories that were processed."""
+        now = now or time.time()
+        repos = self.repositories()
+        processed = []
+
+        if (self.last_sweep is None or
+                now - self.last_sweep >= self.sweep_interval):
+            self.last_sweep = now
+            for incomingdir in repos:
+                self.dirty.setdefault(incomingdir, 0)
+
+        for incomingdir, touched in self.dirty.items():
+            if now - touched < self.settle_time:
+                continue
+            del self.dirty[incomingdir]
+            repo = repos.get(incomingdir)
+            if repo and self.process(repo):
+                processed.append(repo)
+        return processed
+
+    def timeout(self):
+        if not self.dirty:
+            return self.poll_interval
+        now = time.time()
+        return max(0, min(touched + self.settle_time - now
+                          for touched in self.dirty.values()))
+
+    def run(self):
+        if pyinotify is None:
+            logger.info('pyinotify not available, polling incoming '
+                        'directories every %ds' % (self.poll_interval,))
+            self.run_polling()
+        else:
+            self.run_inotify()
+
+    def run_polling(self):
+        while True:
+            self.scan()
+            self.process_settled()
+            time.sleep(min(self.poll_interval, self.timeout()) or 0.1)
+
+    def run_inotify(self):
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                watcher.touch(os.path.dirname(event.pathname))
+
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, Handler())
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_DELETE)
+        watched = set()
+
+        while True:
+            for incomingdir in self.repositories():
+                if incomingdir not in watched and os.path.isdir(incomingdir):
+                    wm.add_watch(incomingdir, mask)
+                    watched.add(incomingdir)
+
+            if notifier.check_events(timeout=self.timeout() * 1000):
+                notifier.read_events()
+                notifier.process_events()
+            self.process_settled()
@@ -0,0 +1,34 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from django.core.management.base import BaseCommand
+from repomgmt.models import BuildNodeImage, ChrootTarball
+
+
+class Command(BaseCommand):
+    args = '[<ubuntu series> <architecture>]'
+    help = 'Bakes build node images for chroots that lack them'
+
+    def handle(self, *args, **options):
+        tb = None
+        if args:
+            series_arg, arch_arg = args
+            tb = ChrootTarball.objects.get(series__name=series_arg,
+                                           architecture__name=arch_arg)
+
+        for cloud, tarball in BuildNodeImage.missing(tb):
+            BuildNodeImage.bake(cloud, tarball)
@@ -0,0 +1,114 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from repomgmt.models import Architecture, BuildNode, BuildRecord, Cloud
+from repomgmt.models import Repository, Series, UbuntuSeries
+
+
+class Command(BaseCommand):
+    args = '[<queued records> [<claimers>]]'
+    help = ('Measures BuildRecord.pick_build latency on a scratch test '
+            'database (defaults: 100000 records, 32 claimers)')
+
+    def handle(self, *args, **options):
+        records = int(args[0]) if len(args) > 0 else 100000
+        claimers = int(args[1]) if len(args) > 1 else 32
+
+        # create_test_db returns the name of the test database, but
+        # destroy_test_db wants the one to switch back to.
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            self.populate(records, claimers)
+            claimed, latencies = self.run_claimers(claimers)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        latencies.sort()
+        n = len(latencies)
+        self.stdout.write('%d builds claimed by %d claimers on %s, '
+                          '%d of them more than once\n' %
+                          (n, claimers, connection.vendor,
+                           n - len(set(claimed))))
+        for label, q in [('median', 0.5), ('p95', 0.95), ('p99', 0.99)]:
+            self.stdout.write('%-7s %.2f ms\n' %
+                              (label, latencies[int(q * (n - 1))] * 1000))
+        self.stdout.write('%-7s %.2f ms\n' % ('max', latencies[-1] * 1000))
+
+    def populate(self, records, claimers):
+        Architecture.objects.get_or_create(name='amd64')
+        UbuntuSeries.objects.get_or_create(name='precise')
+        Cloud.objects.get_or_create(name='benchmark')
+
+        # bulk_create skips the save() hooks, which would otherwise
+        # write reprepro configuration and generate keys.
+        Repository.objects.bulk_create([Repository(name='benchmark')])
+        Series.objects.bulk_create([Series(name='benchmark',
+                                           repository_id='benchmark',
+                                           base_ubuntu_series_id='precise')])
+        series = Series.objects.get()
+        BuildNode.objects.bulk_create([BuildNode(name='benchmark-%d' % i,
+                                                 cloud_id='benchmark')
+                                       for i in range(claimers)])
+
+        batch = []
+        for i in range(records):
+            batch.append(BuildRecord(series=series, architecture_id='amd64',
+                                     source_package_name='pkg%d' % i,
+                                     version='1.0', priority=i % 1000))
+            if len(batch) == 1000:
+                BuildRecord.objects.bulk_create(batch)
+                batch = []
+        BuildRecord.objects.bulk_create(batch)
+
+    def run_claimers(self, claimers):
+        """Has claimers threads claim builds until there are none left
+
+        Like the threads of repo-supervise-builds, they share the
+        pickers of a dispatch pass. Returns the ids of the claimed builds
+        and the claim latencies."""
+        claimed = []
+        latencies = []
+        lock = threading.Lock()
+        pickers = {}
+
+        def claim(build_node):
+            try:
+                while True:
+                    start = time.time()
+                    br = BuildRecord.pick_build(build_node, pickers=pickers)
+                    elapsed = time.time() - start
+                    if br is None:
+                        return
+                    with lock:
+                        claimed.append(br.id)
+                        latencies.append(elapsed)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim, args=(bn,))
+                   for bn in BuildNode.objects.all()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return claimed, latencies
@@ -0,0 +1,44 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+
+from django.core.management.base import BaseCommand
+from repomgmt import buildlog
+from repomgmt.models import BuildRecord
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Converts uncompressed build logs to compressed ones'
+
+    def handle(self, **options):
+        for br in BuildRecord.objects.all():
+            if not os.path.exists(br.legacy_logfile()):
+                continue
+
+            if os.path.exists(br.logfile()):
+                # Built again since; the compressed log is newer
+                os.unlink(br.legacy_logfile())
+                continue
+
+            with open(br.legacy_logfile(), 'r') as fp:
+                with buildlog.BuildLogWriter(br.logfile()) as out:
+                    for data in iter(lambda: fp.read(buildlog.BLOCK_SIZE),
+                                     ''):
+                        out.write(data)
+            os.unlink(br.legacy_logfile())
@@ -91,11 +91,19 @@ class Command(BaseCommand):
             elif arch in known_archs:
                 build_archs.add(known_archs[arch])
 
+        build_depends = ', '.join(dsc[field]
+                                  for field in ('Build-Depends',
+                                                'Build-Depends-Indep')
+                                  if field in dsc)
+
         print build_archs
-        for arch in build_archs:
-            br = BuildRecord(source_package_name=pkg_name,
-                             version=pkg_version,
-                             architecture=arch,
-                             state=BuildRecord.NEEDS_BUILDING,
-                             series=series)
-            br.save()
+        with BuildRecord.deferred_blocked_updates():
+            for arch in build_archs:
+                br = BuildRecord(source_package_name=pkg_name,
+                                 version=pkg_version,
+                                 architecture=arch,
+                                 state=BuildRecord.NEEDS_BUILDING,
+                                 series=series,
+                                 build_depends=build_depends,
+                                 binaries=dsc.get('Binary', ''))
+                br.save()
@@ -16,12 +16,12 @@
 #   limitations under the License.
 #
 from django.core.management.base import BaseCommand
-from repomgmt.models import BuildRecord
+from repomgmt import tasks
 
 
 class Command(BaseCommand):
     args = ''
-    help = 'Processes the build queue'
+    help = 'Fills all free build slots with pending builds'
 
     def handle(self, **options):
-        BuildRecord.perform_single_build()
+        tasks.process_build_queue()
@@ -112,6 +112,9 @@ class Command(BaseCommand):
                                      version=pkg_version)
         br.update_state(BuildRecord.SUCCESFULLY_BUILT)
 
-        logger.info('Finished processing build record %r. Deleting associated '
-                    'build node %r' % (br, br.build_node))
-        br.build_node.delete()
+        BuildRecord.retry_dependency_waits(series, architecture,
+                                           changes['Binary'].split())
+
+        logger.info('Finished processing build record %r. Releasing '
+                    'associated build node %r' % (br, br.build_node))
+        br.build_node.upload_processed(br)
@@ -0,0 +1,34 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from django.core.management.base import BaseCommand
+from repomgmt.models import Series
+
+
+class Command(BaseCommand):
+    args = '[<repository> [<series>]]'
+    help = 'Rebuilds the published source index from reprepro'
+
+    def handle(self, repository_name=None, series_name=None, **options):
+        series = Series.objects.exclude(state=Series.CLOSED)
+        if repository_name is not None:
+            series = series.filter(repository__name=repository_name)
+        if series_name is not None:
+            series = series.filter(name=series_name)
+
+        for s in series:
+            s.reconcile_published_sources()
@@ -17,13 +17,43 @@
 #
 from django.core.management.base import BaseCommand
 from repomgmt.models import BuildNode
+from repomgmt.remote import CommandMultiplexer
 
 
 class Command(BaseCommand):
-    args = '<build_node_name> <command>'
-    help = 'Runs command on the given build node'
+    args = '<build_node_name>[,<build_node_name>...] <command>'
+    help = 'Runs command on the given build node(s)'
 
-    def handle(self, build_node_name, cmd, **options):
-        bn = BuildNode.objects.get(name=build_node_name)
-        for data in bn.run_cmd(cmd):
-            self.stdout.write(data)
+    def handle(self, build_node_names, cmd, **options):
+        build_nodes = [BuildNode.objects.get(name=name)
+                       for name in build_node_names.split(',')]
+
+        if len(build_nodes) == 1:
+            for data in build_nodes[0].run_cmd(cmd):
+                self.stdout.write(data)
+            return
+
+        multiplexer = CommandMultiplexer()
+        commands = {}
+        for bn in build_nodes:
+            commands[bn.name] = bn.start_cmd(cmd, multiplexer=multiplexer,
+                                             output_callback=self._writer(bn))
+        multiplexer.run_all(commands.values())
+
+        for name, command in sorted(commands.items()):
+            if command.error is not None:
+                self.stderr.write('%s: %s\n' % (name, command.error))
+            elif command.exit_status != 0:
+                self.stderr.write('%s: exited with status %d\n' %
+                                  (name, command.exit_status))
+
+    def _writer(self, bn):
+        """Prefixes each complete line of output with the node's name"""
+        lbuf = ['']
+
+        def write(data):
+            lbuf[0] += data
+            while '\n' in lbuf[0]:
+                line, lbuf[0] = lbuf[0].split('\n', 1)
+                self.stdout.write('%s: %s\n' % (bn.name, line))
+        return write
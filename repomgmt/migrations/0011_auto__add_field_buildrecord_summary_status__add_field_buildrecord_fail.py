@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'BuildRecord.summary_status'
+        db.add_column(u'repomgmt_buildrecord', 'summary_status',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=20, blank=True),
+                      keep_default=False)
+
+        # Adding field 'BuildRecord.fail_stage'
+        db.add_column(u'repomgmt_buildrecord', 'fail_stage',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=50, blank=True),
+                      keep_default=False)
+
+        # Adding field 'BuildRecord.build_time'
+        db.add_column(u'repomgmt_buildrecord', 'build_time',
+                      self.gf('django.db.models.fields.IntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'BuildRecord.install_time'
+        db.add_column(u'repomgmt_buildrecord', 'install_time',
+                      self.gf('django.db.models.fields.IntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'BuildRecord.package_time'
+        db.add_column(u'repomgmt_buildrecord', 'package_time',
+                      self.gf('django.db.models.fields.IntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'BuildRecord.build_space'
+        db.add_column(u'repomgmt_buildrecord', 'build_space',
+                      self.gf('django.db.models.fields.IntegerField')(null=True, blank=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'BuildRecord.summary_status'
+        db.delete_column(u'repomgmt_buildrecord', 'summary_status')
+
+        # Deleting field 'BuildRecord.fail_stage'
+        db.delete_column(u'repomgmt_buildrecord', 'fail_stage')
+
+        # Deleting field 'BuildRecord.build_time'
+        db.delete_column(u'repomgmt_buildrecord', 'build_time')
+
+        # Deleting field 'BuildRecord.install_time'
+        db.delete_column(u'repomgmt_buildrecord', 'install_time')
+
+        # Deleting field 'BuildRecord.package_time'
+        db.delete_column(u'repomgmt_buildrecord', 'package_time')
+
+        # Deleting field 'BuildRecord.build_space'
+        db.delete_column(u'repomgmt_buildrecord', 'build_space')
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'repomgmt.architecture': {
+            'Meta': {'object_name': 'Architecture'},
+            'builds_arch_all': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'})
+        },
+        u'repomgmt.buildnode': {
+            'Meta': {'object_name': 'BuildNode'},
+            'architecture': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Architecture']", 'null': 'True', 'blank': 'True'}),
+            'builds_completed': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'cloud': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Cloud']"}),
+            'cloud_node_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'image': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.BuildNodeImage']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'}),
+            'last_used': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'}),
+            'signing_key_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'state': ('django.db.models.fields.SmallIntegerField', [], {'default': '0'}),
+            'ubuntu_series': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.UbuntuSeries']", 'null': 'True', 'blank': 'True'})
+        },
+        u'repomgmt.buildnodeimage': {
+            'Meta': {'unique_together': "(('cloud', 'tarball'),)", 'object_name': 'BuildNodeImage'},
+            'cloud': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Cloud']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'tarball': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.ChrootTarball']"})
+        },
+        u'repomgmt.buildrecord': {
+            'Meta': {'unique_together': "(('series', 'source_package_name', 'version', 'architecture'),)", 'object_name': 'BuildRecord'},
+            'architecture': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Architecture']"}),
+            'build_node': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.BuildNode']", 'null': 'True', 'blank': 'True'}),
+            'build_space': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'build_time': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'fail_stage': ('django.db.models.fields.CharField', [], {'max_length': '50', 'blank': 'True'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'install_time': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'package_time': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'priority': ('django.db.models.fields.IntegerField', [], {'default': '100'}),
+            'series': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Series']"}),
+            'source_package_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'state': ('django.db.models.fields.SmallIntegerField', [], {'default': '8'}),
+            'summary_status': ('django.db.models.fields.CharField', [], {'max_length': '20', 'blank': 'True'}),
+            'version': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        u'repomgmt.chroottarball': {
+            'Meta': {'unique_together': "(('architecture', 'series'),)", 'object_name': 'ChrootTarball'},
+            'architecture': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Architecture']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_refresh': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'series': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.UbuntuSeries']"}),
+            'state': ('django.db.models.fields.SmallIntegerField', [], {'default': '1'})
+        },
+        u'repomgmt.cloud': {
+            'Meta': {'object_name': 'Cloud'},
+            'endpoint': ('django.db.models.fields.URLField', [], {'max_length': '200'}),
+            'flavor_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'image_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'region': ('django.db.models.fields.CharField', [], {'max_length': '200', 'blank': 'True'}),
+            'tenant_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'user_name': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        u'repomgmt.keypair': {
+            'Meta': {'unique_together': "(('cloud', 'name'),)", 'object_name': 'KeyPair'},
+            'cloud': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Cloud']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'private_key': ('django.db.models.fields.TextField', [], {}),
+            'public_key': ('django.db.models.fields.TextField', [], {})
+        },
+        u'repomgmt.packagesource': {
+            'Meta': {'object_name': 'PackageSource'},
+            'code_url': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'flavor': ('django.db.models.fields.CharField', [], {'default': "'OpenStack'", 'max_length': '200'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_changed': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'last_seen_code_rev': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'last_seen_pkg_rev': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'packaging_url': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        u'repomgmt.packagesourcebuildproblem': {
+            'Meta': {'object_name': 'PackageSourceBuildProblem'},
+            'code_rev': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'code_url': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'flavor': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'packaging_url': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'pkg_rev': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        u'repomgmt.repository': {
+            'Meta': {'object_name': 'Repository'},
+            'contact': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'}),
+            'signing_key_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'uploaders': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.User']", 'symmetrical': 'False'})
+        },
+        u'repomgmt.series': {
+            'Meta': {'unique_together': "(('name', 'repository'),)", 'object_name': 'Series'},
+            'base_ubuntu_series': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.UbuntuSeries']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'numerical_version': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'repository': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Repository']"}),
+            'state': ('django.db.models.fields.SmallIntegerField', [], {'default': '1'}),
+            'update_from': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Series']", 'null': 'True', 'blank': 'True'})
+        },
+        u'repomgmt.subscription': {
+            'Meta': {'object_name': 'Subscription'},
+            'counter': ('django.db.models.fields.IntegerField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.PackageSource']"}),
+            'target_series': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['repomgmt.Series']"})
+        },
+        u'repomgmt.tarballcacheentry': {
+            'Meta': {'object_name': 'TarballCacheEntry'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'project_version': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'rev_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '200', 'db_index': 'True'})
+        },
+        u'repomgmt.ubuntuseries': {
+            'Meta': {'object_name': 'UbuntuSeries'},
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'})
+        },
+        u'repomgmt.uploaderkey': {
+            'Meta': {'object_name': 'UploaderKey'},
+            'key_id': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'}),
+            'uploader': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        }
+    }
+
+    complete_apps = ['repomgmt']
\ No newline at end of file
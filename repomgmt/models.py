@@ -15,13 +15,16 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
+import collections
+from contextlib import contextmanager
 from glob import glob
-from datetime import date
+from datetime import date, timedelta
 import logging
 import os
 import os.path
 import random
 import paramiko
+from debian.deb822 import Changes, PkgRelation
 import select
 import shutil
 import StringIO
@@ -30,6 +33,7 @@ import sys
 import tempfile
 import termios
 import textwrap
+import threading
 import time
 import tty
 
@@ -37,7 +41,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 #from django.core.mail import email_admins
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connection, models, transaction
 from django.template.loader import render_to_string
 from django.utils import timezone
 
@@ -51,17 +55,53 @@ else:
     # FIXME(ben): update to at least V2 api
     client = novaclient.v1_1.client
 
+from repomgmt import buildlog
+from repomgmt import remote
 from repomgmt import utils
-from repomgmt.exceptions import CommandFailed
+from repomgmt.exceptions import CommandFailed, RemoteCommandTimedOut
+from repomgmt.gitcache import GitCache
 
 logger = logging.getLogger(__name__)
 
 
+def parse_distributions(s):
+    """Splits the contents of reprepro's conf/distributions up into
+    a dict mapping each codename to its definition"""
+    distributions = {}
+    for stanza in s.split('\n\n'):
+        for line in stanza.split('\n'):
+            if line.startswith('Codename:'):
+                codename = line[len('Codename:'):].strip()
+                distributions[codename] = stanza.strip()
+    return distributions
+
+
+def arch_qualifier_applies(qualifier, architecture):
+    """Tells whether a Build-Depends architecture qualifier (as parsed
+    by PkgRelation, e.g. [!i386] or [amd64 linux-any]) includes
+    architecture. We only build for Linux, so that's the only OS
+    wildcards are matched against."""
+    if not qualifier:
+        return True
+
+    def matches(pattern):
+        return pattern in ('any', 'linux-any', 'any-' + architecture,
+                           architecture)
+
+    if any(matches(arch) for enabled, arch in qualifier if not enabled):
+        return False
+    wanted = [arch for enabled, arch in qualifier if enabled]
+    return not wanted or any(matches(arch) for arch in wanted)
+
+
 class Repository(models.Model):
     name = models.CharField(max_length=200, primary_key=True)
     signing_key_id = models.CharField(max_length=200)
     uploaders = models.ManyToManyField(User)
     contact = models.EmailField()
+    incoming_processed = models.DateTimeField(null=True, blank=True)
+    incoming_duration = models.FloatField(null=True, blank=True)
+    incoming_latency = models.FloatField(null=True, blank=True)
 
     class Meta:
         verbose_name_plural = "repositories"
@@ -94,8 +134,69 @@ class Repository(models.Model):
     def reprepro_incomingdir(self):
         return '%s/%s' % (settings.BASE_INCOMING_DIR, self.name)
 
+    @property
+    def reprepro_lockfile(self):
+        return '%s/db/lockfile' % (self.reprepro_dir,)
+
+    @property
+    def incoming_lockfile(self):
+        return '%s/incoming.lock' % (self.reprepro_dir,)
+
+    def reprepro_locked(self):
+        return os.path.exists(self.reprepro_lockfile)
+
     def process_incoming(self):
+        # reprepro removes the uploads it processes, so note when they
+        # arrived beforehand.
+        uploaded = []
+        for path in self.complete_uploads():
+            try:
+                uploaded.append(os.path.getmtime(path))
+            except OSError:
+                pass
+
+        start = time.time()
         self._reprepro('processincoming', 'incoming')
+        end = time.time()
+
+        # How long the oldest upload had to wait for us
+        latency = None
+        if uploaded:
+            latency = end - min(uploaded)
+
+        logger.info('Processed incoming for %s in %.1fs' %
+                    (self.name, end - start))
+        self.incoming_processed = timezone.now()
+        self.incoming_duration = end - start
+        self.incoming_latency = latency
+        # Not save(), which would rewrite reprepro's configuration
+        Repository.objects.filter(pk=self.pk).update(
+                incoming_processed=self.incoming_processed,
+                incoming_duration=self.incoming_duration,
+                incoming_latency=self.incoming_latency)
+
+    def complete_uploads(self):
+        """Returns the .changes files in the incoming directory whose
+        files have all been uploaded in full"""
+        complete = []
+        for path in sorted(glob('%s/*.changes' % (self.reprepro_incomingdir,))):
+            try:
+                with open(path, 'r') as fp:
+                    changes = Changes(fp)
+            except (IOError, OSError):
+                continue
+
+            for f in changes.get('Files', []):
+                fpath = os.path.join(self.reprepro_incomingdir, f['name'])
+                try:
+                    if os.path.getsize(fpath) != int(f['size']):
+                        break
+                except OSError:
+                    break
+            else:
+                if changes.get('Files'):
+                    complete.append(path)
+        return complete
 
     def not_closed_series(self):
         return self.series_set.exclude(state=Series.CLOSED)
@@ -124,7 +225,44 @@ class Repository(models.Model):
         self.signing_key_id = key_id
         self.signing_key.public_key
 
-    def write_configuration(self):
+    def configuration_context(self):
+        """Loads everything reprepro's configuration templates need
+
+        This takes a fixed number of queries, no matter how many series,
+        uploaders or build nodes the repository has. Everything is
+        ordered, so the rendered configuration only changes when the
+        data does."""
+        series = list(self.series_set.select_related('base_ubuntu_series',
+                                                     'update_from__repository')
+                                     .order_by('pk'))
+        uploader_keys = UploaderKey.objects.filter(
+                uploader__in=self.uploaders.all())
+        builder_keys = (BuildNode.objects
+                                 .filter(buildrecord__series__repository=self)
+                                 .exclude(signing_key_id='')
+                                 .order_by('signing_key_id')
+                                 .values_list('signing_key_id', flat=True)
+                                 .distinct())
+        return {'repository': self,
+                'all_series': series,
+                'not_closed_series': [s for s in series
+                                      if s.state != Series.CLOSED],
+                'uploader_keys': list(uploader_keys
+                                      .order_by('uploader', 'key_id')
+                                      .values_list('key_id', flat=True)),
+                'builder_keys': list(builder_keys),
+                'architectures': list(Architecture.objects.order_by('name')),
+                'settings': settings,
+                'hookclient': os.path.join(os.path.dirname(__file__),
+                                           'hookclient.py'),
+                'outdir': self.reprepro_outdir}
+
+    def write_configuration(self, force=False):
+        """Writes out reprepro's configuration for this repository
+
+        Only files whose contents changed get rewritten, and only the
+        distributions whose definitions changed get exported. With
+        force, everything gets exported regardless."""
         logger.debug('Writing out config for %s' % (self.name,))
 
         confdir = '%s/conf' % (self.reprepro_dir,)
@@ -134,6 +272,8 @@ class Repository(models.Model):
         settings_module_dir = os.path.dirname(settings_module.__file__)
         basedir = os.path.normpath(os.path.join(settings_module_dir,
                                                 os.pardir))
+        context = self.configuration_context()
+        context['basedir'] = basedir
 
         for d, setgid in [(settings.BASE_PUBLIC_REPO_DIR, False),
                           (confdir, False), (self.reprepro_incomingdir, True)]:
@@ -142,25 +282,60 @@ class Repository(models.Model):
                 if setgid:
                     os.chmod(d, 02775)
 
+        distributions_path = '%s/distributions' % (confdir,)
+        try:
+            with open(distributions_path, 'r') as fp:
+                old_distributions = parse_distributions(fp.read())
+        except IOError:
+            old_distributions = {}
+
+        distributions = render_to_string('reprepro/distributions.tmpl',
+                                         context)
+        new_distributions = parse_distributions(distributions)
+        if force:
+            changed = set(new_distributions)
+        else:
+            changed = set(codename for codename in new_distributions
+                          if (new_distributions[codename] !=
+                              old_distributions.get(codename)))
+
+        # Once the new distributions file is in place, a failed export
+        # would go unnoticed next time round. Until the export succeeds,
+        # the distributions to export are kept in a file of their own.
+        pending_path = '%s/.pending-export' % (confdir,)
+        try:
+            with open(pending_path, 'r') as fp:
+                changed.update(codename for codename in fp.read().split()
+                               if codename in new_distributions)
+        except IOError:
+            pass
+        changed = sorted(changed)
+        if changed:
+            utils.write_file_if_changed(pending_path,
+                                        '\n'.join(changed) + '\n')
+
         for f in ['distributions', 'incoming', 'options', 'pulls',
                   'uploaders', 'create-build-records.sh', 'dput.cf',
-                  'process-changes.sh', 'import-dsc-to-git.sh', 'updates']:
-            s = render_to_string('reprepro/%s.tmpl' % (f,),
-                                 {'repository': self,
-                                  'architectures': Architecture.objects.all(),
-                                  'settings': settings,
-                                  'basedir': basedir,
-                                  'outdir': self.reprepro_outdir})
+                  'process-changes.sh', 'import-dsc-to-git.sh', 'updates',
+                  'record-published-source.sh']:
+            if f == 'distributions':
+                s = distributions
+            else:
+                s = render_to_string('reprepro/%s.tmpl' % (f,), context)
             path = '%s/%s' % (confdir, f)
 
-            with open(path, 'w') as fp:
-                fp.write(s)
-
             if path.endswith('.sh'):
-                os.chmod(path, 0755)
+                mode = 0755
+            else:
+                mode = 0644
 
-        if self.series_set.count() > 0:
-            self._reprepro('export')
+            if utils.write_file_if_changed(path, s, mode):
+                logger.debug('Wrote %s' % (path,))
+
+        if changed:
+            logger.info('Exporting %s in %s' % (', '.join(changed), self.name))
+            self._reprepro('export', *changed)
+            os.unlink(pending_path)
 
     def save(self, *args, **kwargs):
         self.write_configuration()
@@ -242,6 +417,7 @@ class Series(models.Model):
     state = models.SmallIntegerField(default=ACTIVE,
                                      choices=SERIES_STATES)
     update_from = models.ForeignKey('Series', null=True, blank=True)
+    published_sources_synced = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         verbose_name_plural = "series"
@@ -304,7 +480,8 @@ class Series(models.Model):
         logger.info('Flushing queue for %s' % (self,))
         self.repository._reprepro('pull', '%s-proposed' % (self.name, ))
 
-    def get_source_packages(self):
+    def list_source_packages(self):
+        """Asks reprepro for the sources in each pocket of this series"""
         pkgs = {}
 
         def get_pkglist(distribution):
@@ -317,16 +494,110 @@ class Series(models.Model):
                 pkg_name, pkg_version = l.split(' ')[1:]
                 yield (pkg_name, pkg_version)
 
-        for distribution_fmt, key in [('%s', 'stable'),
-                                      ('%s-proposed', 'proposed'),
-                                      ('%s-queued', 'queued')]:
-            distribution = distribution_fmt % (self.name,)
-            pkgs[key] = {}
+        for pocket in PublishedSource.POCKETS:
+            distribution = self.distribution_for_pocket(pocket)
+            pkgs[pocket] = {}
             for pkg_name, pkg_version in get_pkglist(distribution):
-                pkgs[key][pkg_name] = pkg_version
+                pkgs[pocket][pkg_name] = pkg_version
+
+        return pkgs
+
+    @classmethod
+    def for_distribution(cls, repository, codename):
+        """Maps a reprepro codename to a (series, pocket) tuple"""
+        name, pocket = codename, PublishedSource.STABLE
+        for p in (PublishedSource.PROPOSED, PublishedSource.QUEUED):
+            if codename.endswith('-%s' % (p,)):
+                name, pocket = codename[:-len(p) - 1], p
+        return cls.objects.get(repository=repository, name=name), pocket
+
+    def distribution_for_pocket(self, pocket):
+        if pocket == PublishedSource.STABLE:
+            return self.name
+        return '%s-%s' % (self.name, pocket)
+
+    def reconcile_published_sources(self, unless_synced=False):
+        """Rebuilds this series' PublishedSource records from reprepro
+
+        The series is locked while at it, so concurrent reconciliations
+        take turns. With unless_synced, nothing is done if the records
+        turn out to have been built in the meantime."""
+        with utils.commit_on_success_unless_managed():
+            synced = Series.objects.select_for_update().get(
+                                      pk=self.pk).published_sources_synced
+            if unless_synced and synced is not None:
+                self.published_sources_synced = synced
+                return
+
+            pkgs = self.list_source_packages()
+            PublishedSource.objects.filter(series=self).delete()
+            PublishedSource.objects.bulk_create(
+                       [PublishedSource(series=self, pocket=pocket,
+                                        name=name, version=version)
+                        for pocket in pkgs
+                        for name, version in pkgs[pocket].items()])
+            self.published_sources_synced = timezone.now()
+            Series.objects.filter(pk=self.pk).update(
+                         published_sources_synced=self.published_sources_synced)
+
+    def published_sources(self):
+        # The index is only maintained by the reprepro hooks from the
+        # point they were installed, so it gets a full sync first.
+        if self.published_sources_synced is None:
+            self.reconcile_published_sources(unless_synced=True)
+        return PublishedSource.objects.filter(series=self)
 
+    def get_source_packages(self):
+        pkgs = dict((pocket, {}) for pocket in PublishedSource.POCKETS)
+        for pocket, name, version in self.published_sources().values_list(
+                                              'pocket', 'name', 'version'):
+            pkgs[pocket][name] = version
         return pkgs
 
+    def is_published(self, name, version):
+        """Whether version of source name is published (not just queued)"""
+        return self.published_sources().filter(name=name, version=version
+                           ).exclude(pocket=PublishedSource.QUEUED).exists()
+
+    def published_source_versions(self):
+        """Returns a set of (name, version) of the published sources
+
+        Sources that are only queued for a frozen series don't count."""
+        return set(self.published_sources().exclude(
+                       pocket=PublishedSource.QUEUED
+                                                   ).values_list('name',
+                                                                 'version'))
+
+    def prune_superseded_builds(self):
+        """Marks pending builds of sources no longer published superseded
+
+        Takes one snapshot of the series' packages, however many builds
+        are pending. Returns the number of builds marked."""
+        pending = BuildRecord.pending_builds().filter(series=self)
+        if not pending.exists():
+            return 0
+
+        # Builds created after the snapshot may be for sources it
+        # doesn't know about yet, so leave those alone.
+        snapshot_time = timezone.now()
+        published = self.published_source_versions()
+
+        superseded = [pk for pk, name, version in
+                      pending.filter(created__lt=snapshot_time).values_list(
+                             'id', 'source_package_name', 'version')
+                      if (name, version) not in published]
+
+        marked = 0
+        # Chunked to stay within the databases' limits on query parameters
+        for i in range(0, len(superseded), 500):
+            marked += pending.filter(id__in=superseded[i:i + 500]).update(
+                            state=BuildRecord.BUILD_FOR_SUPERSEDED_SOURCE)
+        if marked:
+            logger.info('Marked %d pending builds in %s superseded' %
+                        (marked, self))
+            BuildRecord.update_blocked(self.pk)
+        return marked
+
     def update(self):
         self.repository.write_configuration()
         if self.update_from:
@@ -336,6 +607,44 @@ class Series(models.Model):
         self.repository._reprepro('pull', self.name)
 
 
+class PublishedSource(models.Model):
+    """A source package published in a pocket of a series
+
+    Kept up to date by reprepro through the repo-record-published-source
+    hook, and rebuilt by repo-reconcile-published-sources."""
+    STABLE = 'stable'
+    PROPOSED = 'proposed'
+    QUEUED = 'queued'
+    POCKETS = (STABLE, PROPOSED, QUEUED)
+
+    series = models.ForeignKey(Series)
+    pocket = models.CharField(max_length=20,
+                              choices=[(p, p) for p in POCKETS])
+    name = models.CharField(max_length=200)
+    version = models.CharField(max_length=200)
+
+    class Meta:
+        unique_together = ('series', 'pocket', 'name')
+        index_together = [('series', 'name', 'version')]
+
+    def __unicode__(self):
+        return '%s_%s in %s (%s)' % (self.name, self.version,
+                                     self.series, self.pocket)
+
+    @classmethod
+    def record(cls, series, pocket, name, version):
+        with utils.commit_on_success_unless_managed():
+            if not cls.objects.filter(series=series, pocket=pocket,
+                                      name=name).update(version=version):
+                cls(series=series, pocket=pocket, name=name,
+                    version=version).save()
+
+    @classmethod
+    def forget(cls, series, pocket, name, version):
+        cls.objects.filter(series=series, pocket=pocket, name=name,
+                           version=version).delete()
+
+
 class Package(object):
     def __init__(self, name, version):
         self.name = name
@@ -463,6 +772,24 @@ class ChrootTarball(models.Model):
         self.last_refresh = timezone.now()
         self.state = self.READY
         self.save()
+        self.invalidate_build_nodes()
+
+    def invalidate_build_nodes(self):
+        """Gets rid of baked images and idle nodes with the old chroot"""
+        for image in self.buildnodeimage_set.all():
+            image.delete()
+
+        for bn in BuildNode.idle_nodes().filter(ubuntu_series=self.series,
+                                                architecture=self.architecture):
+            logger.info('Retiring build node %s, since its chroot is '
+                        'outdated' % (bn,))
+            bn.retire_if_idle()
+
+
+# The series update_blocked has been held back for in this thread, or
+# None when it isn't being held back. See
+# BuildRecord.defer_blocked_updates.
+_deferred_blocked = threading.local()
 
 
 class BuildRecord(models.Model):
@@ -474,6 +801,7 @@ class BuildRecord(models.Model):
     DEPENDENCY_WAIT = 6
     FAILED_TO_UPLOAD = 7
     NEEDS_BUILDING = 8
+    TIMED_OUT = 9
 
     BUILD_STATES = (
         (BUILDING, 'Building'),
@@ -484,6 +812,7 @@ class BuildRecord(models.Model):
         (DEPENDENCY_WAIT, 'Dependency wait'),
         (FAILED_TO_UPLOAD, 'Failed to upload'),
         (NEEDS_BUILDING, 'Needs building'),
+        (TIMED_OUT, 'Timed out'),
     )
 
     source_package_name = models.CharField(max_length=200)
@@ -497,22 +826,59 @@ class BuildRecord(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     finished = models.DateTimeField(db_index=True, null=True, blank=True)
 
+    # From sbuild's summary. Times are in seconds, space in kilobytes.
+    summary_status = models.CharField(max_length=20, blank=True)
+    fail_stage = models.CharField(max_length=50, blank=True)
+    build_time = models.IntegerField(null=True, blank=True)
+    install_time = models.IntegerField(null=True, blank=True)
+    package_time = models.IntegerField(null=True, blank=True)
+    build_space = models.IntegerField(null=True, blank=True)
+
+    # From the .dsc. binaries is a comma separated list of the binary
+    # packages the source builds.
+    build_depends = models.TextField(blank=True)
+    binaries = models.TextField(blank=True)
+    # Set while one of the Build-Depends is still to be built in the
+    # same series. Kept up to date by update_blocked.
+    blocked = models.BooleanField(default=False)
+
+    SUMMARY_FIELDS = {'Status': 'summary_status',
+                      'Fail-Stage': 'fail_stage'}
+    SUMMARY_INT_FIELDS = {'Build-Time': 'build_time',
+                          'Install-Time': 'install_time',
+                          'Package-Time': 'package_time',
+                          'Build-Space': 'build_space'}
+
     def get_tarball(self):
         return self.series.base_ubuntu_series.chroottarball_set.get(architecture=self.architecture)
 
     class Meta:
         unique_together = ('series', 'source_package_name',
                            'version', 'architecture')
+        index_together = [('state', 'build_node', 'priority')]
 
     def __unicode__(self):
         return ('Build of %s_%s_%s' %
                 (self.source_package_name, self.version, self.architecture))
 
+    def save(self, *args, **kwargs):
+        new = self.pk is None
+        super(BuildRecord, self).save(*args, **kwargs)
+        if new and (self.build_depends or self.binaries):
+            self.__class__.update_blocked(self.series_id)
+
     def update_state(self, new_state):
+        old_state = self.state
         self.__class__.objects.filter(pk=self.pk).update(state=new_state)
         # Also update this cached object
         self.state = new_state
 
+        # Builds coming or going may hold back others, or be held back
+        unfinished = (self.NEEDS_BUILDING, self.BUILDING)
+        if ((old_state in unfinished) != (new_state in unfinished) and
+                (self.build_depends or self.binaries)):
+            self.__class__.update_blocked(self.series_id)
+
     @classmethod
     def pending_builds(cls):
         return cls.objects.filter(state=cls.NEEDS_BUILDING,
@@ -522,96 +888,374 @@ class BuildRecord(models.Model):
     def pending_build_count(cls):
         return cls.pending_builds().count()
 
+    def build_depends_names(self):
+        """Returns the Build-Depends as a list of sets of package names
+
+        Each set holds the alternatives of one dependency. Alternatives
+        restricted to other architectures are left out."""
+        relations = PkgRelation.parse_relations(self.build_depends)
+        names = [set(alt['name'] for alt in rel
+                     if arch_qualifier_applies(alt['arch'],
+                                               self.architecture_id))
+                 for rel in relations]
+        return [alternatives for alternatives in names if alternatives]
+
+    def binary_names(self):
+        return set(b.strip() for b in self.binaries.split(',') if b.strip())
+
+    @classmethod
+    def blocked_build_ids(cls, builds):
+        """Returns the ids of pending builds that should wait for others
+
+        A build waits if one of its Build-Depends can only be satisfied
+        by a binary from a build in the same series and architecture that
+        is still pending or building. Builds caught in a dependency cycle
+        are let through, since waiting would never end."""
+        unfinished = cls.objects.filter(
+                          state__in=[cls.NEEDS_BUILDING, cls.BUILDING],
+                          series__in=builds.values('series'))
+
+        providers = {}
+        for br in unfinished.exclude(binaries=''):
+            for binary in br.binary_names():
+                key = (br.series_id, br.architecture_id, binary)
+                providers.setdefault(key, set()).add(br.id)
+
+        waits_for = {}
+        for br in builds.exclude(build_depends=''):
+            deps = set()
+            for alternatives in br.build_depends_names():
+                alt_providers = [providers.get((br.series_id,
+                                                br.architecture_id,
+                                                name), set()) - set([br.id])
+                                 for name in alternatives]
+                if all(alt_providers):
+                    for p in alt_providers:
+                        deps.update(p)
+            if deps:
+                waits_for[br.id] = deps
+
+        # Builds waiting for builds that don't wait for anything, directly
+        # or indirectly, are peeled off. What remains is in or behind a
+        # dependency cycle.
+        remaining = set(waits_for)
+        while True:
+            peel = set(b for b in remaining if not waits_for[b] & remaining)
+            if not peel:
+                break
+            remaining -= peel
+
+        def reachable(start):
+            seen = set()
+            todo = [start]
+            while todo:
+                for d in waits_for.get(todo.pop(), ()):
+                    if d not in seen:
+                        seen.add(d)
+                        todo.append(d)
+            return seen
+
+        # A build in a cycle only has to wait for builds outside it.
+        reach = dict((b, reachable(b)) for b in remaining)
+        unblocked = set(b for b in remaining
+                        if all(d in reach and b in reach[d]
+                               for d in waits_for[b]))
+        return set(waits_for) - unblocked
+
+    @classmethod
+    def update_blocked(cls, series_id):
+        """Works out afresh which of a series' pending builds are blocked
+
+        Called whenever a build that may hold back others, or be held
+        back itself, is queued or finishes, so that claiming a build can
+        leave out the blocked ones in SQL."""
+        deferred = getattr(_deferred_blocked, 'series_ids', None)
+        if deferred is not None:
+            deferred.add(series_id)
+            return
+
+        pending = cls.objects.filter(series=series_id,
+                                     state=cls.NEEDS_BUILDING)
+        blocked = cls.blocked_build_ids(pending)
+        unblocked = set(pending.filter(blocked=True).values_list('id',
+                                                                 flat=True))
+        unblocked -= blocked
+        # Chunked to stay within the databases' limits on query parameters
+        for ids, value in [(sorted(blocked), True),
+                           (sorted(unblocked), False)]:
+            for i in range(0, len(ids), 500):
+                pending.filter(id__in=ids[i:i + 500]).update(blocked=value)
+
+    @classmethod
+    def defer_blocked_updates(cls):
+        """Makes update_blocked only note the series, in this thread
+
+        Each series then gets worked out once by flush_blocked_updates,
+        however many builds were queued or finished in it, rather than
+        once per build."""
+        if getattr(_deferred_blocked, 'series_ids', None) is None:
+            _deferred_blocked.series_ids = set()
+
+    @classmethod
+    def flush_blocked_updates(cls, stop=False):
+        """Runs the update_blocked calls held back so far
+
+        If stop is True, update_blocked runs straight away again
+        afterwards."""
+        series_ids = getattr(_deferred_blocked, 'series_ids', None) or set()
+        _deferred_blocked.series_ids = None
+        try:
+            for series_id in sorted(series_ids):
+                cls.update_blocked(series_id)
+        finally:
+            if not stop:
+                _deferred_blocked.series_ids = set()
+
+    @classmethod
+    @contextmanager
+    def deferred_blocked_updates(cls):
+        """Defers update_blocked until the end of the block
+
+        Does nothing if it is already being deferred."""
+        if getattr(_deferred_blocked, 'series_ids', None) is not None:
+            yield
+            return
+
+        cls.defer_blocked_updates()
+        try:
+            yield
+        except:
+            _deferred_blocked.series_ids = None
+            raise
+        cls.flush_blocked_updates(stop=True)
+
+    @classmethod
+    def retry_dependency_waits(cls, series, architecture, binaries):
+        """Requeues builds waiting for any of binaries
+
+        Called when binaries built for architecture have been published
+        to series. If architecture is the one that builds architecture
+        independent packages, waiting builds of every architecture are
+        considered."""
+        binaries = set(binaries)
+        waiting = cls.objects.filter(series=series,
+                                     state=cls.DEPENDENCY_WAIT)
+        if not architecture.builds_arch_all:
+            waiting = waiting.filter(architecture=architecture)
+
+        requeued = []
+        for br in waiting.exclude(build_depends=''):
+            wanted = set()
+            for alternatives in br.build_depends_names():
+                wanted.update(alternatives)
+            if wanted & binaries:
+                logger.info('%s may be satisfied now. Requeueing %s.' %
+                            (', '.join(sorted(wanted & binaries)), br))
+                requeued.append(br.id)
+
+        if requeued:
+            cls.objects.filter(id__in=requeued).update(
+                                                 state=cls.NEEDS_BUILDING)
+            cls.update_blocked(series.pk)
+
     def superseded(self):
-        pkginfo = self.series.get_source_packages()
-        for pocket in pkginfo:
-            if pocket.endswith('-queued'):
-                continue
-            if self.source_package_name in pkginfo[pocket]:
-                version = pkginfo[pocket][self.source_package_name]
-                if self.version == version:
-                    return False
-        return True
+        return not self.series.is_published(self.source_package_name,
+                                            self.version)
+
+    @classmethod
+    def prune_superseded(cls):
+        """Weeds out pending builds of sources that have been replaced"""
+        for series in Series.objects.filter(
+                         id__in=cls.pending_builds().values('series')):
+            try:
+                series.prune_superseded_builds()
+            except Exception:
+                logger.warning('Failed to prune superseded builds in %s' %
+                               (series,), exc_info=True)
+
+    @classmethod
+    def dispatch_builds(cls, pickers=None):
+        """Fills every free build slot with a pending build
+
+        Returns a list of (build_node, build_record) tuples. The build
+        nodes are only reserved, not booted. It's up to the caller to
+        drive each of them through boot, prepare and build.
+
+        The queue is ranked once for the pass. If pickers, a dict, is
+        given, the pass' BuildPickers are left in it, so that build
+        nodes finishing their build can use them as well."""
+        if pickers is None:
+            pickers = {}
+        cls.prune_superseded()
+        claimed = cls._dispatch_to_idle_nodes(pickers)
+        for queue in BuildQueue.active_queues():
+            for cloud in queue.clouds():
+                claimed += cls._fill_build_slots(cloud, queue, pickers)
+        return claimed
+
+    @classmethod
+    def _dispatch_to_idle_nodes(cls, pickers):
+        claimed = []
+        for bn in BuildNode.idle_nodes():
+            if not cls.pending_builds().exists():
+                break
+            br = bn.next_build(pickers)
+            if br is not None:
+                logger.info('Handing %s to idle build node %s' % (br, bn))
+                claimed.append((bn, br))
+        return claimed
 
     @classmethod
-    def perform_single_build(cls):
-        if cls.pending_build_count() > 0:
-            bn = BuildNode.start_new()
-            br = BuildRecord.pick_build(bn)
-            bn.prepare(br)
-            bn.build(br)
+    def _fill_build_slots(cls, cloud, queue, pickers):
+        if not queue.pending_builds().exists():
+            return []
+
+        architecture = queue.architecture
+        # Anything involving the cloud's API is done up front, so that
+        # the locks below aren't held while waiting for the cloud.
+        # Making room for a node for another series retires an idle
+        # node, which shuts down its server.
+        free_slots = cloud.free_build_slots(architecture)
+        if free_slots == 0:
+            if (queue.free_capacity() == 0 or
+                    not cloud.reclaim_idle_build_slot(architecture)):
+                return []
+            free_slots = 1
+        names = BuildNode.get_unique_buildnode_names(cloud.client,
+                                                     free_slots)
+
+        claimed = []
+        with transaction.commit_on_success():
+            # Serialise slot accounting per queue and per cloud, so that
+            # dispatchers running side by side (for other clouds, too)
+            # don't overcommit either. Queues are always locked first.
+            if queue.pk is not None:
+                queue = BuildQueue.objects.select_for_update().get(
+                                                                pk=queue.pk)
+            cloud = Cloud.objects.select_for_update().get(pk=cloud.pk)
+            # Other dispatchers may have taken some of the names or
+            # slots in the meantime.
+            taken = set(BuildNode.objects.filter(name__in=names
+                                                ).values_list('name',
+                                                              flat=True))
+            names = [name for name in names if name not in taken]
+            free_slots = min(cloud.free_build_slots(architecture),
+                             len(names))
+            capacity = queue.free_capacity()
+            if capacity is not None:
+                free_slots = min(free_slots, capacity)
+            logger.debug('%d free build slots for %s on cloud %s' %
+                         (free_slots, queue, cloud))
+            picker = BuildPicker.for_chroot(pickers, architecture,
+                                            queue.ubuntu_series)
+            for name in names[:free_slots]:
+                bn = BuildNode.reserve(cloud, architecture,
+                                       queue.ubuntu_series, name)
+                br = picker.pick(bn)
+                if br is None:
+                    bn.delete()
+                    break
+                logger.info('Assigned %s to build node %s' % (br, bn))
+                claimed.append((bn, br))
+        return claimed
 
     def allow_rebuild(self):
         return (self.state in [BuildRecord.DEPENDENCY_WAIT,
-                               BuildRecord.FAILED_TO_BUILD]
+                               BuildRecord.FAILED_TO_BUILD,
+                               BuildRecord.TIMED_OUT]
                 and not self.superseded())
 
     def build_log_url(self):
-        return '%s/%s' % (settings.BASE_BUILD_LOG_URL, '%s.log.txt' % self.pk)
+        return reverse('build_log', kwargs={'build_id': self.pk})
 
     def logfile(self):
+        return os.path.join(settings.BUILD_LOG_DIR, '%s.log.gz' % self.pk)
+
+    def legacy_logfile(self):
+        """The uncompressed log written by older versions of repomgmt"""
         return os.path.join(settings.BUILD_LOG_DIR, '%s.log.txt' % self.pk)
 
+    def has_log(self):
+        return (os.path.exists(self.logfile()) or
+                os.path.exists(self.legacy_logfile()))
+
+    def _has_legacy_log_only(self):
+        # A build run again after upgrading has both. The compressed
+        # log is the one from the latest attempt.
+        return (not os.path.exists(self.logfile()) and
+                os.path.exists(self.legacy_logfile()))
+
+    def iter_log(self):
+        """Yields the (decompressed) build log in chunks"""
+        if self._has_legacy_log_only():
+            with open(self.legacy_logfile(), 'r') as fp:
+                for data in iter(lambda: fp.read(64 * 1024), ''):
+                    yield data
+        else:
+            for data in buildlog.BuildLogReader(self.logfile()):
+                yield data
+
     def log_tail(self, max_lines=20):
-        last_lines = []
         try:
-            with open(self.logfile(), 'r') as fp:
-                for l in fp:
-                    last_lines.append(l)
-
-                last_lines = last_lines[-max_lines:]
-
-            return ''.join(last_lines)
+            if self._has_legacy_log_only():
+                with open(self.legacy_logfile(), 'r') as fp:
+                    return ''.join(collections.deque(fp, max_lines))
+            return buildlog.BuildLogReader(self.logfile()).tail(max_lines)
         except:
             return ''
 
     def parse_summary(self):
-        lines = self.log_tail(40).split('\n')
-        if not lines:
-            return {'Status': 'Unknown'}
-
-        for i in range(len(lines) - 1, 0, -1):
-            if 'Summary' in lines[i]:
-                break
-
-        # The ith line is the summary heading.
-        # i+1 is the bottem of the heading box.
-        # i+2 is a blank line
-        summary = {}
-        for j in range(i + 3, len(lines)):
-            if not ':' in lines[j]:
-                break
+        parser = buildlog.SbuildSummaryParser()
+        parser.feed(self.log_tail(40))
+        return parser.close()
+
+    def record_summary(self, summary):
+        """Stores the fields of an sbuild summary on this build record"""
+        fields = {}
+        for k, attr in self.SUMMARY_FIELDS.items():
+            fields[attr] = summary.get(k, '')
+        for k, attr in self.SUMMARY_INT_FIELDS.items():
+            try:
+                fields[attr] = int(summary[k])
+            except (KeyError, ValueError):
+                # sbuild says "n/a" for stages it didn't get to
+                fields[attr] = None
 
-            k, v = lines[j].split(':', 1)
-            summary[k] = v.strip()
-        return summary
+        self.__class__.objects.filter(pk=self.pk).update(**fields)
+        # Also update this cached object
+        for attr, value in fields.items():
+            setattr(self, attr, value)
 
     def update_state_from_build_log(self):
         logger.debug('Setting build state if %r from build log' % (self,))
 
-        summary = self.parse_summary()
-        if summary['Status'] == 'successful':
+        if not self.summary_status:
+            # The summary wasn't picked up while the build ran, so
+            # fall back to looking for it in the log.
+            self.record_summary(self.parse_summary())
+
+        if self.summary_status == 'successful':
             logger.debug('Build summary says build %r completed succesfully. '
                          'Setting state accordingly.' % (self,))
             # Everything worked beautifully
             self.update_state(self.SUCCESFULLY_BUILT)
             return
-        elif summary['Status'] == 'attempted':
+        elif self.summary_status == 'attempted':
             # The infrastructure performed as expected. The build failed.
             # There's nothing more for us to do
             logger.debug('Build summary says build %r failed. '
                          'Setting state accordingly.' % (self,))
             self.update_state(self.FAILED_TO_BUILD)
             return
-        elif summary['Status'] == 'failed':
+        elif self.summary_status == 'failed':
             # Some dependencies could not be fulfilled.
-            if summary['Fail-Stage'] == 'install-deps':
+            if self.fail_stage == 'install-deps':
                 logger.debug('Build summary says installing deps failed for '
                              'build %r. Setting state accordingly.' % (self,))
                 self.update_state(self.DEPENDENCY_WAIT)
                 return
             # We failed to fetch the source pkg. Put it back in the queue
-            if summary['Fail-Stage'] == 'fetch-src':
+            if self.fail_stage == 'fetch-src':
                 logger.debug('Build summary says fetching source for build %r '
                              'failed. Setting state to NEEDS_BUILDING to '
                              'retry.' % (self,))
@@ -621,17 +1265,39 @@ class BuildRecord(models.Model):
                     self.update_state(self.NEEDS_BUILDING)
                 return
 
-        logger.debug("Setting a default of NEEDS_BUILDING for build summary:"
-                     "%r" % (summary,))
+        logger.debug("Setting a default of NEEDS_BUILDING for build status:"
+                     "%r, fail stage: %r" % (self.summary_status,
+                                             self.fail_stage))
         self.update_state(self.NEEDS_BUILDING)
 
     @classmethod
-    def pick_build(cls, build_node):
-        """Picks the highest priority build"""
+    def pick_build(cls, build_node, architecture=None, ubuntu_series=None,
+                   pickers=None):
+        """Picks the next build according to the BuildScheduler
+
+        Builds whose Build-Depends are still to be built in the same
+        series are held back until those are done. Passing the pickers
+        of a dispatch pass (see BuildPicker.for_chroot) saves ranking
+        the queue again for every build."""
+        if pickers is None:
+            picker = BuildPicker(architecture, ubuntu_series)
+        else:
+            picker = BuildPicker.for_chroot(pickers, architecture,
+                                            ubuntu_series)
+        return picker.pick(build_node)
+
+    @classmethod
+    def _claim_oldest(cls, build_node, builds):
+        """Assigns the oldest of builds to build_node
+
+        Returns None if there's nothing (left) to claim."""
+        builds = builds.order_by('created')
+        if connection.vendor == 'postgresql':
+            return cls._claim_build_skip_locked(build_node, builds)
+
         while True:
-            builds = cls.pending_builds()
             try:
-                next_build = builds.order_by('-priority')[0]
+                next_build = builds[0]
             except IndexError:
                 return None
             # This ensures that assigning a build node is atomic,x
@@ -647,6 +1313,312 @@ class BuildRecord(models.Model):
             else:
                 return cls.objects.get(id=next_build.id)
 
+    @classmethod
+    def _claim_build_skip_locked(cls, build_node, builds):
+        """Claims the first of builds in a single statement
+
+        Rows locked by concurrent claimers are skipped rather than waited
+        for, so claimers never block each other or have to retry. The
+        statement returns the claimed build, too, so it's the only round
+        trip to the database."""
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        # The ORM checks build_node__isnull against a LEFT JOINed build
+        # node. When a row it wanted was claimed in the meantime,
+        # PostgreSQL rechecks the conditions against the row's new
+        # version, but not against the joined table, so the claim
+        # would go through anyway. Check the column itself as well.
+        builds = builds.extra(where=['%s.build_node_id IS NULL' % (table,)])
+        select, params = builds.values('id')[:1].query.sql_with_params()
+
+        columns = ', '.join(qn(f.column) for f in cls._meta.fields)
+
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET build_node_id = %%s '
+                       'WHERE id = (%s FOR UPDATE OF %s SKIP LOCKED) '
+                       'RETURNING %s' % (table, select, table, columns),
+                       (build_node.pk,) + tuple(params))
+        row = cursor.fetchone()
+        transaction.commit_unless_managed()
+        if row is None:
+            return None
+        br = cls(*row)
+        br._state.adding = False
+        br._state.db = connection.alias
+        return br
+
+
+class BuildScheduler(object):
+    """Weighted fair-share scheduling of builds across repositories
+
+    Repositories take turns according to their share of the build
+    farm (settings.REPOSITORY_BUILD_SHARES, a dict mapping repository
+    names to weights, falling back to
+    settings.DEFAULT_REPOSITORY_BUILD_SHARE). The repository that has
+    used the least of its share recently (builds running or finished
+    within settings.FAIR_SHARE_WINDOW seconds) goes first, so a big
+    batch of uploads to one repository can't hold up everyone else.
+
+    Within a repository, builds are ordered by priority, aged by
+    settings.BUILD_PRIORITY_AGING priority points per minute waited,
+    so long-waiting builds gradually overtake newer ones. BuildPicker
+    does the ranking, going by the loads and effective priorities
+    worked out here."""
+    def __init__(self):
+        self.now = timezone.now()
+        self.shares = getattr(settings, 'REPOSITORY_BUILD_SHARES', {})
+        self.default_share = getattr(settings,
+                                     'DEFAULT_REPOSITORY_BUILD_SHARE', 1)
+        self.window = getattr(settings, 'FAIR_SHARE_WINDOW', 3600)
+        self.aging = getattr(settings, 'BUILD_PRIORITY_AGING', 1)
+
+        self.loads = {}
+
+    def share(self, repository_name):
+        return float(self.shares.get(repository_name, self.default_share))
+
+    def usage(self, repository_name):
+        since = self.now - timedelta(seconds=self.window)
+        return BuildRecord.objects.filter(
+                      models.Q(state=BuildRecord.BUILDING) |
+                      models.Q(finished__gte=since),
+                      series__repository=repository_name).count()
+
+    def load(self, repository_name):
+        if repository_name not in self.loads:
+            self.loads[repository_name] = (self.usage(repository_name) /
+                                           self.share(repository_name))
+        return self.loads[repository_name]
+
+    def charge(self, repository_name):
+        """Accounts for a build just handed out from repository_name"""
+        self.loads[repository_name] = (self.load(repository_name) +
+                                       1 / self.share(repository_name))
+
+    def effective_priority(self, priority, created):
+        waited = (self.now - created).total_seconds() / 60
+        return priority + self.aging * waited
+
+    def candidate_rows(self, builds):
+        """Sums up the pending builds in builds for ranking
+
+        Since aging preserves the order of builds with the same
+        priority within a repository, only the oldest one of each of
+        those matters. Returns a row for each repository and priority,
+        with the creation time of the oldest build and the number of
+        builds."""
+        return builds.values('series__repository', 'priority'
+                             ).annotate(oldest=models.Min('created'),
+                                        count=models.Count('id'))
+
+
+class BuildPicker(object):
+    """Hands out pending builds to build nodes, one dispatch pass' worth
+
+    Ranking the queue looks at all of it, so it's done once per pass
+    rather than for every build node filled. The ranking is kept until
+    the builds it lists run out, and builds handed out are charged to
+    their repository as we go, so the pass still shares the build nodes
+    fairly. Builds held back by their Build-Depends are left out in SQL,
+    going by BuildRecord.blocked.
+
+    One picker may be shared by several threads. See for_chroot for
+    sharing the pickers of a pass."""
+    def __init__(self, architecture=None, ubuntu_series=None):
+        builds = BuildRecord.pending_builds().filter(blocked=False)
+        if architecture is not None:
+            builds = builds.filter(architecture=architecture)
+        if ubuntu_series is not None:
+            builds = builds.filter(series__base_ubuntu_series=ubuntu_series)
+        self.builds = builds
+        self.scheduler = BuildScheduler()
+        # Maps repository names to their candidate_rows, best first
+        self.rankings = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_chroot(cls, pickers, architecture=None, ubuntu_series=None):
+        """Returns the picker for the given chroot from pickers
+
+        pickers is a dict holding the pickers of a dispatch pass. One
+        is added for the chroot if it doesn't have one yet."""
+        key = (architecture and architecture.pk,
+               ubuntu_series and ubuntu_series.pk)
+        if key not in pickers:
+            pickers.setdefault(key, cls(architecture, ubuntu_series))
+        return pickers[key]
+
+    def rank(self):
+        """Ranks the builds of each repository, best first
+
+        Within a repository, the ranking doesn't change as builds are
+        handed out. Only which repository's turn it is does."""
+        rankings = {}
+        for row in self.scheduler.candidate_rows(self.builds):
+            rankings.setdefault(row['series__repository'], []).append(row)
+        for rows in rankings.values():
+            rows.sort(key=self._effective_priority, reverse=True)
+        with self.lock:
+            self.rankings = rankings
+
+    def _effective_priority(self, row):
+        return self.scheduler.effective_priority(row['priority'],
+                                                 row['oldest'])
+
+    def pick(self, build_node):
+        """Claims the best ranked build for build_node
+
+        Returns None if there's nothing to claim, or if everything left
+        is being claimed by someone else. In the latter case we don't
+        wait for them, but give up after one pass over a fresh ranking."""
+        fresh = not self.rankings
+        if fresh:
+            self.rank()
+        while True:
+            br = self._pick_ranked(build_node)
+            if br is not None or fresh:
+                return br
+            # Builds may have been queued since the ranking was made
+            self.rank()
+            fresh = True
+
+    def _best_row(self):
+        """The best ranked row of the repository whose turn it is"""
+        candidates = [(self.scheduler.load(repository),
+                       -self._effective_priority(rows[0]), repository)
+                      for repository, rows in self.rankings.items()]
+        if not candidates:
+            return None
+        return self.rankings[min(candidates)[2]][0]
+
+    def _pick_ranked(self, build_node):
+        while True:
+            with self.lock:
+                row = self._best_row()
+            if row is None:
+                return None
+            repository = row['series__repository']
+            builds = self.builds.filter(series__repository=repository,
+                                        priority=row['priority'])
+            br = BuildRecord._claim_oldest(build_node, builds)
+            with self.lock:
+                if br is not None:
+                    self.scheduler.charge(repository)
+                    row['count'] -= 1
+                if br is None or row['count'] <= 0:
+                    # Nothing (more) there, or not for the taking right now
+                    self._drop(row)
+            if br is not None:
+                return br
+
+    def _drop(self, row):
+        repository = row['series__repository']
+        rows = self.rankings.get(repository, [])
+        if row in rows:
+            rows.remove(row)
+        if not rows:
+            self.rankings.pop(repository, None)
+
+
+class BuildQueue(models.Model):
+    """Pending builds for one architecture and Ubuntu series
+
+    Each queue caps the number of build nodes working on it, so a
+    backlog in one queue can't take every build slot from the others.
+    It can also be tied to a particular cloud and flavor, so that nodes
+    are sized for their chroot. Queues without a BuildQueue record use
+    any cloud, the cloud's default flavor, and no cap beyond the
+    clouds' build slots."""
+    architecture = models.ForeignKey(Architecture)
+    ubuntu_series = models.ForeignKey(UbuntuSeries)
+    cloud = models.ForeignKey('Cloud', null=True, blank=True,
+                              help_text='Leave empty to use any cloud')
+    flavor_name = models.CharField(max_length=200, blank=True,
+                                   help_text="Leave empty to use the "
+                                             "cloud's default flavor")
+    capacity = models.IntegerField(null=True, blank=True,
+                                   help_text='Maximum number of build nodes '
+                                             'for this queue. Leave empty '
+                                             'for no limit.')
+
+    class Meta:
+        unique_together = ('architecture', 'ubuntu_series')
+
+    def __unicode__(self):
+        return '%s-%s' % (self.ubuntu_series, self.architecture)
+
+    @classmethod
+    def for_chroot(cls, ubuntu_series, architecture):
+        """Returns the queue for the given chroot
+
+        If none is configured, an unsaved queue with the defaults is
+        returned."""
+        try:
+            return cls.objects.get(ubuntu_series=ubuntu_series,
+                                   architecture=architecture)
+        except cls.DoesNotExist:
+            return cls(ubuntu_series=ubuntu_series, architecture=architecture)
+
+    @classmethod
+    def active_queues(cls):
+        """Returns the queues holding pending builds, oldest first"""
+        chroots = BuildRecord.pending_builds().values_list(
+                            'series__base_ubuntu_series', 'architecture'
+                                                          ).distinct()
+        queues = [cls.for_chroot(UbuntuSeries.objects.get(pk=series_id),
+                                 Architecture.objects.get(pk=arch_id))
+                  for series_id, arch_id in chroots]
+        return sorted(queues, key=lambda q: q.oldest_pending())
+
+    @classmethod
+    def all_queues(cls):
+        """Returns configured queues as well as ones with pending builds"""
+        queues = dict(((q.ubuntu_series_id, q.architecture_id), q)
+                      for q in cls.active_queues())
+        for q in cls.objects.all():
+            queues.setdefault((q.ubuntu_series_id, q.architecture_id), q)
+        return sorted(queues.values(), key=lambda q: unicode(q))
+
+    def pending_builds(self):
+        return BuildRecord.pending_builds().filter(
+                             architecture=self.architecture,
+                             series__base_ubuntu_series=self.ubuntu_series)
+
+    def depth(self):
+        return self.pending_builds().count()
+
+    def oldest_pending(self):
+        return self.pending_builds().aggregate(
+                                   oldest=models.Min('created'))['oldest']
+
+    def oldest_wait(self):
+        """How long the oldest pending build has been waiting"""
+        oldest = self.oldest_pending()
+        if oldest is None:
+            return None
+        return timezone.now() - oldest
+
+    def build_nodes(self):
+        return BuildNode.objects.filter(architecture=self.architecture,
+                                        ubuntu_series=self.ubuntu_series
+                                       ).exclude(state__in=[
+                                                     BuildNode.SHUTTING_DOWN,
+                                                     BuildNode.BAKING])
+
+    def free_capacity(self):
+        """Number of build nodes this queue may add, None if unlimited"""
+        if self.capacity is None:
+            return None
+        return max(self.capacity - self.build_nodes().count(), 0)
+
+    def clouds(self):
+        if self.cloud_id is not None:
+            return [self.cloud]
+        return list(Cloud.objects.all())
+
+    def flavor_name_for(self, cloud):
+        return self.flavor_name or cloud.flavor_name
+
 
 class Cloud(models.Model):
     name = models.CharField(max_length=200, primary_key=True)
@@ -679,6 +1651,34 @@ class Cloud(models.Model):
 
         return self._client
 
+    def build_slots(self, architecture):
+        """Number of concurrent builds for architecture on this cloud
+
+        Configured through settings.BUILD_SLOTS, a dict mapping cloud
+        names to dicts mapping architecture names to slot counts. Falls
+        back to settings.DEFAULT_BUILD_SLOTS."""
+        default = getattr(settings, 'DEFAULT_BUILD_SLOTS', 1)
+        slots = getattr(settings, 'BUILD_SLOTS', {}).get(self.name, {})
+        return slots.get(architecture.name, default)
+
+    def free_build_slots(self, architecture):
+        # Nodes baking an image don't take builds, and are gone again
+        # soon
+        nodes = self.buildnode_set.filter(architecture=architecture)
+        used = nodes.exclude(state=BuildNode.BAKING).count()
+        return max(self.build_slots(architecture) - used, 0)
+
+    def reclaim_idle_build_slot(self, architecture):
+        """Shuts down an idle build node to make room for a new one
+
+        Idle nodes are only ever left idle if no pending build matches
+        their Ubuntu series, so a node for another series is needed."""
+        for bn in BuildNode.idle_nodes().filter(cloud=self,
+                                                architecture=architecture):
+            if bn.retire_if_idle():
+                return True
+        return False
+
 
 class KeyPair(models.Model):
     cloud = models.ForeignKey(Cloud)
@@ -694,6 +1694,181 @@ class KeyPair(models.Model):
         unique_together = ('cloud', 'name')
 
 
+class SSHConnection(object):
+    """A long-lived, authenticated SSH connection to a build node
+
+    Commands get their own channel on the shared transport. If the
+    transport has gone away, a new connection is made."""
+    def __init__(self, ip, pkey):
+        self.ip = ip
+        self.pkey = pkey
+        self.client = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self._close()
+        logger.debug('Opening SSH connection to %s' % (self.ip,))
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self.ip, username='ubuntu', pkey=self.pkey)
+        self.client = client
+
+    def _close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def transport(self):
+        with self.lock:
+            transport = self.client and self.client.get_transport()
+            if transport is None or not transport.is_active():
+                self._connect()
+                transport = self.client.get_transport()
+            return transport
+
+    def open_session(self):
+        try:
+            return self.transport().open_session()
+        except (paramiko.SSHException, socket.error):
+            logger.debug('SSH connection to %s went stale. Reconnecting.' %
+                         (self.ip,))
+            with self.lock:
+                self._connect()
+            return self.transport().open_session()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+# SSHConnections to build nodes, keyed by build node name and cloud server
+# id. Names get reused, but a new server means a new connection.
+_ssh_connections = {}
+_ssh_connections_lock = threading.Lock()
+
+
+class BuildRun(object):
+    """One build of build_record on build_node
+
+    Running sbuild takes up nearly all of a build's time, so that part
+    is left to a CommandMultiplexer: start() returns as soon as sbuild
+    has been started, and its output is written to the build log and
+    scanned for sbuild's summary as it arrives. prepare() and finish(),
+    which come before and after it, block."""
+    def __init__(self, build_node, build_record):
+        self.build_node = build_node
+        self.build_record = build_record
+        self.command = None
+        self.log = None
+        self.parser = buildlog.SbuildSummaryParser()
+
+    def __repr__(self):
+        return '<BuildRun %s on %s>' % (self.build_record, self.build_node)
+
+    @property
+    def done(self):
+        return self.command is None or self.command.done
+
+    def prepare(self):
+        """Points the build node at the build
+
+        Returns False if that failed, in which case there's nothing to
+        do but finish()."""
+        bn, br = self.build_node, self.build_record
+        bn.update_state(BuildNode.BUILDING)
+        br.update_state(BuildRecord.BUILDING)
+        # Forget the summary of any previous attempt
+        br.record_summary({})
+        try:
+            bn.assign(br)
+            bn._run_cmd('rm -rf build; mkdir build')
+            return True
+        except Exception:
+            logger.info('Preparing %s for %s failed' % (bn, br),
+                        exc_info=True)
+            return False
+
+    def sbuild_cmd(self):
+        br = self.build_record
+        sbuild_cmd = ('cd build; sbuild -d %s ' % (br.series.name,) +
+                      '--arch=%s ' % br.architecture.name +
+                      '-c buildchroot ' +
+                      '-n -k%s ' % self.build_node.signing_key_id)
+
+        if br.architecture.builds_arch_all:
+            sbuild_cmd += '-A '
+
+        sbuild_cmd += '%s_%s' % (br.source_package_name, br.version)
+        return sbuild_cmd
+
+    def output(self, data):
+        self.log.write(data)
+        self.parser.feed(data)
+
+    def start(self, multiplexer):
+        """Starts sbuild, to be driven by multiplexer"""
+        try:
+            if not os.path.exists(settings.BUILD_LOG_DIR):
+                os.makedirs(settings.BUILD_LOG_DIR)
+            self.log = buildlog.BuildLogWriter(self.build_record.logfile())
+            self.command = self.build_node.start_cmd(
+                                  self.sbuild_cmd(),
+                                  output_callback=self.output,
+                                  idle_callback=self.log.flush_if_stale,
+                                  timeout=getattr(settings, 'BUILD_TIMEOUT',
+                                                  None),
+                                  multiplexer=multiplexer)
+        except Exception:
+            logger.info('Starting %s on %s failed' %
+                        (self.build_record, self.build_node), exc_info=True)
+
+    def timed_out(self):
+        return isinstance(getattr(self.command, 'error', None),
+                          RemoteCommandTimedOut)
+
+    def finish(self):
+        """Uploads the result and updates the build and build node
+
+        A build that timed out is given up on for good. Its log doesn't
+        say how it went, so it would otherwise be retried forever."""
+        bn, br = self.build_node, self.build_record
+        if self.command is not None:
+            self.command.chan.close()
+        if self.log is not None:
+            self.log.close()
+            br.record_summary(self.parser.close())
+
+        if self.timed_out():
+            logger.info('%s timed out on %s. Giving up on it.' % (br, bn))
+            br.update_state(BuildRecord.TIMED_OUT)
+        else:
+            if self.command is not None and self.command.exit_status == 0:
+                try:
+                    bn._run_cmd('cd build; dput return *.changes')
+                except Exception:
+                    logger.info('Uploading %s from %s failed' % (br, bn),
+                                exc_info=True)
+            br.update_state_from_build_log()
+        # Not br.save(): that would write back the blocked flag as it
+        # was when the build was claimed
+        br.finished = timezone.now()
+        BuildRecord.objects.filter(pk=br.pk).update(finished=br.finished)
+
+        if br.state != BuildRecord.SUCCESFULLY_BUILT:
+            # If the build succeeded, the build record keeps referencing
+            # the node until the upload has been processed, so that the
+            # repository keeps accepting uploads signed by it.
+            BuildRecord.objects.filter(pk=br.pk).update(build_node=None)
+
+        if br.state in (BuildRecord.SUCCESFULLY_BUILT,
+                        BuildRecord.FAILED_TO_BUILD,
+                        BuildRecord.DEPENDENCY_WAIT):
+            bn.release()
+        else:
+            # We can't tell if the node itself is to blame.
+            bn.retire()
+
+
 class BuildNode(models.Model):
     NEW = 0
     BOOTING = 1
@@ -701,6 +1876,7 @@ class BuildNode(models.Model):
     READY = 3
     BUILDING = 4
     SHUTTING_DOWN = 5
+    BAKING = 6
 
     NODE_STATES = (
         (NEW, 'Newly created'),
@@ -709,6 +1885,7 @@ class BuildNode(models.Model):
         (READY, 'Ready to build'),
         (BUILDING, 'Building'),
         (SHUTTING_DOWN, 'Shutting down'),
+        (BAKING, 'Baking an image (not taking builds)'),
     )
 
     name = models.CharField(max_length=200, primary_key=True)
@@ -717,128 +1894,293 @@ class BuildNode(models.Model):
     state = models.SmallIntegerField(default=NEW,
                                      choices=NODE_STATES)
     signing_key_id = models.CharField(max_length=200)
+    architecture = models.ForeignKey(Architecture, null=True, blank=True)
+    ubuntu_series = models.ForeignKey(UbuntuSeries, null=True, blank=True)
+    builds_completed = models.IntegerField(default=0)
+    last_used = models.DateTimeField(null=True, blank=True)
+    image = models.ForeignKey('BuildNodeImage', null=True, blank=True,
+                              on_delete=models.SET_NULL)
 
     def __unicode__(self):
         return self.name
 
-    def _run_cmd(self, cmd, *args, **kwargs):
-        def log(s):
-            logger.info('%-15s: %s' % (self.name, s))
-
-        def log_whole_lines(lbuf):
-            while '\n' in lbuf:
-                line, lbuf = lbuf.split('\n', 1)
-                log(line)
-            return lbuf
+    def iter_lines(self, cmd, *args, **kwargs):
+        """Runs cmd on this node, yielding its output one line at a time
 
-        output_callback = kwargs.pop('output_callback', lambda _: None)
+        Each line is logged as well. Nothing but the current partial line
+        is held in memory, so this is safe for arbitrarily large output."""
+        output_callback = kwargs.pop('output_callback', None)
 
-        out = ''
-        lbuf = ''
+        partial = []
         for data in self.run_cmd(cmd, *args, **kwargs):
-            output_callback(data)
-            out += data
-            lbuf += data
-            lbuf = log_whole_lines(lbuf)
+            if output_callback is not None:
+                output_callback(data)
+            lines = data.split('\n')
+            if len(lines) == 1:
+                partial.append(data)
+                continue
+            partial.append(lines[0])
+            lines[0] = ''.join(partial)
+            for line in lines[:-1]:
+                logger.info('%-15s: %s' % (self.name, line))
+                yield line
+            partial = [lines[-1]]
+
+        line = ''.join(partial)
+        if line:
+            logger.info('%-15s: %s' % (self.name, line))
+            yield line
 
-        lbuf = log_whole_lines(lbuf)
-        log(lbuf)
-        return out
+    def _run_cmd(self, cmd, *args, **kwargs):
+        """Runs cmd on this node, logging its output
+
+        If tail is given, the last tail lines of output are returned."""
+        tail = kwargs.pop('tail', None)
+
+        buf = collections.deque(maxlen=tail)
+        for line in self.iter_lines(cmd, *args, **kwargs):
+            if tail:
+                buf.append(line)
+
+        if tail:
+            return list(buf)
 
     def update_state(self, new_state):
         self.__class__.objects.filter(pk=self.pk).update(state=new_state)
         # Also update this cached object
         self.state = new_state
 
-    def prepare(self, build_record):
+    @property
+    def tarball(self):
+        return ChrootTarball.objects.get(series=self.ubuntu_series,
+                                         architecture=self.architecture)
+
+    def prepare(self):
+        """Installs the build infrastructure for this node's chroot
+
+        Returns True if the node is ready to take builds. Otherwise the
+        node is deleted."""
         self.state = self.BOOTING
         self.save()
         try:
-            while True:
-                try:
-                    self._run_cmd('id')
-                    break
-                except Exception, e:
-                    print e
-                time.sleep(5)
+            self.wait_until_reachable()
             self.state = self.PREPARING
             self.save()
-            self._run_cmd('sudo apt-get update')
-            self._run_cmd('sudo DEBIAN_FRONTEND=noninteractive '
-                          'apt-get -y --force-yes install puppet')
-            self._run_cmd('sudo wget -O puppet.pp %s/puppet/%s/' %
-                          (settings.BASE_URL, build_record.id))
-            self._run_cmd('sudo -H puppet apply --verbose puppet.pp')
-            self._run_cmd(textwrap.dedent(
-                """\n
-                cat <<EOF > keygen.param
-                Key-Type: 1
-                Key-Length: 2048
-                Subkey-Type: ELG-E
-                Subkey-Length: 2048
-                Name-Real: %s signing key
-                Expire-Date: 0
-                %%commit
-                EOF""" % (self,)
-                ))
-            out = self._run_cmd('gpg --gen-key --batch keygen.param')
-            for l in out.split('\n'):
-                if l.startswith('gpg: key '):
-                    key_id = l.split(' ')[2]
-            self.signing_key_id = key_id
-
-            public_key_data = self._run_cmd('gpg -a --export %s' %
-                                            (self.signing_key_id))
-            utils.run_cmd(['gpg', '--import'], input=public_key_data)
+            if self.image is None:
+                self.install_build_infrastructure()
+            else:
+                logger.info('Build node %s was booted from %s. Skipping '
+                            'installation of build infrastructure.' %
+                            (self, self.image))
+            self.create_signing_key()
 
-            self.state = self.READY
+            self.last_used = timezone.now()
             self.save()
-            build_record.series.repository.write_configuration()
-        except Exception, e:
+            return True
+        except Exception:
             logger.info('Preparing build node %s failed' % (self.name),
                         exc_info=True)
             self.delete()
+            return False
 
-    def build(self, build_record):
-        self.update_state(BuildNode.BUILDING)
-        build_record.update_state(BuildRecord.BUILDING)
-        try:
-            series = build_record.series
-            self._run_cmd('mkdir build')
-            sbuild_cmd = ('cd build; sbuild -d %s ' % (series.name,) +
-                          '--arch=%s ' % build_record.architecture.name +
-                          '-c buildchroot ' +
-                          '-n -k%s ' % self.signing_key_id)
+    def wait_until_reachable(self):
+        while True:
+            try:
+                self._run_cmd('id')
+                break
+            except Exception:
+                logger.debug('Build node %s not reachable yet' % (self,),
+                             exc_info=True)
+            time.sleep(5)
+
+    def install_build_infrastructure(self):
+        self._run_cmd('sudo apt-get update')
+        self._run_cmd('sudo DEBIAN_FRONTEND=noninteractive '
+                      'apt-get -y --force-yes install puppet')
+        self._run_cmd('sudo wget -O puppet.pp %s/puppet/tarball/%s/' %
+                      (settings.BASE_URL, self.tarball.id))
+        self._run_cmd('sudo -H puppet apply --verbose puppet.pp')
+
+    def create_signing_key(self):
+        self._run_cmd(textwrap.dedent(
+            """\n
+            cat <<EOF > keygen.param
+            Key-Type: 1
+            Key-Length: 2048
+            Subkey-Type: ELG-E
+            Subkey-Length: 2048
+            Name-Real: %s signing key
+            Expire-Date: 0
+            %%commit
+            EOF""" % (self,)
+            ))
+        for l in self.iter_lines('gpg --gen-key --batch keygen.param'):
+            if l.startswith('gpg: key '):
+                key_id = l.split(' ')[2]
+        self.signing_key_id = key_id
 
-            if build_record.architecture.builds_arch_all:
-                sbuild_cmd += '-A '
+        public_key_data = ''.join(self.run_cmd('gpg -a --export %s' %
+                                               (self.signing_key_id)))
+        utils.run_cmd(['gpg', '--import'], input=public_key_data)
 
-            sbuild_cmd += ('%s_%s' % (build_record.source_package_name,
-                                      build_record.version))
+    def assign(self, build_record):
+        """Performs the per-build preparation for build_record
 
-            if not os.path.exists(settings.BUILD_LOG_DIR):
-                os.makedirs(settings.BUILD_LOG_DIR)
+        This points the chroot at the build's repository and series and
+        makes sure the repository accepts uploads signed by this node."""
+        self._run_cmd('sudo wget -O build.pp %s/puppet/%s/' %
+                      (settings.BASE_URL, build_record.id))
+        self._run_cmd('sudo -H puppet apply --verbose build.pp')
+        build_record.series.repository.write_configuration()
 
-            with open(build_record.logfile(), 'a') as fp:
-                def write_and_flush(s):
-                    fp.write(s)
-                    fp.flush()
+    def build(self, build_record):
+        """Runs build_record on this node from start to finish"""
+        multiplexer = remote.default_multiplexer()
+        run = BuildRun(self, build_record)
+        if run.prepare():
+            run.start(multiplexer)
+            if run.command is not None:
+                multiplexer.run_all([run.command])
+        run.finish()
+
+    def release(self):
+        """Returns this node to the pool after a build
+
+        Nodes that have reached settings.BUILD_NODE_MAX_BUILDS are
+        retired instead."""
+        self.builds_completed += 1
+        self.last_used = timezone.now()
+        self.__class__.objects.filter(pk=self.pk).update(
+                              builds_completed=self.builds_completed,
+                              last_used=self.last_used)
+
+        max_builds = getattr(settings, 'BUILD_NODE_MAX_BUILDS', 20)
+        if self.builds_completed >= max_builds:
+            logger.info('Build node %s has completed %d builds. Retiring it.'
+                        % (self, self.builds_completed))
+            self.retire()
+        else:
+            self.update_state(self.READY)
 
-                self._run_cmd(sbuild_cmd, output_callback=write_and_flush)
+    def retire(self):
+        """Takes this node out of the pool for good
 
-            self._run_cmd('cd build; dput return *.changes')
-        except Exception:
-            pass
+        The node is deleted as soon as no uploads signed by it are
+        pending."""
+        self.update_state(self.SHUTTING_DOWN)
+        if not self.buildrecord_set.exists():
+            self.delete()
 
-        build_record.update_state_from_build_log()
-        build_record.finished = timezone.now()
-        build_record.save()
+    def retire_if_idle(self):
+        matches = self.__class__.objects.filter(pk=self.pk, state=self.READY
+                                               ).update(state=self.SHUTTING_DOWN)
+        if matches != 1:
+            return False
+        self.retire()
+        return True
 
-        if build_record.state != build_record.SUCCESFULLY_BUILT:
-            # If the build succeeded, defer deleting the build node record
-            # until the upload has been processed.
+    def upload_processed(self, build_record):
+        BuildRecord.objects.filter(pk=build_record.pk).update(build_node=None)
+        if (self.__class__.objects.filter(pk=self.pk,
+                                          state=self.SHUTTING_DOWN).exists()
+                and not self.buildrecord_set.exists()):
             self.delete()
 
+    def claim(self):
+        """Atomically takes this node out of the idle pool"""
+        matches = self.__class__.objects.filter(pk=self.pk, state=self.READY
+                                               ).update(state=self.BUILDING)
+        if matches == 1:
+            self.state = self.BUILDING
+            return True
+        return False
+
+    def next_build(self, pickers=None):
+        """Claims the next pending build matching this node's chroot
+
+        Returns None if this node is busy or there's nothing to build.
+        In the latter case, the node is left idle in the pool unless the
+        pool is already full. pickers is passed on to
+        BuildRecord.pick_build."""
+        if not self.claim():
+            return None
+
+        br = BuildRecord.pick_build(self, architecture=self.architecture,
+                                    ubuntu_series=self.ubuntu_series,
+                                    pickers=pickers)
+        if br is not None:
+            return br
+
+        pool_max = getattr(settings, 'BUILD_NODE_POOL_MAX', 2)
+        idle = self.idle_nodes().filter(cloud=self.cloud,
+                                        architecture=self.architecture,
+                                        ubuntu_series=self.ubuntu_series)
+        if idle.count() >= pool_max:
+            logger.info('Build node pool for %s is full. Retiring %s.' %
+                        (self.tarball, self))
+            self.retire()
+        else:
+            self.update_state(self.READY)
+        return None
+
+    @classmethod
+    def idle_nodes(cls):
+        return cls.objects.filter(state=cls.READY)
+
+    @classmethod
+    def maintain_pool(cls):
+        """Evicts idle and retired build nodes and tops up the pool
+
+        Returns a list of newly reserved build nodes that need to be
+        booted and prepared to bring the pool up to
+        settings.BUILD_NODE_POOL_MIN."""
+        for bn in cls.objects.filter(state=cls.SHUTTING_DOWN,
+                                     buildrecord__isnull=True):
+            logger.info('Deleting retired build node %s' % (bn,))
+            bn.delete()
+
+        pool_min = getattr(settings, 'BUILD_NODE_POOL_MIN', 0)
+        idle_timeout = getattr(settings, 'BUILD_NODE_IDLE_TIMEOUT', 600)
+        cutoff = timezone.now() - timedelta(seconds=idle_timeout)
+
+        kept = {}
+        for bn in cls.idle_nodes().order_by('-last_used'):
+            key = (bn.cloud_id, bn.ubuntu_series_id, bn.architecture_id)
+            kept[key] = kept.get(key, 0) + 1
+            if kept[key] <= pool_min:
+                continue
+            if bn.last_used is None or bn.last_used < cutoff:
+                logger.info('Build node %s has been idle since %s. Evicting.'
+                            % (bn, bn.last_used))
+                bn.retire_if_idle()
+
+        reserved = []
+        if pool_min < 1:
+            return reserved
+
+        warm_states = (cls.NEW, cls.BOOTING, cls.PREPARING, cls.READY)
+        for cloud in Cloud.objects.all():
+            for tarball in ChrootTarball.objects.filter(state=ChrootTarball.READY):
+                warm = cls.objects.filter(cloud=cloud,
+                                          architecture=tarball.architecture,
+                                          ubuntu_series=tarball.series,
+                                          state__in=warm_states).count()
+                queue = BuildQueue.for_chroot(tarball.series,
+                                              tarball.architecture)
+                if queue.cloud_id not in (None, cloud.pk):
+                    continue
+                missing = min(pool_min - warm,
+                              cloud.free_build_slots(tarball.architecture))
+                if queue.free_capacity() is not None:
+                    missing = min(missing, queue.free_capacity())
+                for _ in range(missing):
+                    bn = cls.reserve(cloud, tarball.architecture,
+                                     tarball.series)
+                    logger.info('Reserved build node %s to warm up the %s '
+                                'pool' % (bn, tarball))
+                    reserved.append(bn)
+        return reserved
+
     @classmethod
     def get_unique_keypair_name(cls, cl):
         existing_keypair_names = [kp.name for kp in cl.keypairs.list()]
@@ -849,25 +2191,94 @@ class BuildNode(models.Model):
 
     @classmethod
     def get_unique_buildnode_name(cls, cl):
+        return cls.get_unique_buildnode_names(cl, 1)[0]
+
+    @classmethod
+    def get_unique_buildnode_names(cls, cl, count):
+        """Returns count distinct names not used by servers or build nodes
+
+        Asks the cloud for its servers just once, however many names
+        are wanted."""
         existing_server_names = [srv.name for srv in cl.servers.list()]
         old_build_node_names = [bn.name for bn in BuildNode.objects.all()]
         names_to_avoid = set(existing_server_names + old_build_node_names)
-        while True:
+        names = []
+        while len(names) < count:
             name = 'buildd-%d' % random.randint(1, 1000)
             if name not in names_to_avoid:
-                return name
+                names_to_avoid.add(name)
+                names.append(name)
+        return names
+
+    @classmethod
+    def reserve(cls, cloud, architecture=None, ubuntu_series=None,
+                name=None):
+        """Creates the record for a build node without booting it
+
+        The node occupies a build slot on the cloud from this point on.
+        Unless a name is given, one is made up, which means asking the
+        cloud for its servers."""
+        if name is None:
+            name = cls.get_unique_buildnode_name(cloud.client)
+        bn = BuildNode(name=name, cloud=cloud, architecture=architecture,
+                       ubuntu_series=ubuntu_series)
+        bn.save()
+        return bn
 
     @classmethod
-    def start_new(cls):
-        cloud = random.choice(Cloud.objects.all())
-        logger.info('Picked cloud %s' % cloud)
+    def start_new(cls, cloud=None, architecture=None):
+        if cloud is None:
+            cloud = random.choice(Cloud.objects.all())
+            logger.info('Picked cloud %s' % cloud)
+        bn = cls.reserve(cloud, architecture)
+        bn.boot()
+        return bn
+
+    def run_build(self, build_record=None):
+        """Drives this node through its lifecycle
+
+        Boots and prepares the node if that hasn't happened yet. Then
+        builds build_record followed by any matching pending builds
+        until the node runs out of work or is retired."""
+        build_record = self.make_ready(build_record)
+        while build_record is not None:
+            self.build(build_record)
+            build_record = self.next_build()
+
+    def make_ready(self, build_record=None):
+        """Boots and prepares this node if that hasn't happened yet
+
+        Returns the build to run first: build_record or, if there's
+        none, the next pending build. Returns None if the node failed
+        to come up, or there's nothing to build."""
+        if self.state == self.NEW:
+            try:
+                self.boot()
+            except Exception:
+                logger.info('Booting build node %s failed' % (self.name,),
+                            exc_info=True)
+                self.delete()
+                return None
+
+            if not self.prepare():
+                return None
+
+            if build_record is None:
+                self.update_state(self.READY)
+                return self.next_build()
+            self.update_state(self.BUILDING)
+        return build_record
+
+    def boot(self, use_baked_image=True):
+        cloud = self.cloud
+        name = self.name
         cl = cloud.client
         if cloud.keypair_set.count() < 1:
             logger.info('Cloud %s does not have a keypair yet. '
                         'Creating' % cloud)
-            name = cls.get_unique_keypair_name(cl)
-            kp = cl.keypairs.create(name=name)
-            keypair = KeyPair(cloud=cloud, name=name,
+            keypair_name = self.get_unique_keypair_name(cl)
+            kp = cl.keypairs.create(name=keypair_name)
+            keypair = KeyPair(cloud=cloud, name=keypair_name,
                               private_key=kp.private_key,
                               public_key=kp.public_key)
             keypair.save()
@@ -876,12 +2287,17 @@ class BuildNode(models.Model):
             keypair = cloud.keypair_set.all()[0]
         logger.debug('Using cached keypair: %s' % (keypair,))
 
-        name = cls.get_unique_buildnode_name(cl)
-        flavor = utils.get_flavor_by_name(cl, cl.cloud.flavor_name)
-        image = utils.get_image_by_regex(cl, cl.cloud.image_name)
+        flavor = utils.get_flavor_by_name(cl, self.flavor_name())
+        image = None
+        if use_baked_image:
+            image = self.baked_image()
+        if image is None:
+            image = utils.get_image_by_regex(cl, cl.cloud.image_name)
 
         logger.info('Creating server %s on cloud %s' % (name, cloud))
         srv = cl.servers.create(name, image, flavor, key_name=keypair.name)
+        self.cloud_node_id = srv.id
+        self.save()
 
         timeout = time.time() + 120
         succeeded = False
@@ -932,9 +2348,62 @@ class BuildNode(models.Model):
                 floating_ip.delete()
                 raise Exception('Failed to spawn node')
 
-        bn = BuildNode(name=name, cloud=cloud, cloud_node_id=srv.id)
-        bn.save()
-        return bn
+    def flavor_name(self):
+        if self.ubuntu_series_id is None or self.architecture_id is None:
+            return self.cloud.flavor_name
+        queue = BuildQueue.for_chroot(self.ubuntu_series, self.architecture)
+        return queue.flavor_name_for(self.cloud)
+
+    def baked_image(self):
+        """Looks up the pre-baked image for this node's chroot
+
+        Records the image on the node and returns the cloud's image
+        object. Returns None if there's no usable baked image."""
+        if self.ubuntu_series_id is None or self.architecture_id is None:
+            return None
+
+        try:
+            image = BuildNodeImage.objects.get(cloud=self.cloud,
+                                               tarball=self.tarball)
+        except (BuildNodeImage.DoesNotExist, ChrootTarball.DoesNotExist):
+            return None
+
+        try:
+            cloud_image = self.cloud.client.images.get(image.image_id)
+        except novaclient.exceptions.NotFound:
+            logger.info('Baked image %s is gone. Forgetting about it.' %
+                        (image,))
+            image.delete()
+            return None
+
+        logger.info('Booting build node %s from %s' % (self, image))
+        self.image = image
+        self.save()
+        return cloud_image
+
+    def snapshot(self, image_name):
+        """Snapshots this node and waits for the image to become active
+
+        Returns the cloud's ID of the new image."""
+        cl = self.cloud.client
+        logger.info('Snapshotting build node %s as %s' % (self, image_name))
+        self._run_cmd('sync')
+        image_id = cl.servers.create_image(self.cloud_node_id, image_name)
+
+        timeout = time.time() + 1800
+        while timeout > time.time():
+            status = cl.images.get(image_id).status
+            if status == 'ACTIVE':
+                return image_id
+            elif status == 'ERROR':
+                break
+            time.sleep(10)
+
+        try:
+            cl.images.delete(image_id)
+        except novaclient.exceptions.NotFound:
+            pass
+        raise Exception('Failed to snapshot build node %s' % (self,))
 
     @property
     def cloud_server(self):
@@ -952,6 +2421,11 @@ class BuildNode(models.Model):
         return self.cloud_server.networks.values()[0][index]
 
     def delete(self):
+        if not self.cloud_node_id:
+            # Reserved, but never booted.
+            self.buildrecord_set.all().update(build_node=None)
+            return super(BuildNode, self).delete()
+
         if getattr(settings, 'USE_FLOATING_IPS', False):
             try:
                 floating_ip = self.ip
@@ -982,6 +2456,8 @@ class BuildNode(models.Model):
                      'BuildNode %s' % (self,))
         self.buildrecord_set.all().update(build_node=None)
 
+        self.close_ssh_connection()
+
         logger.info('Deleting BuildNode %s' % (self,))
         super(BuildNode, self).delete()
 
@@ -995,41 +2471,72 @@ class BuildNode(models.Model):
         priv_key_file = StringIO.StringIO(private_key)
         return paramiko.RSAKey.from_private_key(priv_key_file)
 
-    def ssh_client(self):
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(self.ip, username='ubuntu', pkey=self.paramiko_private_key)
-        return ssh
+    def ssh_connection(self):
+        """Returns the cached SSHConnection to this node
+
+        The node's IP and private key are resolved only once, when the
+        connection is first needed."""
+        key = (self.name, self.cloud_node_id)
+        stale = []
+        with _ssh_connections_lock:
+            if key not in _ssh_connections:
+                # Whatever server used to go by this name is gone
+                for other in _ssh_connections.keys():
+                    if other[0] == self.name:
+                        stale.append(_ssh_connections.pop(other))
+                _ssh_connections[key] = SSHConnection(
+                                                 self.ip,
+                                                 self.paramiko_private_key)
+            conn = _ssh_connections[key]
+        for other in stale:
+            other.close()
+        return conn
+
+    def close_ssh_connection(self):
+        with _ssh_connections_lock:
+            conn = _ssh_connections.pop((self.name, self.cloud_node_id),
+                                        None)
+        if conn is not None:
+            conn.close()
 
-    def run_cmd(self, cmd, input=None):
+    def ssh_client(self):
+        conn = self.ssh_connection()
+        conn.transport()
+        return conn.client
+
+    def start_cmd(self, cmd, input=None, output_callback=None,
+                  timeout=None, multiplexer=None, buffer_output=False,
+                  idle_callback=None):
+        """Starts cmd on this node without waiting for it
+
+        The returned RemoteCommand is driven by multiplexer (this
+        thread's default one unless given), so any number of commands,
+        on any number of nodes, can be supervised from one process."""
         logger.debug('Running: %s' % (cmd,))
 
-        ssh = self.ssh_client()
-        transport = ssh.get_transport()
+        if multiplexer is None:
+            multiplexer = remote.default_multiplexer()
 
-        chan = transport.open_session()
-        chan.exec_command(cmd)
-        chan.set_combine_stderr(True)
-        if input:
-            chan.sendall(input)
-            chan.shutdown_write()
+        chan = self.ssh_connection().open_session()
+        try:
+            chan.exec_command(cmd)
+            chan.set_combine_stderr(True)
+            if input:
+                chan.sendall(input)
+                chan.shutdown_write()
+        except:
+            chan.close()
+            raise
 
-        while True:
-            r, _, __ = select.select([chan], [], [], 1)
-            if r:
-                if chan in r:
-                    if chan.recv_ready():
-                        s = chan.recv(4096)
-                        if len(s) == 0:
-                            break
-                        yield s
-                    else:
-                        status = chan.recv_exit_status()
-                        if status != 0:
-                            raise Exception('Command %s failed' % cmd)
-                        break
+        return multiplexer.add(chan, cmd, output_callback=output_callback,
+                               timeout=timeout, buffer_output=buffer_output,
+                               idle_callback=idle_callback)
 
-        ssh.close()
+    def run_cmd(self, cmd, input=None, timeout=None):
+        multiplexer = remote.default_multiplexer()
+        command = self.start_cmd(cmd, input=input, timeout=timeout,
+                                 multiplexer=multiplexer, buffer_output=True)
+        return multiplexer.iter_output(command)
 
     def _posix_shell(self, chan):
         oldtty = termios.tcgetattr(sys.stdin)
@@ -1064,6 +2571,74 @@ class BuildNode(models.Model):
         self._posix_shell(shell)
 
 
+class BuildNodeImage(models.Model):
+    """A cloud image of a build node with the build infrastructure installed
+
+    Booting build nodes from these saves installing puppet, sbuild and
+    the chroot tarball on every node. Images are invalidated whenever
+    their chroot tarball is refreshed."""
+    cloud = models.ForeignKey(Cloud)
+    tarball = models.ForeignKey(ChrootTarball)
+    image_id = models.CharField(max_length=200)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('cloud', 'tarball')
+
+    def __unicode__(self):
+        return '%s image on %s' % (self.tarball, self.cloud)
+
+    @classmethod
+    def missing(cls, tarball=None):
+        """Returns (cloud, tarball) tuples that lack a baked image"""
+        tarballs = ChrootTarball.objects.filter(state=ChrootTarball.READY)
+        if tarball is not None:
+            tarballs = tarballs.filter(pk=tarball.pk)
+
+        pairs = []
+        for cloud in Cloud.objects.all():
+            for tb in tarballs.exclude(buildnodeimage__cloud=cloud):
+                pairs.append((cloud, tb))
+        return pairs
+
+    @classmethod
+    def bake(cls, cloud, tarball):
+        """Prepares a build node for tarball and snapshots it"""
+        if cls.objects.filter(cloud=cloud, tarball=tarball).exists():
+            logger.info('%s already has a baked image on %s' %
+                        (tarball, cloud))
+            return
+
+        logger.info('Baking image for %s on %s' % (tarball, cloud))
+        # Kept out of the build slot, queue capacity and pool counts
+        bn = BuildNode.reserve(cloud, tarball.architecture, tarball.series)
+        bn.update_state(BuildNode.BAKING)
+        try:
+            bn.boot(use_baked_image=False)
+            bn.wait_until_reachable()
+            bn.install_build_infrastructure()
+            bn._run_cmd('sudo apt-get clean; sudo rm -f puppet.pp')
+            image_id = bn.snapshot('buildd-%s-%s-%s' %
+                                   (tarball.series.name,
+                                    tarball.architecture.name,
+                                    date.today().strftime('%Y%m%d')))
+        finally:
+            bn.delete()
+
+        image = cls(cloud=cloud, tarball=tarball, image_id=image_id)
+        image.save()
+        logger.info('Baked %s: %s' % (image, image_id))
+        return image
+
+    def delete(self):
+        logger.info('Deleting %s (%s)' % (self, self.image_id))
+        try:
+            self.cloud.client.images.delete(self.image_id)
+        except novaclient.exceptions.NotFound:
+            logger.info('Image %s already gone' % (self.image_id,))
+        super(BuildNodeImage, self).delete()
+
+
 class TarballCacheEntry(models.Model):
     project_name = models.CharField(max_length=200)
     project_version = models.CharField(max_length=200)
@@ -1106,6 +2681,76 @@ class PackageSourceBuildProblem(models.Model):
             return fp.read()
 
 
+class RevisionLookupCache(object):
+    """Looks up the current revision of code and packaging branches
+
+    Meant to last for a single poll cycle. All branches of a git remote
+    are answered from a single "git ls-remote", and each bzr branch is
+    only asked once. Safe to share between threads: if a lookup is
+    already in progress, others for the same remote wait for it rather
+    than repeating it."""
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.results = {}
+        self.locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def _cached(self, key, f):
+        with self.lock:
+            key_lock = self.locks[key]
+
+        with key_lock:
+            if key not in self.results:
+                try:
+                    self.results[key] = (f(), None)
+                except Exception, e:
+                    self.results[key] = (None, e)
+
+        result, error = self.results[key]
+        if error is not None:
+            raise error
+        return result
+
+    def git_refs(self, remote):
+        """Returns a list of (ref, sha) for all refs in remote"""
+        def ls_remote():
+            logger.debug('Listing refs of %s' % (remote,))
+            out = utils.run_cmd(['git', 'ls-remote', remote],
+                                timeout=self.timeout)
+            refs = []
+            for l in out.split('\n'):
+                if '\t' in l:
+                    sha, ref = l.split('\t', 1)
+                    refs.append((ref, sha))
+            return refs
+        return self._cached(('git', remote), ls_remote)
+
+    def bzr_revision(self, url):
+        def revision_info():
+            logger.debug('Looking up current revision of %s' % (url,))
+            out = utils.run_cmd(['bzr', 'revision-info', '-d', url],
+                                timeout=self.timeout)
+            return out.split('\n')[0].split(' ')[1]
+        return self._cached(('bzr', url), revision_info)
+
+    def lookup(self, url):
+        vcstype = PackageSource._guess_vcs_type(url)
+
+        if vcstype == 'bzr':
+            return self.bzr_revision(url)
+
+        if vcstype == 'git':
+            if '#' in url:
+                url, branch = url.split('#')
+            else:
+                branch = 'master'
+            # Same matching as "git ls-remote <url> <branch>"
+            for ref, sha in self.git_refs(url):
+                if ref == branch or ref.endswith('/' + branch):
+                    return sha
+            return ''
+
+
 class PackageSource(models.Model):
     OPENSTACK = 'OpenStack'
     PUPPET = 'Puppet'
@@ -1270,8 +2915,11 @@ class PackageSource(models.Model):
                 subscription.save()
 
         def build(self):
-            self.prepare_code()
-            self.build_packages()
+            # The checkouts borrow objects from the git cache, so it
+            # mustn't be repacked until we're done with them.
+            with GitCache().in_use():
+                self.prepare_code()
+                self.build_packages()
             self.cleanup()
 
     class PuppetPackageBuilder(SourcePackageBuilder):
@@ -1359,10 +3007,91 @@ class PackageSource(models.Model):
     flavor = models.CharField(max_length=200, choices=PACKAGING_FLAVORS,
                               default=OPENSTACK)
     last_changed = models.DateTimeField(null=True, blank=True, db_index=True)
+    next_poll = models.DateTimeField(null=True, blank=True, db_index=True)
+    poll_interval = models.IntegerField(null=True, blank=True)
+    poll_interval_override = models.IntegerField(null=True, blank=True,
+                                                 help_text="Always poll this "
+                                                           "often (in seconds)")
+    code_url_normalized = models.CharField(max_length=200, db_index=True,
+                                           blank=True, editable=False)
+    packaging_url_normalized = models.CharField(max_length=200, db_index=True,
+                                                blank=True, editable=False)
 
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.code_url_normalized = utils.normalize_vcs_url(self.code_url)
+        self.packaging_url_normalized = utils.normalize_vcs_url(
+                                                         self.packaging_url)
+        return super(PackageSource, self).save(*args, **kwargs)
+
+    @classmethod
+    def matching_url(cls, url, branch=None):
+        """Returns the sources whose code or packaging comes from url
+
+        If branch (or a '#branch' suffix on url) is given, only sources
+        following that branch are returned."""
+        if branch is None and '#' in url:
+            url, branch = url.split('#', 1)
+        normalized = utils.normalize_vcs_url(url)
+        candidates = cls.objects.filter(
+                          models.Q(code_url_normalized=normalized) |
+                          models.Q(packaging_url_normalized=normalized))
+
+        if branch is None:
+            return list(candidates)
+
+        def follows_branch(source_url):
+            if utils.normalize_vcs_url(source_url) != normalized:
+                return False
+            if '#' in source_url:
+                return source_url.split('#', 1)[1] == branch
+            return branch == 'master'
+
+        return [pkg_src for pkg_src in candidates
+                if (follows_branch(pkg_src.code_url) or
+                    follows_branch(pkg_src.packaging_url))]
+
+    @classmethod
+    def due(cls, now=None):
+        now = now or timezone.now()
+        return cls.objects.filter(models.Q(next_poll__isnull=True) |
+                                  models.Q(next_poll__lte=now))
+
+    def schedule_next_poll(self, changed, now=None):
+        """Works out when to poll this source next
+
+        Every poll that finds nothing new doubles the interval (up to
+        settings.POLL_INTERVAL_MAX). Finding a change resets it to
+        settings.POLL_INTERVAL_MIN. Either way, a source that changed
+        recently gets polled at least every quarter of the time since.
+        poll_interval_override trumps all of this."""
+        now = now or timezone.now()
+        min_interval = getattr(settings, 'POLL_INTERVAL_MIN', 120)
+        max_interval = getattr(settings, 'POLL_INTERVAL_MAX', 86400)
+        factor = getattr(settings, 'POLL_BACKOFF_FACTOR', 2)
+
+        if self.poll_interval_override:
+            interval = self.poll_interval_override
+        else:
+            if changed or not self.poll_interval:
+                interval = min_interval
+            else:
+                interval = self.poll_interval * factor
+
+            if self.last_changed and not changed:
+                age = (now - self.last_changed).total_seconds()
+                interval = min(interval, age / 4)
+
+            interval = int(max(min_interval, min(interval, max_interval)))
+
+        self.poll_interval = interval
+        self.next_poll = now + timedelta(seconds=interval)
+        # Not save(), since a build may be updating the revisions
+        PackageSource.objects.filter(pk=self.pk).update(
+                poll_interval=self.poll_interval, next_poll=self.next_poll)
+
     @classmethod
     def _guess_vcs_type(cls, url):
         if 'launchpad' in url:
@@ -1374,34 +3103,31 @@ class PackageSource(models.Model):
         raise Exception('No idea what to do with %r' % url)
 
     @classmethod
-    def lookup_revision(cls, url):
+    def lookup_revision(cls, url, timeout=None, cache=None):
         if not url:
             logger.debug("Empty url. Not going to poll.")
             return ''
 
-        logger.debug("Looking up current revision of %s" % (url,))
-        vcstype = cls._guess_vcs_type(url)
+        if cache is None:
+            cache = RevisionLookupCache(timeout)
+        return cache.lookup(url)
 
-        if vcstype == 'bzr':
-            out = utils.run_cmd(['bzr', 'revision-info', '-d', url])
-            return out.split('\n')[0].split(' ')[1]
+    def detect_changes(self, cache=None):
+        """Looks up the current code and packaging revisions
 
-        if vcstype == 'git':
-            if '#' in url:
-                url, branch = url.split('#')
-            else:
-                branch = 'master'
-            out = utils.run_cmd(['git', 'ls-remote', url, branch])
-            return out.split('\n')[0].split('\t')[0]
-
-    def poll(self):
+        Returns them as a tuple if either differs from what we last
+        built, otherwise None. Pass a RevisionLookupCache to share
+        lookups with other sources."""
         logger.info('Polling %s' % (self,))
+        timeout = getattr(settings, 'POLL_TIMEOUT', 60)
 
-        current_code_revision = self.lookup_revision(self.code_url)
+        current_code_revision = self.lookup_revision(self.code_url, timeout,
+                                                     cache)
         logger.info('Current code revision for %s: %s' %
                     (self, current_code_revision))
 
-        current_pkg_revision = self.lookup_revision(self.packaging_url)
+        current_pkg_revision = self.lookup_revision(self.packaging_url,
+                                                    timeout, cache)
         logger.info('Current packaging revision for %s: %s' %
                     (self, current_pkg_revision))
 
@@ -1421,17 +3147,37 @@ class PackageSource(models.Model):
             something_changed = True
 
         if something_changed:
-            package_builder_class = self.PACKAGE_BUILDER_CLASS[self.flavor]
-            package_builder = package_builder_class(self,
-                                                    current_code_revision,
-                                                    current_pkg_revision)
-            package_builder.build()
-
-            self.last_seen_code_rev = current_code_revision
-            self.last_seen_pkg_rev = current_pkg_revision
-            self.last_changed = timezone.now()
-            self.save()
-        return something_changed
+            return current_code_revision, current_pkg_revision
+        return None
+
+    def build(self, code_revision, pkg_revision, detected=None):
+        """Builds and uploads source packages for the given revisions
+
+        detected is when the change was noticed. If a build of a change
+        noticed later has already finished, the last seen revisions are
+        left alone, so a slow build doesn't roll them back."""
+        package_builder_class = self.PACKAGE_BUILDER_CLASS[self.flavor]
+        package_builder = package_builder_class(self,
+                                                code_revision,
+                                                pkg_revision)
+        package_builder.build()
+
+        detected = detected or timezone.now()
+        newer = (models.Q(last_changed__isnull=True) |
+                 models.Q(last_changed__lt=detected))
+        if PackageSource.objects.filter(newer, pk=self.pk).update(
+                last_seen_code_rev=code_revision,
+                last_seen_pkg_rev=pkg_revision,
+                last_changed=detected):
+            self.last_seen_code_rev = code_revision
+            self.last_seen_pkg_rev = pkg_revision
+            self.last_changed = detected
+
+    def poll(self):
+        revisions = self.detect_changes()
+        if revisions:
+            self.build(*revisions)
+        return bool(revisions)
 
     @classmethod
     def vcs_browser_url(self, url, revision):
@@ -1472,57 +3218,53 @@ class PackageSource(models.Model):
                                       '-r', revision,
                                       url, destdir])
         elif vcstype == 'git':
-            if not os.path.exists(settings.GIT_CACHE_DIR):
-                utils.run_cmd(['git', 'init', settings.GIT_CACHE_DIR])
-
-            try:
-                # If it's already here, don't fetch.
-                utils.run_cmd(['git', 'show', revision, '--'],
-                              cwd=settings.GIT_CACHE_DIR)
-            except CommandFailed:
-                # Fetch all the needed objects and store them in the cache
-                if '#' in url:
-                    branchless_url, branch = url.split('#')
-                else:
-                    branchless_url = url
-
-                sanitized_url = branchless_url.replace(':', '_'
-                                             ).replace('/', '_')
-
-                remotes = utils.run_cmd(['git', 'remote'],
-                                        cwd=settings.GIT_CACHE_DIR).split('\n')
+            with GitCache().in_use() as cache:
+                cache.ensure_revision(url, revision)
+
+                if not os.path.exists(destdir):
+                    # Clones the real repo, but uses the cache as a
+                    # reference. This saves bandwidth (we know for sure
+                    # the objects are already there, and gets us a fully
+                    # usable repo with tags and everything.
+                    clone_cmd = ['git', 'clone', '--reference', cache.path]
+
+                    if '#' in url:
+                        clone_url, clone_branch = url.split('#')
+                        clone_cmd += ['-b', clone_branch, clone_url]
+                    else:
+                        clone_cmd += [url]
 
-                if not sanitized_url in remotes:
-                    utils.run_cmd(['git', 'remote', 'add', sanitized_url,
-                                   branchless_url],
-                                  cwd=settings.GIT_CACHE_DIR)
+                    clone_cmd += [destdir]
 
-                utils.run_cmd(['git', 'fetch', sanitized_url],
-                              cwd=settings.GIT_CACHE_DIR)
+                    utils.run_cmd(clone_cmd)
 
-            if not os.path.exists(destdir):
-                # Clones the real repo, but uses the cache as a reference.
-                # This saves bandwidth (we know for sure the objects are
-                # already there, and gets us a fully usable repo with tags
-                # and everything.
-                clone_cmd = ['git', 'clone', '--reference',
-                             settings.GIT_CACHE_DIR]
+                utils.run_cmd(['git', 'reset', '--hard', revision],
+                              cwd=destdir)
+                utils.run_cmd(['git', 'clean', '-dfx'], cwd=destdir)
 
-                if '#' in url:
-                    clone_url, clone_branch = url.split('#')
-                    clone_cmd += ['-b', clone_branch, clone_url]
-                else:
-                    clone_cmd += [url]
+    def can_modify(self, user):
+        return all(x.can_modify(user) for x in self.subscription_set.all())
 
-                clone_cmd += [destdir]
 
-                utils.run_cmd(clone_cmd)
+class PollCycle(models.Model):
+    """One run of poll_upstreams over all the package sources"""
+    started = models.DateTimeField(db_index=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    sources = models.IntegerField(default=0)
+    changed = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    failed_sources = models.TextField(blank=True)
 
-            utils.run_cmd(['git', 'reset', '--hard', revision], cwd=destdir)
-            utils.run_cmd(['git', 'clean', '-dfx'], cwd=destdir)
+    def __unicode__(self):
+        return 'Poll cycle started %s' % (self.started,)
 
-    def can_modify(self, user):
-        return all(x.can_modify(user) for x in self.subscription_set.all())
+    @classmethod
+    def latest(cls):
+        try:
+            return cls.objects.exclude(finished=None).order_by('-started')[0]
+        except IndexError:
+            return None
 
 
 class Subscription(models.Model):
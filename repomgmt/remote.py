@@ -0,0 +1,185 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import collections
+import logging
+import select
+import threading
+import time
+
+from repomgmt.exceptions import RemoteCommandFailed, RemoteCommandTimedOut
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4096
+
+# Output we're willing to hold on to for a command whose consumer isn't
+# keeping up. Beyond this, we stop reading from the channel, so the SSH
+# window fills up and the remote end blocks.
+MAX_BUFFERED = 1024 * 1024
+
+
+class RemoteCommand(object):
+    """A command running on a paramiko channel
+
+    Output is handed to output_callback as it arrives. If buffer_output
+    is set, it is also kept around for CommandMultiplexer.iter_output.
+    idle_callback is called whenever the multiplexer polls without
+    getting any output from the command."""
+    def __init__(self, chan, cmd, output_callback=None, timeout=None,
+                 buffer_output=False, max_buffered=MAX_BUFFERED,
+                 idle_callback=None):
+        self.chan = chan
+        self.cmd = cmd
+        self.output_callback = output_callback
+        self.idle_callback = idle_callback
+        self.buffer_output = buffer_output
+        self.max_buffered = max_buffered
+        if timeout:
+            self.deadline = time.time() + timeout
+        else:
+            self.deadline = None
+
+        self.buffer = collections.deque()
+        self.buffered = 0
+        self.exit_status = None
+        self.error = None
+
+    def __repr__(self):
+        return '<RemoteCommand cmd=%r>' % (self.cmd,)
+
+    @property
+    def done(self):
+        return self.exit_status is not None or self.error is not None
+
+    def wants_data(self):
+        return not self.done and self.buffered < self.max_buffered
+
+    def check_timeout(self, now):
+        if self.deadline is not None and not self.done and now > self.deadline:
+            logger.info('Command %s timed out' % (self.cmd,))
+            self.error = RemoteCommandTimedOut('Command %s timed out' %
+                                               (self.cmd,))
+            self.chan.close()
+
+    def read(self):
+        """Reads whatever output is available
+
+        Returns whether there was any."""
+        got_output = False
+        while self.wants_data() and self.chan.recv_ready():
+            data = self.chan.recv(CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            got_output = True
+            if self.output_callback is not None:
+                self.output_callback(data)
+            if self.buffer_output:
+                self.buffer.append(data)
+                self.buffered += len(data)
+
+        if (not self.done and not self.chan.recv_ready() and
+                self.chan.exit_status_ready()):
+            self.exit_status = self.chan.recv_exit_status()
+        return got_output
+
+    def pop_output(self):
+        data = self.buffer.popleft()
+        self.buffered -= len(data)
+        return data
+
+    def raise_for_status(self):
+        if self.error is not None:
+            raise self.error
+        if self.exit_status != 0:
+            raise RemoteCommandFailed('Command %s failed' % (self.cmd,),
+                                      self.cmd, self.exit_status)
+
+
+class CommandMultiplexer(object):
+    """Supervises any number of remote commands from a single thread"""
+    def __init__(self):
+        self.commands = []
+
+    def add(self, chan, cmd, **kwargs):
+        command = RemoteCommand(chan, cmd, **kwargs)
+        self.commands.append(command)
+        return command
+
+    def poll(self, timeout=1):
+        """Waits up to timeout seconds for output and dispatches it"""
+        now = time.time()
+        for command in self.commands:
+            command.check_timeout(now)
+
+        readers = {}
+        poller = select.poll()
+        for command in self.commands:
+            if command.wants_data():
+                fd = command.chan.fileno()
+                readers[fd] = command
+                poller.register(fd, select.POLLIN)
+
+        active = set()
+        if readers:
+            for fd, _ in poller.poll(timeout * 1000):
+                if readers[fd].read():
+                    active.add(readers[fd])
+        elif self.commands:
+            # Everything is either done or waiting for its consumer.
+            time.sleep(timeout)
+
+        for command in self.commands:
+            if command.idle_callback is not None and command not in active:
+                command.idle_callback()
+
+        self.commands = [c for c in self.commands if not c.done]
+
+    def iter_output(self, command):
+        """Yields command's output, running other commands meanwhile
+
+        Raises RemoteCommandFailed if the command fails or times out."""
+        try:
+            while True:
+                while command.buffer:
+                    yield command.pop_output()
+                if command.done:
+                    break
+                self.poll()
+        finally:
+            command.chan.close()
+            if command in self.commands:
+                self.commands.remove(command)
+
+        command.raise_for_status()
+
+    def run_all(self, commands):
+        """Runs until all of commands have completed"""
+        while not all(c.done for c in commands):
+            self.poll()
+        for command in commands:
+            command.chan.close()
+
+
+_local = threading.local()
+
+
+def default_multiplexer():
+    """Returns this thread's CommandMultiplexer"""
+    if not hasattr(_local, 'multiplexer'):
+        _local.multiplexer = CommandMultiplexer()
+    return _local.multiplexer
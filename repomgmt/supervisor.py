@@ -0,0 +1,134 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from multiprocessing.pool import ThreadPool
+import logging
+import Queue
+import time
+
+from django.conf import settings
+
+from repomgmt import remote, utils
+from repomgmt.models import BuildRecord, BuildRun
+
+logger = logging.getLogger(__name__)
+
+
+def supervisor_lock(blocking=False, shared=False):
+    """The lock a running BuildSupervisor holds exclusively
+
+    The process-build-queue task leaves the build queue alone while
+    it's held. See utils.file_lock for the arguments."""
+    return utils.file_lock(utils.lock_path('build-supervisor'),
+                           blocking=blocking, shared=shared)
+
+
+class BuildSupervisor(object):
+    """Runs the build farm's builds from a single process
+
+    sbuild, which takes up nearly all of a build's time, runs under one
+    CommandMultiplexer for all builds, so there's no process or thread
+    tied up per build. The blocking steps around it (booting and
+    preparing build nodes, pointing them at a build, uploading the
+    result) are handed to a pool of settings.BUILD_SUPERVISOR_THREADS
+    threads. Pending builds are dispatched every
+    settings.BUILD_DISPATCH_INTERVAL seconds, and a build node that
+    finishes a build moves straight on to the next one, going by the
+    ranking of the queue made for the last dispatch pass."""
+    def __init__(self):
+        self.dispatch_interval = getattr(settings, 'BUILD_DISPATCH_INTERVAL',
+                                         60)
+        self.pool = ThreadPool(getattr(settings, 'BUILD_SUPERVISOR_THREADS',
+                                       8))
+        self.multiplexer = remote.CommandMultiplexer()
+        # Builds ready for sbuild, handed over by the pool
+        self.prepared = Queue.Queue()
+        self.runs = []
+        self.last_dispatch = None
+        # The BuildPickers of the last dispatch pass
+        self.pickers = {}
+
+    def dispatch(self):
+        self.pickers = {}
+        for build_node, build_record in BuildRecord.dispatch_builds(
+                                                              self.pickers):
+            self.pool.apply_async(self.prepare, (build_node, build_record))
+
+    def prepare(self, build_node, build_record):
+        """Gets build_record ready to run on build_node
+
+        Runs in the pool."""
+        try:
+            build_record = build_node.make_ready(build_record)
+            if build_record is None:
+                return
+            run = BuildRun(build_node, build_record)
+            if run.prepare():
+                self.prepared.put(run)
+            else:
+                self.finish(run)
+        except Exception:
+            logger.error('Failed to prepare %s on %s' %
+                         (build_record, build_node), exc_info=True)
+
+    def finish(self, run):
+        """Wraps up run and starts preparing the node's next build
+
+        Runs in the pool."""
+        try:
+            run.finish()
+            build_record = run.build_node.next_build(self.pickers)
+        except Exception:
+            logger.error('Failed to finish %r' % (run,), exc_info=True)
+            return
+        if build_record is not None:
+            self.prepare(run.build_node, build_record)
+
+    def start_prepared(self):
+        while True:
+            try:
+                run = self.prepared.get_nowait()
+            except Queue.Empty:
+                break
+            run.start(self.multiplexer)
+            self.runs.append(run)
+
+    def finish_done(self):
+        for run in [run for run in self.runs if run.done]:
+            self.runs.remove(run)
+            self.pool.apply_async(self.finish, (run,))
+
+    def run_once(self, timeout=1):
+        now = time.time()
+        if (self.last_dispatch is None or
+                now - self.last_dispatch >= self.dispatch_interval):
+            self.last_dispatch = now
+            self.dispatch()
+
+        self.start_prepared()
+        if self.runs:
+            self.multiplexer.poll(timeout)
+        else:
+            time.sleep(timeout)
+        self.finish_done()
+
+    def run(self):
+        # A second supervisor waits here until the first one exits
+        with supervisor_lock(blocking=True):
+            logger.info('Supervising builds')
+            while True:
+                self.run_once()
@@ -15,11 +15,19 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
+from multiprocessing.pool import ThreadPool
+import time
+
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.utils import timezone
 
-from repomgmt.models import BuildRecord, ChrootTarball, PackageSource
-from repomgmt.models import Repository
+from repomgmt.models import BuildNode, BuildNodeImage, BuildRecord
+from repomgmt.models import ChrootTarball, Cloud, PackageSource
+from repomgmt.models import PollCycle, Repository, RevisionLookupCache
+from repomgmt import utils
+from repomgmt.gitcache import GitCache
+from repomgmt.supervisor import supervisor_lock
 
 logger = get_task_logger(__name__)
 
@@ -30,7 +38,11 @@ if getattr(settings, 'TESTING', False):
         def inner(f):
             def run(*args, **kwargs):
                 return f(*args, **kwargs)
+
+            def apply_async(args=(), kwargs={}, **options):
+                return f(*args, **kwargs)
             f.delay = run
+            f.apply_async = apply_async
             return f
         return inner
 else:
@@ -42,26 +54,199 @@ def refresh_tarball(tarball_id):
     tb = ChrootTarball.objects.get(pk=tarball_id)
     logger.info('Refreshing %r' % (tb,))
     tb.refresh()
+    bake_build_node_images.delay(tarball_id)
+
+
+@task()
+def bake_build_node_images(tarball_id=None):
+    if tarball_id is None:
+        tb = None
+    else:
+        tb = ChrootTarball.objects.get(pk=tarball_id)
+
+    for cloud, tarball in BuildNodeImage.missing(tb):
+        bake_build_node_image.delay(cloud.name, tarball.id)
+
+
+@task()
+def bake_build_node_image(cloud_name, tarball_id):
+    cloud = Cloud.objects.get(name=cloud_name)
+    tb = ChrootTarball.objects.get(pk=tarball_id)
+    BuildNodeImage.bake(cloud, tb)
 
 
 @task()
 def process_build_queue():
-    BuildRecord.perform_single_build()
+    with supervisor_lock(shared=True) as locked:
+        if not locked:
+            logger.debug('repo-supervise-builds is running. Leaving the '
+                         'build queue to it.')
+            return
+        claimed = BuildRecord.dispatch_builds()
+
+    for build_node, build_record in claimed:
+        perform_build.delay(build_node.name, build_record.id)
+
+
+@task()
+def perform_build(build_node_name, build_record_id=None):
+    bn = BuildNode.objects.get(name=build_node_name)
+    if build_record_id is None:
+        br = None
+    else:
+        br = BuildRecord.objects.get(id=build_record_id)
+    bn.run_build(br)
+
+
+@task()
+def maintain_build_node_pool():
+    for build_node in BuildNode.maintain_pool():
+        perform_build.delay(build_node.name)
 
 
 @task()
 def process_incoming():
+    # repo-watch-incoming normally handles uploads as they arrive. This is
+    # only a sweep for anything it missed, so don't take reprepro's lock
+    # unless there's something to process.
     for repo in Repository.objects.all():
-        try:
-            repo.process_incoming()
-        except Exception, e:
-            logger.error('Error processing incoming for %s', repo.name, exc_info=e)
+        if repo.complete_uploads():
+            process_repository_incoming.delay(repo.name)
+
+
+@task()
+def process_repository_incoming(repository_name):
+    repo = Repository.objects.get(name=repository_name)
+    with utils.file_lock(repo.incoming_lockfile) as locked:
+        if not locked:
+            logger.info('Incoming for %s is already being processed' %
+                        (repo.name,))
+            return False
+
+        # Rather than have reprepro wait for the lock (and tie up a
+        # worker), skip this round. The next one will pick it up.
+        if repo.reprepro_locked():
+            logger.warning('reprepro lock for %s is held, not processing '
+                           'incoming' % (repo.name,))
+            return False
+
+        repo.process_incoming()
+        return True
+
+
+def _detect_changes(pkg_src, cache):
+    # Runs in a worker thread, so this mustn't touch the database
+    try:
+        return pkg_src, pkg_src.detect_changes(cache), None
+    except Exception, e:
+        logger.error('Error polling pkg_src %s', pkg_src, exc_info=e)
+        return pkg_src, None, e
+
+
+def _handle_poll_result(pkg_src, revisions):
+    pkg_src.schedule_next_poll(changed=bool(revisions))
+    if revisions:
+        code_rev, pkg_rev = revisions
+        build_source_package.delay(pkg_src.id, code_rev, pkg_rev,
+                                   timezone.now())
+
+
+@task()
+def poll_package_source(pkg_src_id):
+    pkg_src = PackageSource.objects.get(pk=pkg_src_id)
+    revisions = pkg_src.detect_changes()
+    _handle_poll_result(pkg_src, revisions)
+    return bool(revisions)
 
 
 @task()
 def poll_upstreams():
-    for pkg_src in PackageSource.objects.all():
+    with utils.file_lock(utils.lock_path('poll-upstreams')) as locked:
+        if not locked:
+            logger.warning('The previous poll cycle is still running, '
+                           'skipping this one')
+            return None
+
+        cycle = PollCycle(started=timezone.now())
+        start = time.time()
+        pkg_srcs = list(PackageSource.due())
+        workers = getattr(settings, 'POLL_WORKERS', 8)
+        pool = ThreadPool(max(1, min(workers, len(pkg_srcs))))
+        cache = RevisionLookupCache(getattr(settings, 'POLL_TIMEOUT', 60))
+        failed = []
         try:
-            pkg_src.poll()
-        except Exception, e:
-            logger.error('Error polling pkg_src %s', pkg_src, exc_info=e)
+            for pkg_src, revisions, error in pool.imap_unordered(
+                        lambda pkg_src: _detect_changes(pkg_src, cache),
+                        pkg_srcs):
+                cycle.sources += 1
+                if error is not None:
+                    failed.append('%s: %s' % (pkg_src, error))
+                elif revisions:
+                    cycle.changed += 1
+                _handle_poll_result(pkg_src, revisions)
+        finally:
+            pool.close()
+            pool.join()
+
+        cycle.finished = timezone.now()
+        cycle.duration = time.time() - start
+        cycle.failures = len(failed)
+        cycle.failed_sources = '\n'.join(failed)
+        cycle.save()
+        logger.info('Polled %d sources in %.1fs: %d changed, %d failed' %
+                    (cycle.sources, cycle.duration, cycle.changed,
+                     cycle.failures))
+        return cycle.id
+
+
+@task()
+def build_source_package(pkg_src_id, code_rev, pkg_rev, detected=None):
+    # Builds of the same source bump the same subscription counters, so
+    # only one of them may run at a time, whatever the revisions. If
+    # this one is a duplicate, the source still looks changed next time
+    # it gets polled, so it'll be queued again then.
+    name = 'source-build-%d' % (pkg_src_id,)
+    with utils.file_lock(utils.lock_path(name)) as locked:
+        if not locked:
+            logger.info('Source package %d is already being built, not '
+                        'building %s/%s now' % (pkg_src_id, code_rev, pkg_rev))
+            return False
+
+        concurrency = getattr(settings, 'SOURCE_BUILD_CONCURRENCY', 2)
+        with utils.slot_lock('source-build', concurrency) as slot:
+            if slot is None:
+                delay = getattr(settings, 'SOURCE_BUILD_RETRY_DELAY', 60)
+                logger.info('Too many source builds running, building '
+                            '%s/%s in %ds' % (code_rev, pkg_rev, delay))
+                build_source_package.apply_async((pkg_src_id, code_rev,
+                                                  pkg_rev, detected),
+                                                 countdown=delay)
+                return False
+
+            pkg_src = PackageSource.objects.get(pk=pkg_src_id)
+            if (pkg_src.last_seen_code_rev == code_rev and
+                    pkg_src.last_seen_pkg_rev == pkg_rev):
+                logger.info('%s/%s has already been built for %s' %
+                            (code_rev, pkg_rev, pkg_src))
+                return False
+
+            logger.info('Building source packages for %s (code: %s, '
+                        'packaging: %s)' % (pkg_src, code_rev, pkg_rev))
+            pkg_src.build(code_rev, pkg_rev, detected)
+            return True
+
+
+@task()
+def maintain_git_cache(attempt=1):
+    if GitCache().maintain():
+        return True
+
+    # The cache is hardly ever idle on a busy day, so rather than wait
+    # for tomorrow, keep trying until tomorrow's run takes over.
+    delay = getattr(settings, 'GIT_CACHE_MAINTENANCE_RETRY_DELAY', 900)
+    if attempt * delay < 24 * 3600:
+        maintain_git_cache.apply_async((attempt + 1,), countdown=delay)
+    else:
+        logger.warning('Git cache was in use all day. Giving up on '
+                       'maintaining it until the next scheduled run.')
+    return False
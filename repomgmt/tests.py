@@ -16,17 +16,42 @@
 #   limitations under the License.
 #
 from base64 import b64encode
-from contextlib import contextmanager
+from contextlib import contextmanager, nested
+import datetime
+import glob
+import gzip
 import json
 import mock
+import os
+import select
+import shutil
+import socket
+import tempfile
 import textwrap
+import threading
+import time
+import urllib
 from StringIO import StringIO
 
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase, client
 from django.test.utils import override_settings
+from django.db import connection, transaction
+from django.utils import timezone
 from repomgmt.models import Cloud, BuildNode, BuildRecord, KeyPair, Repository
+from repomgmt.models import BuildNodeImage, ChrootTarball, UbuntuSeries
+from repomgmt.models import Architecture, BuildQueue, PollCycle
 from repomgmt.models import Series, UploaderKey, PackageSource, Subscription
+from repomgmt.models import BuildPicker, BuildScheduler, RevisionLookupCache
+from repomgmt import buildlog, hookclient, tasks, utils
+from repomgmt.exceptions import CommandFailed, CommandTimedOut
+from repomgmt.gitcache import GitCache
+from repomgmt.exceptions import RemoteCommandFailed, RemoteCommandTimedOut
+from repomgmt.hooks import HookServer
+from repomgmt.incoming import IncomingWatcher
+from repomgmt.remote import CommandMultiplexer
+from repomgmt.supervisor import BuildSupervisor, supervisor_lock
 
 
 class CloudTests(TestCase):
@@ -136,10 +161,402 @@ class BuildNodeTests(TestCase):
             self.assertEquals(bn.ip, self.test_ip)
             client.servers.get.assert_called_with(self.test_id)
 
+    def _run_cmd_with_mocks(self, bn, SSHClient):
+        chan = SSHClient.return_value.get_transport.return_value.open_session.return_value
+        chan.recv_ready.return_value = False
+        chan.recv_exit_status.return_value = 0
+        chan.exit_status_ready.return_value = True
+        with mock.patch('repomgmt.remote.select') as select:
+            select.poll.return_value.poll.return_value = [
+                                           (chan.fileno.return_value, 1)]
+            return list(bn.run_cmd('true'))
+
+    def test_iter_lines(self):
+        bn = self._create()
+        chunks = ['fir', 'st\nsec', 'ond\n', '\nthi', 'rd']
+        with mock.patch.object(BuildNode, 'run_cmd') as run_cmd:
+            run_cmd.return_value = iter(chunks)
+            self.assertEquals(list(bn.iter_lines('foo')),
+                              ['first', 'second', '', 'third'])
+
+            run_cmd.return_value = iter(chunks)
+            self.assertEquals(bn._run_cmd('foo', tail=2), ['', 'third'])
+
+            run_cmd.return_value = iter(chunks)
+            self.assertEquals(bn._run_cmd('foo'), None)
+
+    def test_ssh_connection_reused(self):
+        bn = self._create()
+        with nested(
+                mock.patch('repomgmt.models.paramiko.SSHClient'),
+                mock.patch.object(BuildNode, 'ip',
+                                  new_callable=mock.PropertyMock)
+                ) as (SSHClient, ip):
+            ip.return_value = self.test_ip
+            self._run_cmd_with_mocks(bn, SSHClient)
+            self._run_cmd_with_mocks(BuildNode.objects.get(pk=bn.pk),
+                                     SSHClient)
+
+            self.assertEquals(SSHClient.call_count, 1)
+            self.assertEquals(ip.call_count, 1)
+            transport = SSHClient.return_value.get_transport.return_value
+            self.assertEquals(transport.open_session.call_count, 2)
+
+            with mock.patch.object(Cloud, 'client'):
+                bn.delete()
+            SSHClient.return_value.close.assert_called_with()
+
+    def test_ssh_connection_not_reused_for_new_server(self):
+        bn = self._create()
+        with nested(
+                mock.patch('repomgmt.models.paramiko.SSHClient'),
+                mock.patch.object(BuildNode, 'ip',
+                                  new_callable=mock.PropertyMock)
+                ) as (SSHClient, ip):
+            ip.return_value = self.test_ip
+            self._run_cmd_with_mocks(bn, SSHClient)
+
+            # Another server comes along under the same name
+            bn.cloud_node_id = 'a5b2f6e1-8d4c-4f0e-9a27-3c1d5e7b9f02'
+            ip.return_value = '10.11.12.14'
+            self._run_cmd_with_mocks(bn, SSHClient)
+
+            self.assertEquals(SSHClient.call_count, 2)
+            connect = SSHClient.return_value.connect
+            self.assertEquals(connect.call_args[0][0], '10.11.12.14')
+            SSHClient.return_value.close.assert_called_with()
+            bn.close_ssh_connection()
+
+
+class FakeChannel(object):
+    """Enough of a paramiko channel to drive a CommandMultiplexer"""
+    def __init__(self, chunks, exit_status=0):
+        self.chunks = list(chunks)
+        self.exit_status = exit_status
+        self.closed = False
+        self.recv_calls = 0
+        # A pipe that is always readable, like a channel's once it has
+        # data or has hit EOF.
+        self.rfd, self.wfd = os.pipe()
+        os.write(self.wfd, 'x')
+
+    def fileno(self):
+        return self.rfd
+
+    def recv_ready(self):
+        return bool(self.chunks)
+
+    def recv(self, nbytes):
+        self.recv_calls += 1
+        return self.chunks.pop(0)
+
+    def exit_status_ready(self):
+        return not self.chunks and self.exit_status is not None
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        if not self.closed:
+            os.close(self.rfd)
+            os.close(self.wfd)
+        self.closed = True
+
+
+class CommandMultiplexerTests(TestCase):
+    def test_concurrent_commands(self):
+        mux = CommandMultiplexer()
+        seen = []
+        chan1 = FakeChannel(['a1', 'a2'])
+        chan2 = FakeChannel(['b1'], exit_status=1)
+        cmd1 = mux.add(chan1, 'one', output_callback=seen.append)
+        cmd2 = mux.add(chan2, 'two', output_callback=seen.append)
+        mux.run_all([cmd1, cmd2])
+
+        self.assertEquals(sorted(seen), ['a1', 'a2', 'b1'])
+        self.assertEquals(cmd1.exit_status, 0)
+        self.assertEquals(cmd2.exit_status, 1)
+        self.assertTrue(chan1.closed and chan2.closed)
+
+    def test_unconsumed_output_stops_reading(self):
+        mux = CommandMultiplexer()
+        chan1 = FakeChannel(['x' * 10] * 5)
+        cmd1 = mux.add(chan1, 'one', buffer_output=True, max_buffered=20)
+        output = mux.iter_output(mux.add(FakeChannel(['y']), 'two',
+                                         buffer_output=True))
+        self.assertEquals(list(output), ['y'])
+
+        # Nobody has consumed cmd1's output, so reading stopped once the
+        # buffer was full.
+        self.assertEquals(chan1.recv_calls, 2)
+        self.assertEquals(''.join(mux.iter_output(cmd1)), 'x' * 50)
+
+    def test_failure_and_timeout(self):
+        mux = CommandMultiplexer()
+        failed = mux.add(FakeChannel(['oops'], exit_status=2), 'false',
+                         buffer_output=True)
+        self.assertRaises(RemoteCommandFailed, list, mux.iter_output(failed))
+
+        hung = mux.add(FakeChannel([], exit_status=None), 'sleep',
+                       buffer_output=True, timeout=0.01)
+        self.assertRaises(RemoteCommandTimedOut, list, mux.iter_output(hung))
+
+    def test_idle_callback(self):
+        mux = CommandMultiplexer()
+        idle = mock.Mock()
+        chan = FakeChannel(['output'], exit_status=None)
+        mux.add(chan, 'quiet', idle_callback=idle)
+        mux.poll(timeout=0.01)
+        self.assertFalse(idle.called)
+        mux.poll(timeout=0.01)
+        idle.assert_called_once_with()
+        chan.close()
+
+
+SUCCESSFUL_BUILD_LOG = textwrap.dedent('''\
+    +======================================================+
+    | Summary                                              |
+    +======================================================+
+
+    Status: successful
+
+    ''')
+
+
+class BuildRunTests(TestCase):
+    fixtures = ["test_series.yaml", "test_cloud.yaml"]
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        settings = self.settings(BUILD_LOG_DIR=self.log_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        for patcher in [mock.patch.object(BuildNode, 'assign'),
+                        mock.patch.object(BuildNode, '_run_cmd'),
+                        mock.patch.object(BuildNode, 'start_cmd'),
+                        mock.patch.object(Cloud, 'client')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _build(self, name):
+        bn = BuildNode(name='bn-%s' % (name,), cloud_id='test_cloud',
+                       state=BuildNode.READY)
+        bn.save()
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name=name, version='1.0',
+                         build_node=bn)
+        br.save()
+        return bn, br
+
+    def _sbuild(self, chunks, exit_status=0):
+        def start_cmd(cmd, multiplexer, **kwargs):
+            return multiplexer.add(FakeChannel(chunks, exit_status), cmd,
+                                   **kwargs)
+        BuildNode.start_cmd.side_effect = start_cmd
+
+    @override_settings(BUILD_TIMEOUT=0.01)
+    def test_timed_out_build_is_given_up(self):
+        bn, br = self._build('foo')
+        self._sbuild(['partial log\n'], exit_status=None)
+        bn.build(br)
+
+        br = BuildRecord.objects.get(pk=br.pk)
+        self.assertEquals(br.state, BuildRecord.TIMED_OUT)
+        self.assertEquals(''.join(br.iter_log()), 'partial log\n')
+        # No upload, and the node is retired
+        BuildNode._run_cmd.assert_called_once_with('rm -rf build; mkdir build')
+        self.assertFalse(BuildNode.objects.filter(pk=bn.pk).exists())
+
+    def test_requeued_build_keeps_blocked_flag(self):
+        bn, br = self._build('foo')
+        self._sbuild(['no summary\n'], exit_status=1)
+        start_cmd = BuildNode.start_cmd.side_effect
+
+        def block_meanwhile(*args, **kwargs):
+            # Something it build-depends on got queued during the build
+            BuildRecord.objects.filter(pk=br.pk).update(blocked=True)
+            return start_cmd(*args, **kwargs)
+        BuildNode.start_cmd.side_effect = block_meanwhile
+        bn.build(br)
+
+        br = BuildRecord.objects.get(pk=br.pk)
+        self.assertEquals(br.state, BuildRecord.NEEDS_BUILDING)
+        self.assertIsNotNone(br.finished)
+        self.assertTrue(br.blocked)
+
+    def test_supervisor_multiplexes_builds(self):
+        builds = [self._build('foo'), self._build('bar')]
+        self._sbuild([SUCCESSFUL_BUILD_LOG])
+
+        supervisor = BuildSupervisor()
+        # Threads would get a database of their own
+        supervisor.pool = mock.Mock()
+        supervisor.pool.apply_async.side_effect = lambda f, args: f(*args)
+        with nested(mock.patch.object(BuildRecord, 'dispatch_builds',
+                                      return_value=builds),
+                    mock.patch.object(BuildNode, 'next_build',
+                                      return_value=None)):
+            supervisor.run_once(timeout=0.01)
+            self.assertEquals(len(supervisor.runs), 0)
+            self.assertEquals(BuildNode.start_cmd.call_count, 2)
+
+        for bn, br in builds:
+            br = BuildRecord.objects.get(pk=br.pk)
+            self.assertEquals(br.state, BuildRecord.SUCCESFULLY_BUILT)
+            BuildNode._run_cmd.assert_any_call(
+                                       'cd build; dput return *.changes')
+            self.assertEquals(BuildNode.objects.get(pk=bn.pk).state,
+                              BuildNode.READY)
+
+    def test_no_build_queue_task_next_to_supervisor(self):
+        with mock.patch.object(BuildRecord, 'dispatch_builds',
+                               return_value=[]) as dispatch_builds:
+            with supervisor_lock() as locked:
+                self.assertTrue(locked)
+                tasks.process_build_queue()
+            self.assertEquals(dispatch_builds.call_count, 0)
+
+            tasks.process_build_queue()
+            self.assertEquals(dispatch_builds.call_count, 1)
+
+
+class BuildLogTests(TestCase):
+    fixtures = ["test_series.yaml"]
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(BUILD_LOG_DIR=self.log_dir)
+        self.settings_override.enable()
+        self.br = BuildRecord(series_id=1, architecture_id='amd64',
+                              source_package_name='foo', version='1.0-1')
+        self.br.save()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.log_dir)
+
+    def _write(self, lines):
+        with buildlog.BuildLogWriter(self.br.logfile(), block_size=100) as fp:
+            for l in lines:
+                fp.write(l)
+
+    def test_tail_reads_only_last_blocks(self):
+        lines = ['line %d\n' % (i,) for i in range(1000)]
+        self._write(lines[:500])
+        self._write(lines[500:])
+
+        with mock.patch.object(buildlog, 'decompress',
+                               wraps=buildlog.decompress) as decompress:
+            self.assertEquals(self.br.log_tail(), ''.join(lines[-20:]))
+            self.assertTrue(decompress.call_count < 5)
+
+        # The log is still a plain gzip stream
+        self.assertEquals(gzip.open(self.br.logfile()).read(),
+                          ''.join(lines))
+        self.assertEquals(''.join(self.br.iter_log()), ''.join(lines))
+
+    def test_flush_when_idle(self):
+        writer = buildlog.BuildLogWriter(self.br.logfile(), flush_interval=10)
+        writer.write('line 1\n')
+        writer.flush_if_stale()
+        self.assertEquals(self.br.log_tail(), '')
+
+        with mock.patch.object(buildlog.time, 'time',
+                               return_value=time.time() + 10):
+            writer.flush_if_stale()
+        self.assertEquals(self.br.log_tail(), 'line 1\n')
+        writer.close()
+
+    def test_serve_log(self):
+        c = client.Client()
+        self.assertEquals(c.get(self.br.build_log_url()).status_code, 404)
+
+        self._write(['hello\n', 'world\n'])
+        response = c.get(self.br.build_log_url())
+        self.assertEquals(''.join(response.streaming_content),
+                          'hello\nworld\n')
+
+    def test_summary(self):
+        log = textwrap.dedent('''\
+            | Summary |  <- not the summary box
+            +======================================================+
+            | Summary                                              |
+            +======================================================+
+
+            Build-Space: 1024
+            Build-Time: 37
+            Fail-Stage: install-deps
+            Install-Time: n/a
+            Status: failed
+
+            ------------------------------------------------------
+            ''')
+        parser = buildlog.SbuildSummaryParser()
+        for i in range(0, len(log), 7):
+            parser.feed(log[i:i + 7])
+        summary = parser.close()
+        self.assertEquals(summary['Status'], 'failed')
+        self.assertEquals(summary['Fail-Stage'], 'install-deps')
+
+        self.br.record_summary(summary)
+        br = BuildRecord.objects.get(pk=self.br.pk)
+        self.assertEquals((br.build_time, br.build_space, br.install_time),
+                          (37, 1024, None))
+        br.update_state_from_build_log()
+        self.assertEquals(br.state, BuildRecord.DEPENDENCY_WAIT)
+
+    def test_state_from_missing_log(self):
+        self.br.update_state_from_build_log()
+        self.assertEquals(self.br.state, BuildRecord.NEEDS_BUILDING)
+        self.assertEquals(self.br.summary_status, '')
+
+    def test_legacy_log(self):
+        with open(self.br.legacy_logfile(), 'w') as fp:
+            fp.write('old\nlog\n')
+        self.assertEquals(self.br.log_tail(1), 'log\n')
+        self.assertEquals(''.join(self.br.iter_log()), 'old\nlog\n')
+
+        # Built again after the upgrade
+        self._write(['new\n', 'log\n'])
+        self.assertEquals(self.br.log_tail(2), 'new\nlog\n')
+        self.assertEquals(''.join(self.br.iter_log()), 'new\nlog\n')
+
 
 class BuildSchedulerTests(TestCase):
     fixtures = ["test_series.yaml", "test_cloud.yaml"]
 
+    def setUp(self):
+        # The test builds aren't published in the (mock) repository
+        self.prune_patch = mock.patch.object(BuildRecord, 'prune_superseded')
+        self.prune_patch.start()
+
+    def tearDown(self):
+        self.prune_patch.stop()
+
+    def test_prune_superseded(self):
+        current = BuildRecord(series_id=1, architecture_id='i386',
+                              source_package_name='cinder',
+                              version='2012.2.1~+cisco-folsom1260-53')
+        current.save()
+        old = BuildRecord(series_id=1, architecture_id='i386',
+                          source_package_name='cinder',
+                          version='2012.2.1~+cisco-folsom1259-52')
+        old.save()
+
+        with mock.patch('repomgmt.utils.run_cmd',
+                        wraps=utils.run_cmd) as run_cmd:
+            series = Series.objects.get(pk=1)
+            self.assertEquals(series.prune_superseded_builds(), 1)
+            # One snapshot of the series, no matter the number of builds
+            self.assertEquals(run_cmd.call_count, 3)
+
+        self.assertEquals(BuildRecord.objects.get(pk=old.pk).state,
+                          BuildRecord.BUILD_FOR_SUPERSEDED_SOURCE)
+        self.assertEquals(BuildRecord.objects.get(pk=current.pk).state,
+                          BuildRecord.NEEDS_BUILDING)
+
     def test_pending_builds(self):
         self.assertEquals(BuildRecord.pending_build_count(), 0)
 
@@ -174,6 +591,417 @@ class BuildSchedulerTests(TestCase):
         br = BuildRecord.pick_build(bn)
         self.assertEquals(br, br2)
 
+    def test_claim_uses_skip_locked_on_postgres(self):
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name='foo1', version='1.2-2ubuntu2')
+        br.save()
+        bn = BuildNode(name='bn1', cloud_id='test_cloud')
+        bn.save()
+
+        with mock.patch('repomgmt.models.connection') as connection:
+            connection.vendor = 'postgresql'
+            connection.ops.quote_name.side_effect = lambda n: '"%s"' % n
+            cursor = connection.cursor.return_value
+            cursor.fetchone.return_value = tuple(
+                         getattr(br, f.attname) for f in BuildRecord._meta.fields)
+            picker = BuildPicker(architecture=br.architecture)
+            picker.rank()
+            picker.scheduler.load('cisco')
+            # The claim statement is all it takes
+            with self.assertNumQueries(0):
+                claimed = picker.pick(bn)
+            self.assertEquals(claimed, br)
+            self.assertEquals(claimed.source_package_name, 'foo1')
+
+        sql, params = cursor.execute.call_args[0]
+        self.assertIn('FOR UPDATE OF "repomgmt_buildrecord" SKIP LOCKED', sql)
+        # Not just through the build node join, which PostgreSQL doesn't
+        # recheck if the row changes under us
+        self.assertIn('"repomgmt_buildrecord".build_node_id IS NULL', sql)
+        self.assertEquals(params[0], 'bn1')
+        self.assertIn('i386', params)
+
+    def _dep_build(self, name, priority=100, build_depends='', binaries=''):
+        br = BuildRecord(series_id=1, architecture_id='i386', priority=priority,
+                         source_package_name=name, version='1.0',
+                         build_depends=build_depends, binaries=binaries)
+        br.save()
+        return br
+
+    def test_build_depends_order(self):
+        lib = self._dep_build('libfoo', binaries='libfoo1, libfoo-dev')
+        app = self._dep_build('app', priority=500,
+                              build_depends='debhelper, libfoo-dev (>= 1.0)')
+        alt = self._dep_build('alt', priority=400,
+                              build_depends='libfoo-dev | libbar-dev')
+        bn = BuildNode(name='bn1', cloud_id='test_cloud')
+        bn.save()
+
+        # libbar-dev might well be in the archive already
+        self.assertEquals(BuildRecord.blocked_build_ids(
+                              BuildRecord.pending_builds()),
+                          set([app.id]))
+        self.assertEquals(list(BuildRecord.objects.filter(blocked=True)),
+                          [app])
+        self.assertEquals(BuildRecord.pick_build(bn), alt)
+        self.assertEquals(BuildRecord.pick_build(bn), lib)
+        # Still building
+        self.assertEquals(BuildRecord.pick_build(bn), None)
+
+        lib.update_state(BuildRecord.SUCCESFULLY_BUILT)
+        self.assertFalse(BuildRecord.objects.get(pk=app.pk).blocked)
+        self.assertEquals(BuildRecord.pick_build(bn), app)
+
+    def test_deferred_blocked_updates(self):
+        with mock.patch.object(BuildRecord, 'blocked_build_ids',
+                               wraps=BuildRecord.blocked_build_ids
+                               ) as blocked_build_ids:
+            with BuildRecord.deferred_blocked_updates():
+                app = self._dep_build('app', build_depends='libfoo-dev')
+                self._dep_build('libfoo', binaries='libfoo-dev')
+                with BuildRecord.deferred_blocked_updates():
+                    self._dep_build('libbar', binaries='libbar-dev')
+                self.assertFalse(blocked_build_ids.called)
+                self.assertFalse(BuildRecord.objects.get(pk=app.pk).blocked)
+            self.assertEquals(blocked_build_ids.call_count, 1)
+            self.assertTrue(BuildRecord.objects.get(pk=app.pk).blocked)
+
+            # Back to updating straight away
+            self._dep_build('libbaz', binaries='libbaz-dev')
+            self.assertEquals(blocked_build_ids.call_count, 2)
+
+    def test_pick_gives_up_when_everything_is_taken(self):
+        for i in range(3):
+            self._dep_build('foo%d' % i)
+        bn = BuildNode(name='bn1', cloud_id='test_cloud')
+        bn.save()
+
+        # As when every candidate is locked by a concurrent claimer
+        with nested(mock.patch.object(BuildRecord, '_claim_oldest',
+                                      return_value=None),
+                    mock.patch.object(BuildScheduler, 'candidate_rows',
+                                      wraps=BuildScheduler().candidate_rows)
+                    ) as (claim_oldest, candidate_rows):
+            picker = BuildPicker()
+            self.assertIsNone(picker.pick(bn))
+            self.assertEquals(candidate_rows.call_count, 1)
+            # A stale ranking gets one fresh look
+            picker.rankings = {'cisco': [{'series__repository': 'cisco',
+                                          'priority': 100, 'count': 1,
+                                          'oldest': timezone.now()}]}
+            self.assertIsNone(picker.pick(bn))
+            self.assertEquals(candidate_rows.call_count, 2)
+
+    def test_build_depends_cycle(self):
+        a = self._dep_build('a', build_depends='b-dev', binaries='a-dev')
+        b = self._dep_build('b', build_depends='a-dev', binaries='b-dev')
+        c = self._dep_build('c', build_depends='a-dev')
+        blocked = BuildRecord.blocked_build_ids(BuildRecord.pending_builds())
+        self.assertEquals(blocked, set([c.id]))
+        self.assertNotIn(a.id, blocked)
+        self.assertNotIn(b.id, blocked)
+
+    def test_build_depends_arch_qualifiers(self):
+        self._dep_build('libfoo', binaries='libfoo-dev')
+        other_arch = self._dep_build('app',
+                                     build_depends='libfoo-dev [!i386]')
+        this_arch = self._dep_build('app2',
+                                    build_depends='libfoo-dev [amd64 i386]')
+        wildcard = self._dep_build('app3',
+                                   build_depends='libfoo-dev [linux-any]')
+        self.assertEquals(other_arch.build_depends_names(), [])
+        self.assertEquals(BuildRecord.blocked_build_ids(
+                              BuildRecord.pending_builds()),
+                          set([this_arch.id, wildcard.id]))
+
+    @override_settings(BUILD_SLOTS={'test_cloud': {'i386': 2}})
+    def test_dispatch_pass_ranks_once(self):
+        Repository.objects.bulk_create([Repository(name='other')])
+        Series.objects.bulk_create([Series(id=2, name='folsom',
+                                           repository_id='other',
+                                           base_ubuntu_series_id='precise')])
+        for i in range(3):
+            self._dep_build('big%d' % i, priority=500)
+        small = BuildRecord(series_id=2, architecture_id='i386',
+                            source_package_name='small', version='1.0')
+        small.save()
+
+        pickers = {}
+        with nested(mock.patch.object(Cloud, 'client'),
+                    mock.patch.object(BuildScheduler, 'candidate_rows',
+                                      wraps=BuildScheduler().candidate_rows),
+                    mock.patch.object(BuildScheduler, 'usage',
+                                      return_value=0)
+                    ) as (client, candidate_rows, usage):
+            client.servers.list.return_value = []
+            claimed = BuildRecord.dispatch_builds(pickers)
+            self.assertEquals(candidate_rows.call_count, 1)
+            self.assertEquals(usage.call_count, 2)
+
+            # Build nodes finishing a build carry on with the ranking
+            bn, br = claimed[0]
+            BuildNode.objects.filter(pk=bn.pk).update(state=BuildNode.READY)
+            self.assertIsNotNone(bn.next_build(pickers))
+            self.assertEquals(candidate_rows.call_count, 1)
+
+        # The pass still takes turns between the repositories
+        self.assertEquals(len(claimed), 2)
+        self.assertIn(small, [record for node, record in claimed])
+
+    def test_retry_dependency_waits(self):
+        waiting = self._dep_build('app', build_depends='libfoo-dev')
+        waiting.update_state(BuildRecord.DEPENDENCY_WAIT)
+        other = self._dep_build('other', build_depends='libbar-dev')
+        other.update_state(BuildRecord.DEPENDENCY_WAIT)
+
+        BuildRecord.retry_dependency_waits(waiting.series,
+                                           waiting.architecture,
+                                           ['libfoo1', 'libfoo-dev'])
+        self.assertEquals(BuildRecord.objects.get(pk=waiting.pk).state,
+                          BuildRecord.NEEDS_BUILDING)
+        self.assertEquals(BuildRecord.objects.get(pk=other.pk).state,
+                          BuildRecord.DEPENDENCY_WAIT)
+
+    def test_fair_share_simulation(self):
+        # Repository "cisco" dumps 100 builds in the queue at once, while
+        # "other" uploads a build every 10 minutes. Two build nodes each
+        # take 5 minutes per build.
+        Repository.objects.bulk_create([Repository(name='other')])
+        Series.objects.bulk_create([Series(id=2, name='folsom',
+                                           repository_id='other',
+                                           base_ubuntu_series_id='precise')])
+        start = timezone.now()
+
+        def queue_build(series_id, name, now):
+            br = BuildRecord(series_id=series_id, architecture_id='i386',
+                             source_package_name=name, version='1.0')
+            br.save()
+            BuildRecord.objects.filter(pk=br.pk).update(created=now)
+
+        for i in range(100):
+            queue_build(1, 'big%d' % i, start)
+
+        nodes = []
+        for i in range(2):
+            bn = BuildNode(name='bn%d' % i, cloud_id='test_cloud')
+            bn.save()
+            nodes.append(bn)
+
+        running = {}
+        waits = []
+        with mock.patch('repomgmt.models.timezone') as tz:
+            for minute in range(300):
+                now = start + datetime.timedelta(minutes=minute)
+                tz.now.return_value = now
+                if minute % 10 == 0 and minute < 200:
+                    queue_build(2, 'small%d' % minute, now)
+
+                for bn, (br, end) in running.items():
+                    if end <= minute:
+                        BuildRecord.objects.filter(pk=br.pk).update(
+                                  state=BuildRecord.SUCCESFULLY_BUILT,
+                                  finished=now, build_node=None)
+                        del running[bn]
+
+                for bn in nodes:
+                    if bn in running:
+                        continue
+                    br = BuildRecord.pick_build(bn)
+                    if br is None:
+                        continue
+                    br.update_state(BuildRecord.BUILDING)
+                    running[bn] = (br, minute + 5)
+                    if br.series_id == 2:
+                        waits.append(now - br.created)
+
+        # Every small upload got built within one build's time of being
+        # uploaded, rather than waiting for the batch ahead of it...
+        self.assertEquals(len(waits), 20)
+        self.assertTrue(max(waits) <= datetime.timedelta(minutes=5))
+        # ...and the batch still got through.
+        self.assertEquals(BuildRecord.pending_build_count(), 0)
+
+    @override_settings(BUILD_SLOTS={'test_cloud': {'i386': 2}})
+    def test_dispatch_fills_free_slots(self):
+        for i in range(3):
+            BuildRecord(series_id=1, architecture_id='i386', priority=100,
+                        source_package_name='foo%d' % i,
+                        version='1.2-2ubuntu2').save()
+
+        with mock.patch.object(Cloud, 'client') as client:
+            client.servers.list.return_value = []
+            claimed = BuildRecord.dispatch_builds()
+            self.assertEquals(len(claimed), 2)
+            self.assertEquals(BuildNode.objects.count(), 2)
+            # The names of both nodes came from one look at the cloud,
+            # taken before locking the cloud and the queue
+            self.assertEquals(client.servers.list.call_count, 1)
+            self.assertEquals(BuildRecord.pending_build_count(), 1)
+
+            for bn, br in claimed:
+                self.assertEquals(br.build_node, bn)
+                self.assertEquals(bn.architecture_id, 'i386')
+
+            # All slots are taken, so nothing more gets dispatched
+            self.assertEquals(BuildRecord.dispatch_builds(), [])
+
+    @override_settings(BUILD_SLOTS={'test_cloud': {'i386': 5}})
+    def test_queue_capacity_and_flavor(self):
+        for i in range(3):
+            BuildRecord(series_id=1, architecture_id='i386', priority=100,
+                        source_package_name='foo%d' % i,
+                        version='1.2-2ubuntu2').save()
+        BuildQueue(ubuntu_series_id='precise', architecture_id='i386',
+                   flavor_name='m1.large', capacity=1).save()
+
+        queue = BuildQueue.for_chroot(UbuntuSeries.objects.get(pk='precise'),
+                                      Architecture.objects.get(pk='i386'))
+        self.assertEquals(queue.depth(), 3)
+        self.assertTrue(queue.oldest_wait() >= datetime.timedelta(0))
+
+        lock = BuildQueue.objects.select_for_update
+        with nested(mock.patch.object(Cloud, 'client'),
+                    mock.patch.object(BuildQueue.objects, 'select_for_update',
+                                      wraps=lock)
+                    ) as (cloud_client, select_for_update):
+            cloud_client.servers.list.return_value = []
+            claimed = BuildRecord.dispatch_builds()
+            self.assertEquals(len(claimed), 1)
+            # The capacity check holds the queue's lock
+            select_for_update.assert_called_once_with()
+            self.assertEquals(queue.free_capacity(), 0)
+            self.assertEquals(claimed[0][0].flavor_name(), 'm1.large')
+
+        response = client.Client().get('/builders/')
+        self.assertContains(response, 'precise-i386')
+        self.assertContains(response, '1 of 1')
+
+
+class BuildNodePoolTests(TestCase):
+    fixtures = ["test_series.yaml", "test_cloud.yaml", "test_keypair.yaml"]
+
+    def _create_idle_node(self, **kwargs):
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud',
+                       cloud_node_id='abc', architecture_id='i386',
+                       ubuntu_series_id='precise', state=BuildNode.READY,
+                       **kwargs)
+        bn.save()
+        return bn
+
+    def test_idle_node_gets_matching_build(self):
+        bn = self._create_idle_node()
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name='foo', version='1.0')
+        br.save()
+
+        self.assertEquals(bn.next_build(), br)
+        self.assertEquals(BuildNode.objects.get(pk=bn.pk).state,
+                          BuildNode.BUILDING)
+        self.assertEquals(BuildRecord.objects.get(pk=br.pk).build_node, bn)
+
+        # The node is busy now, so it can't be handed another build
+        self.assertIsNone(bn.next_build())
+
+    def test_idle_node_ignores_other_architectures(self):
+        bn = self._create_idle_node()
+        BuildRecord(series_id=1, architecture_id='amd64',
+                    source_package_name='foo', version='1.0').save()
+
+        self.assertIsNone(bn.next_build())
+        self.assertEquals(BuildNode.objects.get(pk=bn.pk).state,
+                          BuildNode.READY)
+
+    @override_settings(BUILD_NODE_MAX_BUILDS=3)
+    def test_node_retired_after_max_builds(self):
+        bn = self._create_idle_node(builds_completed=2)
+        bn.state = BuildNode.BUILDING
+        with mock.patch.object(BuildNode, 'delete') as delete:
+            bn.release()
+            delete.assert_called_with()
+        self.assertEquals(BuildNode.objects.get(pk=bn.pk).state,
+                          BuildNode.SHUTTING_DOWN)
+
+    def test_boot_from_baked_image(self):
+        UbuntuSeries(name='precise').save()
+        tb = ChrootTarball(series_id='precise', architecture_id='i386')
+        tb.save()
+        BuildNodeImage(cloud_id='test_cloud', tarball=tb,
+                       image_id='img-1').save()
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud',
+                       architecture_id='i386', ubuntu_series_id='precise')
+        bn.save()
+
+        with mock.patch.object(Cloud, 'client') as client:
+            client.servers.create.return_value.id = 'srv-1'
+            bn.boot()
+            client.images.get.assert_called_with('img-1')
+            self.assertEquals(client.servers.create.call_args[0][1],
+                              client.images.get.return_value)
+        self.assertEquals(bn.image.image_id, 'img-1')
+
+    @override_settings(BUILD_NODE_POOL_MIN=1, DEFAULT_BUILD_SLOTS=1)
+    def test_baking_node_takes_no_slot(self):
+        UbuntuSeries(name='precise').save()
+        tb = ChrootTarball(series_id='precise', architecture_id='i386',
+                           state=ChrootTarball.READY)
+        tb.save()
+        queue = BuildQueue.for_chroot(tb.series, tb.architecture)
+        queue.capacity = 1
+        queue.save()
+        cloud = Cloud.objects.get(pk='test_cloud')
+
+        def bake_step(*args, **kwargs):
+            self.assertEquals(BuildNode.objects.get().state,
+                              BuildNode.BAKING)
+            self.assertEquals(cloud.free_build_slots(tb.architecture), 1)
+            self.assertEquals(queue.free_capacity(), 1)
+            with mock.patch.object(BuildNode, 'get_unique_buildnode_name',
+                                   return_value='buildd-2'):
+                self.assertEquals(len(BuildNode.maintain_pool()), 1)
+
+        with nested(mock.patch.object(Cloud, 'client'),
+                    mock.patch.object(BuildNode, 'get_unique_buildnode_name',
+                                      return_value='buildd-1'),
+                    mock.patch.object(BuildNode, 'boot',
+                                      side_effect=bake_step),
+                    mock.patch.object(BuildNode, 'wait_until_reachable'),
+                    mock.patch.object(BuildNode,
+                                      'install_build_infrastructure'),
+                    mock.patch.object(BuildNode, '_run_cmd'),
+                    mock.patch.object(BuildNode, 'snapshot',
+                                      return_value='img-1')) as mocks:
+            BuildNodeImage.bake(cloud, tb)
+        self.assertTrue(mocks[2].called)
+        self.assertEquals([bn.name for bn in BuildNode.objects.all()],
+                          ['buildd-2'])
+
+    def test_refresh_invalidates_baked_images(self):
+        UbuntuSeries(name='precise').save()
+        tb = ChrootTarball(series_id='precise', architecture_id='i386')
+        tb.save()
+        BuildNodeImage(cloud_id='test_cloud', tarball=tb,
+                       image_id='img-1').save()
+        bn = self._create_idle_node()
+
+        with mock.patch.object(Cloud, 'client') as client:
+            with mock.patch.object(BuildNode, 'delete') as delete:
+                tb.invalidate_build_nodes()
+                client.images.delete.assert_called_with('img-1')
+                delete.assert_called_with()
+        self.assertEquals(BuildNodeImage.objects.count(), 0)
+        self.assertEquals(BuildNode.objects.get(pk=bn.pk).state,
+                          BuildNode.SHUTTING_DOWN)
+
+    @override_settings(BUILD_NODE_POOL_MIN=0, BUILD_NODE_IDLE_TIMEOUT=60)
+    def test_maintain_pool_evicts_idle_nodes(self):
+        bn = self._create_idle_node(last_used=timezone.now() -
+                                              datetime.timedelta(hours=1))
+        with mock.patch.object(BuildNode, 'delete') as delete:
+            self.assertEquals(BuildNode.maintain_pool(), [])
+            delete.assert_called_with()
+        self.assertEquals(BuildNode.objects.get(pk=bn.pk).state,
+                          BuildNode.SHUTTING_DOWN)
+
 
 class SeriesTests(TestCase):
     fixtures = ['test_series.yaml']
@@ -203,6 +1031,426 @@ class SeriesTests(TestCase):
             run_cmd.assert_has_calls(calls, any_order=True)
             self.assertEquals(len(pkg_list), 3)
 
+            # From here on, the index in the database is used
+            run_cmd.reset_mock()
+            series = Series.objects.get(name='folsom')
+            self.assertEquals(
+                   series.get_source_packages()['proposed']['cinder'],
+                   '2012.2.1~+cisco-folsom1260-53')
+            self.assertFalse(run_cmd.called)
+
+    def test_record_published_source(self):
+        series = Series.objects.get(name='folsom')
+        series.reconcile_published_sources()
+
+        def hook(*args):
+            call_command('repo-record-published-source', *args,
+                         repository='cisco')
+
+        hook('add', 'folsom', 'dsc', 'main', 'source', 'nova', '1.0',
+             'nova_1.0.dsc')
+        self.assertTrue(series.is_published('nova', '1.0'))
+
+        hook('replace', 'folsom-proposed', 'dsc', 'main', 'source', 'cinder',
+             '2.0', '2012.2.1~+cisco-folsom1260-53', 'cinder_2.0.dsc')
+        self.assertEquals(series.get_source_packages()['proposed'],
+                          {'cinder': '2.0'})
+
+        hook('remove', 'folsom', 'dsc', 'main', 'source', 'nova', '1.0',
+             'nova_1.0.dsc')
+        self.assertFalse(series.is_published('nova', '1.0'))
+
+    def test_first_read_after_concurrent_reconcile(self):
+        series = Series.objects.get(name='folsom')
+        # Someone else got there between loading the series and reading
+        Series.objects.get(name='folsom').reconcile_published_sources()
+        self.assertIsNone(series.published_sources_synced)
+
+        with nested(mock.patch.object(Series, 'list_source_packages'),
+                    mock.patch.object(Series.objects, 'select_for_update',
+                                      wraps=Series.objects.select_for_update)
+                    ) as (list_source_packages, select_for_update):
+            self.assertTrue(series.published_sources().exists())
+            self.assertFalse(list_source_packages.called)
+            select_for_update.assert_called_once_with()
+        self.assertIsNotNone(series.published_sources_synced)
+
+
+class HookServerTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def _request(self, server, command, args, env={}):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        request = hookclient.build_request(command, args, env)
+        ours.sendall(json.dumps(request))
+        ours.shutdown(socket.SHUT_WR)
+        server.handle(theirs)
+        return ours
+
+    def _replied(self, sock):
+        return bool(select.select([sock], [], [], 0)[0])
+
+    def _reply(self, sock):
+        return json.loads(sock.recv(65536))
+
+    def _call(self, server, command, args, env={}):
+        sock = self._request(server, command, args, env)
+        server.commit()
+        return self._reply(sock)
+
+    @override_settings(BASE_REPO_DIR='/base/repo/dir')
+    def test_runs_hook_command(self):
+        series = Series.objects.get(name='folsom')
+        series.reconcile_published_sources()
+        server = HookServer('/nonexistent')
+        env = {'REPREPRO_BASE_DIR': '/base/repo/dir/cisco',
+               'PATH': '/not/forwarded'}
+        sock = self._request(server, 'repo-record-published-source',
+                             ['add', 'folsom', 'dsc', 'main', 'source',
+                              'nova', '1.0', 'nova_1.0.dsc'], env)
+        self.assertTrue(series.is_published('nova', '1.0'))
+        self.assertEquals(server.uncommitted, 1)
+        self.assertNotIn('REPREPRO_BASE_DIR', os.environ)
+
+        # No reply until the event has been committed, and the blocked
+        # builds are worked out just before that
+        self.assertFalse(self._replied(sock))
+        calls = mock.Mock()
+        with nested(mock.patch('django.db.transaction.commit',
+                               calls.commit),
+                    mock.patch.object(BuildRecord, 'flush_blocked_updates',
+                                      calls.flush_blocked_updates)):
+            calls.commit.side_effect = (
+                    lambda: self.assertFalse(self._replied(sock)))
+            server.commit()
+        self.assertEquals(calls.method_calls,
+                          [mock.call.flush_blocked_updates(),
+                           mock.call.commit()])
+        self.assertEquals(self._reply(sock)['status'], 0)
+        self.assertEquals(server.uncommitted, 0)
+
+    @override_settings(BASE_REPO_DIR='/base/repo/dir')
+    def test_failed_commit_fails_the_batch(self):
+        Series.objects.get(name='folsom').reconcile_published_sources()
+        server = HookServer('/nonexistent')
+        sock = self._request(server, 'repo-record-published-source',
+                             ['add', 'folsom', 'dsc', 'main', 'source',
+                              'nova', '1.0', 'nova_1.0.dsc'],
+                             {'REPREPRO_BASE_DIR': '/base/repo/dir/cisco'})
+        with nested(mock.patch('django.db.transaction.commit',
+                               side_effect=Exception('disk full')),
+                    mock.patch('django.db.transaction.rollback')
+                    ) as (commit, rollback):
+            server.commit()
+        rollback.assert_called_once_with()
+        reply = self._reply(sock)
+        self.assertEquals(reply['status'], 1)
+        self.assertIn('disk full', reply['output'])
+        self.assertEquals(server.replies, [])
+
+    @override_settings(BASE_REPO_DIR='/base/repo/dir')
+    def test_batches_with_savepoints(self):
+        Series.objects.get(name='folsom').reconcile_published_sources()
+        server = HookServer('/nonexistent')
+        env = {'REPREPRO_BASE_DIR': '/base/repo/dir/cisco'}
+        args = ['add', 'folsom', 'dsc', 'main', 'source', 'nova', '1.0',
+                'nova_1.0.dsc']
+        with nested(mock.patch('django.db.transaction.commit'),
+                    mock.patch('django.db.transaction.savepoint',
+                               side_effect=['s1', 's2', 's3']),
+                    mock.patch('django.db.transaction.savepoint_commit'),
+                    mock.patch('django.db.transaction.savepoint_rollback')
+                    ) as (commit, savepoint, savepoint_commit,
+                          savepoint_rollback):
+            transaction.set_dirty()
+            socks = [self._request(server, 'repo-record-published-source',
+                                   args, env),
+                     self._request(server, 'repo-record-published-source',
+                                   ['add', 'nonexistent'] + args[2:], env)]
+
+            # The hook commands leave committing to the server
+            self.assertFalse(commit.called)
+            savepoint_commit.assert_called_once_with('s1')
+            savepoint_rollback.assert_called_once_with('s2')
+            self.assertEquals(server.uncommitted, 2)
+            self.assertEquals([reply['status']
+                               for conn, reply in server.replies], [0, 1])
+
+            # If a savepoint goes missing anyway, start over rather
+            # than die. The events before it got rolled back too.
+            savepoint_commit.side_effect = Exception('no such savepoint')
+            with mock.patch('django.db.transaction.rollback') as rollback:
+                socks.append(self._request(server,
+                                           'repo-record-published-source',
+                                           args, env))
+            rollback.assert_called_once_with()
+            self.assertEquals(server.uncommitted, 0)
+
+            server.commit()
+            self.assertFalse(commit.called)
+            self.assertEquals([self._reply(sock)['status']
+                               for sock in socks], [1, 1, 1])
+
+    @override_settings(HOOK_CLIENT_TIMEOUT=0.1)
+    def test_client_timeout(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        ours.sendall('{"command": ')
+        self.assertRaises(socket.timeout, HookServer('/nonexistent').handle,
+                          theirs)
+
+    def test_refuses_other_commands(self):
+        server = HookServer('/nonexistent')
+        reply = self._call(server, 'flush', ['--noinput'])
+        self.assertEquals(reply['status'], 1)
+        self.assertIn('Unknown hook command', reply['output'])
+        self.assertEquals(server.uncommitted, 0)
+
+    def test_client_without_server(self):
+        path = os.path.join(tempfile.mkdtemp(), 'hooks.sock')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.assertEquals(hookclient.main(['hookclient.py', path,
+                                           'repo-process-changes']),
+                          hookclient.UNAVAILABLE)
+
+    def test_serve_forever_replies_without_waiting_for_more(self):
+        path = os.path.join(tempfile.mkdtemp(), 'hooks.sock')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        replies = []
+        client = threading.Thread(
+                target=lambda: replies.append(hookclient.main(
+                                   ['hookclient.py', path, 'flush'])))
+        real_select = select.select
+
+        class Stop(Exception):
+            pass
+
+        def fake_select(r, w, x, timeout=None):
+            # reprepro sends its next event only once it has the reply
+            # to this one, so a second wait for a client ends the test
+            if timeout is None and client.ident:
+                client.join(5)
+                raise Stop()
+            if timeout is None:
+                client.start()
+                timeout = 5
+            return real_select(r, w, x, timeout)
+
+        server = HookServer(path)
+        with nested(mock.patch('select.select', fake_select),
+                    mock.patch.object(connection.features, 'uses_savepoints',
+                                      True),
+                    mock.patch('sys.stderr', StringIO())):
+            self.assertRaises(Stop, server.serve_forever)
+        self.assertEquals(replies, [1])
+        self.assertFalse(os.path.exists(path))
+
+
+class IncomingTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basedir)
+        self.incomingdir = os.path.join(self.basedir, 'incoming', 'cisco')
+        os.makedirs(self.incomingdir)
+        os.makedirs(os.path.join(self.basedir, 'repo', 'cisco', 'db'))
+        self.dirs = dict(BASE_INCOMING_DIR=self.basedir + '/incoming',
+                         BASE_REPO_DIR=self.basedir + '/repo')
+
+    def _upload(self, name, contents):
+        with open(os.path.join(self.incomingdir, name), 'w') as fp:
+            fp.write(contents)
+
+    def _upload_changes(self):
+        self._upload('nova_1.0_source.changes', textwrap.dedent('''\
+            Source: nova
+            Version: 1.0
+            Files:
+             0123456789abcdef0123456789abcdef 6 net optional nova_1.0.dsc
+             0123456789abcdef0123456789abcdef 11 net optional nova_1.0.tar.gz
+            '''))
+
+    def test_complete_uploads(self):
+        with self.settings(**self.dirs):
+            repo = Repository.objects.get(name='cisco')
+            self.assertEquals(repo.complete_uploads(), [])
+
+            self._upload_changes()
+            self._upload('nova_1.0.dsc', 'dsc...')
+            self.assertEquals(repo.complete_uploads(), [])
+
+            self._upload('nova_1.0.tar.gz', 'tarball')
+            self.assertEquals(repo.complete_uploads(), [])
+
+            self._upload('nova_1.0.tar.gz', 'tarball....')
+            self.assertEquals(repo.complete_uploads(),
+                              [os.path.join(self.incomingdir,
+                                            'nova_1.0_source.changes')])
+
+    def test_watcher_waits_for_uploads_to_settle(self):
+        with nested(self.settings(INCOMING_SETTLE_TIME=2, **self.dirs),
+                    mock.patch.object(Repository,
+                                      'process_incoming')) as (_, process):
+            watcher = IncomingWatcher()
+            watcher.process_settled(now=1000)
+            self.assertFalse(process.called)
+
+            self._upload_changes()
+            self._upload('nova_1.0.dsc', 'dsc...')
+            self._upload('nova_1.0.tar.gz', 'tarball....')
+            watcher.scan(now=1010)
+            self.assertEquals(watcher.process_settled(now=1011), [])
+
+            watcher.scan(now=1011)
+            self.assertEquals([r.name for r in
+                               watcher.process_settled(now=1012)], ['cisco'])
+            process.assert_called_once_with()
+
+    def test_sweep_only_processes_complete_uploads(self):
+        with nested(self.settings(**self.dirs),
+                    mock.patch.object(Repository,
+                                      'process_incoming')) as (_, process):
+            tasks.process_incoming()
+            self.assertFalse(process.called)
+
+            self._upload_changes()
+            self._upload('nova_1.0.dsc', 'dsc...')
+            self._upload('nova_1.0.tar.gz', 'tarball....')
+            tasks.process_incoming()
+            process.assert_called_once_with()
+
+    def _upload_complete(self):
+        self._upload_changes()
+        self._upload('nova_1.0.dsc', 'dsc...')
+        self._upload('nova_1.0.tar.gz', 'tarball....')
+
+    def test_one_run_per_repository(self):
+        self._upload_complete()
+        with nested(self.settings(**self.dirs),
+                    mock.patch('repomgmt.utils.run_cmd')) as (_, run_cmd):
+            repo = Repository.objects.get(name='cisco')
+            with utils.file_lock(repo.incoming_lockfile) as locked:
+                self.assertTrue(locked)
+                self.assertFalse(
+                        tasks.process_repository_incoming('cisco'))
+            self.assertFalse(run_cmd.called)
+
+            # Don't queue up behind reprepro's own lock either
+            open(repo.reprepro_lockfile, 'w').close()
+            self.assertFalse(tasks.process_repository_incoming('cisco'))
+            self.assertFalse(run_cmd.called)
+
+            os.unlink(repo.reprepro_lockfile)
+
+            def processincoming(cmd):
+                # Like reprepro, get rid of the uploads once processed
+                for path in glob.glob(os.path.join(repo.reprepro_incomingdir,
+                                                   '*.changes')):
+                    os.unlink(path)
+            run_cmd.side_effect = processincoming
+            self.assertTrue(tasks.process_repository_incoming('cisco'))
+            run_cmd.assert_called_once_with(['reprepro', '-b', repo.reprepro_dir,
+                                             'processincoming', 'incoming'])
+
+        repo = Repository.objects.get(name='cisco')
+        self.assertIsNotNone(repo.incoming_processed)
+        self.assertGreaterEqual(repo.incoming_duration, 0)
+        self.assertGreaterEqual(repo.incoming_latency, 0)
+
+
+class WriteConfigurationTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def setUp(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        settings = self.settings(BASE_REPO_DIR=basedir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_only_changed_distributions_get_exported(self):
+        repo = Repository.objects.get(name='cisco')
+        path = '%s/conf/distributions' % (repo.reprepro_dir,)
+        with mock.patch.object(Repository, '_reprepro') as reprepro:
+            repo.write_configuration()
+            reprepro.assert_called_once_with('export', 'folsom',
+                                             'folsom-proposed',
+                                             'folsom-queued')
+            inode = os.stat(path).st_ino
+
+            reprepro.reset_mock()
+            repo.write_configuration()
+            self.assertFalse(reprepro.called)
+            self.assertEquals(os.stat(path).st_ino, inode)
+
+            reprepro.reset_mock()
+            Series(name='grizzly', repository=repo, numerical_version='13.04',
+                   base_ubuntu_series_id='precise').save()
+            reprepro.assert_called_once_with('export', 'grizzly',
+                                             'grizzly-proposed',
+                                             'grizzly-queued')
+            self.assertNotEquals(os.stat(path).st_ino, inode)
+
+            reprepro.reset_mock()
+            repo.write_configuration(force=True)
+            reprepro.assert_called_once_with('export', 'folsom',
+                                             'folsom-proposed',
+                                             'folsom-queued', 'grizzly',
+                                             'grizzly-proposed',
+                                             'grizzly-queued')
+
+    def test_failed_export_is_retried(self):
+        repo = Repository.objects.get(name='cisco')
+        with mock.patch.object(Repository, '_reprepro') as reprepro:
+            reprepro.side_effect = CommandFailed('export failed', [], 255,
+                                                 '', '')
+            self.assertRaises(CommandFailed, repo.write_configuration)
+
+            # The distributions file is up to date now, but the export
+            # still needs doing
+            reprepro.side_effect = None
+            repo.write_configuration()
+            reprepro.assert_called_with('export', 'folsom',
+                                        'folsom-proposed', 'folsom-queued')
+
+            reprepro.reset_mock()
+            repo.write_configuration()
+            self.assertFalse(reprepro.called)
+
+    def test_fixed_number_of_queries(self):
+        repo = Repository.objects.get(name='cisco')
+        for i in range(3):
+            user = User.objects.create(username='uploader%d' % (i,))
+            repo.uploaders.add(user)
+            UploaderKey.objects.bulk_create(
+                    [UploaderKey(key_id='K%d%d' % (i, j), uploader=user)
+                     for j in range(2)])
+        BuildNode.objects.bulk_create(
+                [BuildNode(name='node%d' % (i,), cloud_id=1,
+                           signing_key_id='B%d' % (i,)) for i in range(3)])
+        BuildRecord.objects.bulk_create(
+                [BuildRecord(series_id=1, architecture_id='amd64',
+                             source_package_name='nova', version='1.%d' % (i,),
+                             build_node_id='node%d' % (i % 3,))
+                 for i in range(6)])
+
+        with mock.patch.object(Repository, '_reprepro'):
+            # Series, uploader keys, builder keys and architectures
+            with self.assertNumQueries(4):
+                repo.write_configuration()
+
+        with open('%s/conf/uploaders' % (repo.reprepro_dir,)) as fp:
+            uploaders = fp.read()
+        for key_id in ['K00', 'K01', 'K10', 'K11', 'K20', 'K21']:
+            self.assertIn('group uploaders add %s+\n' % (key_id,), uploaders)
+        for key_id in ['B0', 'B1', 'B2']:
+            self.assertEquals(uploaders.count('group builders add %s\n' %
+                                              (key_id,)), 1)
+
+
 class RepositoryTests(TestCase):
     def test_repository_unicode(self):
         repo = Repository(name='foo')
@@ -417,6 +1665,314 @@ class PermissionsTests(TestCase):
         self.assertTrue(pkg_src.can_modify(self.user3), 'User3 cannot modify repository')
         self.assertTrue(pkg_src.can_modify(self.superuser), 'Super user cannot modify repository')
 
+class SourceBuildTests(TestCase):
+    def setUp(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        settings = self.settings(LOCK_DIR=lock_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.pkg_src = PackageSource(name='nova', code_url='git://foo/nova',
+                                     packaging_url='git://foo/nova-pkg',
+                                     last_seen_code_rev='code1',
+                                     last_seen_pkg_rev='pkg1')
+        self.pkg_src.save()
+
+    def test_polling_queues_builds(self):
+        revisions = {'git://foo/nova': 'code2', 'git://foo/nova-pkg': 'pkg1'}
+        with nested(mock.patch.object(PackageSource, 'lookup_revision',
+                                      side_effect=lambda url, *args:
+                                                  revisions[url]),
+                    mock.patch.object(tasks.build_source_package,
+                                      'delay')) as (_, delay):
+            tasks.poll_upstreams()
+            delay.assert_called_once_with(self.pkg_src.id, 'code2', 'pkg1',
+                                          mock.ANY)
+
+            # Until the build is done, it's still considered changed
+            delay.reset_mock()
+            PackageSource.objects.update(next_poll=None)
+            tasks.poll_upstreams()
+            self.assertEquals(delay.call_count, 1)
+
+    def test_poll_cycle(self):
+        PackageSource(name='glance', code_url='git://foo/glance',
+                      packaging_url='git://foo/glance-pkg',
+                      last_seen_code_rev='code1',
+                      last_seen_pkg_rev='pkg1').save()
+        PackageSource(name='swift', code_url='git://foo/swift',
+                      packaging_url='git://foo/swift-pkg').save()
+
+        def lookup_revision(url, timeout, cache):
+            self.assertEquals(timeout, 30)
+            if 'swift' in url:
+                raise CommandTimedOut('timed out', [], -9, '', '')
+            if url.endswith('-pkg'):
+                return 'pkg1'
+            return {'git://foo/nova': 'code2'}.get(url, 'code1')
+
+        with nested(self.settings(POLL_WORKERS=2, POLL_TIMEOUT=30),
+                    mock.patch.object(PackageSource, 'lookup_revision',
+                                      side_effect=lookup_revision),
+                    mock.patch.object(tasks.build_source_package,
+                                      'delay')) as (_, __, delay):
+            cycle = PollCycle.objects.get(id=tasks.poll_upstreams())
+            delay.assert_called_once_with(self.pkg_src.id, 'code2', 'pkg1',
+                                          mock.ANY)
+
+        self.assertEquals((cycle.sources, cycle.changed, cycle.failures),
+                          (3, 1, 1))
+        self.assertIn('swift', cycle.failed_sources)
+        self.assertGreaterEqual(cycle.duration, 0)
+        self.assertEquals(PollCycle.latest(), cycle)
+
+    def test_poll_cycles_do_not_overlap(self):
+        with nested(utils.file_lock(utils.lock_path('poll-upstreams')),
+                    mock.patch.object(PackageSource,
+                                      'detect_changes')) as (_, detect):
+            self.assertIsNone(tasks.poll_upstreams())
+        self.assertFalse(detect.called)
+        self.assertEquals(PollCycle.objects.count(), 0)
+
+    @override_settings(TESTING=False)
+    def test_run_cmd_timeout(self):
+        self.assertRaises(CommandTimedOut, utils.run_cmd, ['sleep', '10'],
+                          timeout=0.1)
+        self.assertEquals(utils.run_cmd(['echo', 'hi'], timeout=10), 'hi\n')
+
+    @override_settings(TESTING=False)
+    def test_run_cmd_timeout_kills_grandchildren(self):
+        # The sleep holds on to stdout even once the shell is gone
+        start = datetime.datetime.now()
+        self.assertRaises(CommandTimedOut, utils.run_cmd,
+                          ['sh', '-c', 'sleep 5 | cat; true'], timeout=0.5)
+        self.assertTrue(datetime.datetime.now() - start <
+                        datetime.timedelta(seconds=3))
+
+    @override_settings(POLL_INTERVAL_MIN=120, POLL_INTERVAL_MAX=1000,
+                       POLL_BACKOFF_FACTOR=2)
+    def test_poll_backoff(self):
+        now = timezone.now()
+        intervals = []
+        for changed in [False, False, False, True, False, False, False]:
+            self.pkg_src.schedule_next_poll(changed, now)
+            intervals.append(self.pkg_src.poll_interval)
+        self.assertEquals(intervals, [120, 240, 480, 120, 240, 480, 960])
+
+        pkg_src = PackageSource.objects.get(pk=self.pkg_src.pk)
+        self.assertEquals(pkg_src.next_poll,
+                          now + datetime.timedelta(seconds=960))
+
+        self.pkg_src.schedule_next_poll(False, now)
+        self.assertEquals(self.pkg_src.poll_interval, 1000)
+
+        # Recent changes keep it polled often
+        self.pkg_src.last_changed = now - datetime.timedelta(seconds=800)
+        self.pkg_src.schedule_next_poll(False, now)
+        self.assertEquals(self.pkg_src.poll_interval, 200)
+
+        self.pkg_src.poll_interval_override = 60
+        self.pkg_src.schedule_next_poll(False, now)
+        self.assertEquals(self.pkg_src.poll_interval, 60)
+
+    def test_only_due_sources_get_polled(self):
+        later = timezone.now() + datetime.timedelta(hours=1)
+        PackageSource(name='glance', code_url='git://foo/glance',
+                      packaging_url='git://foo/glance-pkg',
+                      next_poll=later).save()
+
+        with mock.patch.object(PackageSource, 'detect_changes',
+                               return_value=None) as detect_changes:
+            cycle = PollCycle.objects.get(id=tasks.poll_upstreams())
+            self.assertEquals(detect_changes.call_count, 1)
+            self.assertEquals(cycle.sources, 1)
+
+            tasks.poll_upstreams()
+            self.assertEquals(detect_changes.call_count, 1)
+
+        self.assertTrue(PackageSource.objects.get(pk=self.pkg_src.pk)
+                                             .next_poll > timezone.now())
+
+    def test_poll_single_source(self):
+        with nested(mock.patch.object(PackageSource, 'detect_changes',
+                                      return_value=('code2', 'pkg1')),
+                    mock.patch.object(tasks.build_source_package,
+                                      'delay')) as (_, delay):
+            self.assertTrue(tasks.poll_package_source(self.pkg_src.id))
+            delay.assert_called_once_with(self.pkg_src.id, 'code2', 'pkg1',
+                                          mock.ANY)
+        self.assertIsNotNone(PackageSource.objects.get(pk=self.pkg_src.id)
+                                                  .next_poll)
+
+    def test_revision_lookup_cache(self):
+        ls_remote = ('1111\tHEAD\n'
+                     '1111\trefs/heads/master\n'
+                     '2222\trefs/heads/stable/folsom\n'
+                     '3333\trefs/tags/2012.2\n')
+        with mock.patch('repomgmt.utils.run_cmd') as run_cmd:
+            run_cmd.return_value = ls_remote
+            cache = RevisionLookupCache(timeout=30)
+            self.assertEquals(cache.lookup('git://foo/nova'), '1111')
+            self.assertEquals(cache.lookup('git://foo/nova#stable/folsom'),
+                              '2222')
+            self.assertEquals(cache.lookup('git://foo/nova#folsom'), '2222')
+            self.assertEquals(cache.lookup('git://foo/nova#2012.2'), '3333')
+            self.assertEquals(cache.lookup('git://foo/nova#grizzly'), '')
+            run_cmd.assert_called_once_with(['git', 'ls-remote',
+                                             'git://foo/nova'], timeout=30)
+
+            run_cmd.reset_mock()
+            run_cmd.return_value = '42 foo@bar-123\n'
+            for i in range(2):
+                self.assertEquals(
+                        cache.lookup('http://bazaar.launchpad.net/~foo/bar'),
+                        'foo@bar-123')
+            self.assertEquals(run_cmd.call_count, 1)
+
+            run_cmd.reset_mock()
+            run_cmd.side_effect = CommandTimedOut('timed out', [], -9, '', '')
+            for i in range(2):
+                self.assertRaises(CommandTimedOut, cache.lookup,
+                                  'git://foo/unreachable')
+            self.assertEquals(run_cmd.call_count, 1)
+
+    def test_one_build_per_source_at_a_time(self):
+        lock = utils.lock_path('source-build-%d' % (self.pkg_src.id,))
+        with mock.patch.object(PackageSource.OpenStackPackageBuilder,
+                               'build') as build:
+            with utils.file_lock(lock):
+                self.assertFalse(tasks.build_source_package(
+                                         self.pkg_src.id, 'code2', 'pkg1'))
+            self.assertFalse(build.called)
+
+            with nested(self.settings(SOURCE_BUILD_CONCURRENCY=1,
+                                      SOURCE_BUILD_RETRY_DELAY=30),
+                        mock.patch.object(tasks.build_source_package,
+                                          'apply_async')) as (_, apply_async):
+                # Busy build slots only postpone the build
+                with utils.slot_lock('source-build', 1):
+                    self.assertFalse(tasks.build_source_package(
+                                             self.pkg_src.id, 'code2', 'pkg1'))
+                self.assertFalse(build.called)
+                apply_async.assert_called_once_with(
+                        (self.pkg_src.id, 'code2', 'pkg1', None), countdown=30)
+
+                self.assertTrue(tasks.build_source_package(
+                                        self.pkg_src.id, 'code2', 'pkg1'))
+                build.assert_called_once_with()
+
+                # Duplicates queued in the meantime are dropped
+                self.assertFalse(tasks.build_source_package(
+                                         self.pkg_src.id, 'code2', 'pkg1'))
+                build.assert_called_once_with()
+
+        pkg_src = PackageSource.objects.get(pk=self.pkg_src.id)
+        self.assertEquals((pkg_src.last_seen_code_rev,
+                           pkg_src.last_seen_pkg_rev), ('code2', 'pkg1'))
+
+    def test_stale_build_does_not_roll_back(self):
+        now = timezone.now()
+        with mock.patch.object(PackageSource.OpenStackPackageBuilder,
+                               'build'):
+            self.pkg_src.build('code3', 'pkg1', now)
+            self.pkg_src.build('code2', 'pkg1',
+                               now - datetime.timedelta(minutes=2))
+
+        pkg_src = PackageSource.objects.get(pk=self.pkg_src.id)
+        self.assertEquals(pkg_src.last_seen_code_rev, 'code3')
+        self.assertEquals(pkg_src.last_changed, now)
+
+
+@override_settings(TESTING=False)
+class GitCacheTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        settings = self.settings(LOCK_DIR=os.path.join(self.tmpdir, 'locks'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.upstream = os.path.join(self.tmpdir, 'upstream')
+        self.git = lambda *args: utils.run_cmd(['git'] + list(args),
+                                               cwd=self.upstream).strip()
+        env = {'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+               'GIT_COMMITTER_NAME': 'Test',
+               'GIT_COMMITTER_EMAIL': 'test@example.com'}
+        utils.run_cmd(['git', 'init', '-q', self.upstream])
+        self.git('checkout', '-q', '-b', 'master')
+        utils.run_cmd(['git', 'commit', '-q', '--allow-empty', '-m', 'one'],
+                      cwd=self.upstream, override_env=env)
+        self.master = self.git('rev-parse', 'HEAD')
+        self.git('checkout', '-q', '-b', 'stable')
+        utils.run_cmd(['git', 'commit', '-q', '--allow-empty', '-m', 'two'],
+                      cwd=self.upstream, override_env=env)
+        self.stable = self.git('rev-parse', 'HEAD')
+
+        self.cache = GitCache(os.path.join(self.tmpdir, 'cache'))
+
+    def test_fetches_only_needed_branch(self):
+        with self.cache.in_use():
+            self.assertFalse(self.cache.has_object(self.master))
+            self.cache.ensure_revision(self.upstream, self.master)
+            self.assertTrue(self.cache.has_object(self.master))
+            self.assertFalse(self.cache.has_object(self.stable))
+
+            with mock.patch('repomgmt.utils.run_cmd',
+                            wraps=utils.run_cmd) as run_cmd:
+                self.cache.ensure_revision(self.upstream, self.master)
+                self.assertEquals(run_cmd.call_count, 1)
+
+            self.cache.ensure_revision(self.upstream + '#stable', self.stable)
+            self.assertTrue(self.cache.has_object(self.stable))
+
+    def test_maintain(self):
+        with self.cache.in_use():
+            self.cache.ensure_revision(self.upstream, self.master)
+            self.assertFalse(self.cache.maintain())
+
+        self.assertTrue(self.cache.maintain())
+        packs = os.listdir(os.path.join(self.cache.path, '.git', 'objects',
+                                        'pack'))
+        self.assertEquals(len([p for p in packs if p.endswith('.bitmap')]), 1)
+        with self.cache.in_use():
+            self.assertTrue(self.cache.has_object(self.master))
+        self.assertIsNotNone(self.cache.last_maintained())
+
+    def test_maintain_keeps_recently_unreachable_objects(self):
+        with self.cache.in_use():
+            self.cache.ensure_revision(self.upstream + '#stable', self.stable)
+        self.assertTrue(self.cache.maintain())
+
+        # The stable branch is packed now. Once unreachable, it should
+        # stick around until GIT_CACHE_PRUNE_EXPIRE says otherwise.
+        remote = GitCache.remote_name(self.upstream)
+        self.cache._git('update-ref', '-d',
+                        'refs/remotes/%s/stable' % (remote,))
+        self.assertTrue(self.cache.maintain())
+        with self.cache.in_use():
+            self.assertTrue(self.cache.has_object(self.stable))
+
+        with self.settings(GIT_CACHE_PRUNE_EXPIRE='now'):
+            self.assertTrue(self.cache.maintain())
+        with self.cache.in_use():
+            self.assertFalse(self.cache.has_object(self.stable))
+
+    def test_maintenance_retried_when_busy(self):
+        with nested(self.settings(GIT_CACHE_DIR=self.cache.path,
+                                  GIT_CACHE_MAINTENANCE_RETRY_DELAY=3600),
+                    mock.patch.object(tasks.maintain_git_cache,
+                                      'apply_async')) as (_, apply_async):
+            with self.cache.in_use():
+                self.assertFalse(tasks.maintain_git_cache())
+                apply_async.assert_called_once_with((2,), countdown=3600)
+
+                apply_async.reset_mock()
+                self.assertFalse(tasks.maintain_git_cache(24))
+                self.assertFalse(apply_async.called)
+            self.assertTrue(tasks.maintain_git_cache(2))
+
+
 class APIPermissionsTest(TestCase):
     def setUp(self):
         self._create_users()
@@ -449,6 +2005,67 @@ class APIPermissionsTest(TestCase):
         self.superuser.is_superuser = True
         self.superuser.save()
 
+    def test_push_notification(self):
+        nova = PackageSource(name='nova',
+                             code_url='https://github.com/openstack/nova.git',
+                             packaging_url='lp:~cisco/nova/folsom')
+        nova.save()
+        folsom = PackageSource(name='nova-folsom',
+                               code_url='git://github.com/openstack/nova'
+                                        '#stable/folsom',
+                               packaging_url='lp:~cisco/nova/folsom')
+        folsom.save()
+        PackageSource(name='glance',
+                      code_url='git://github.com/openstack/glance',
+                      packaging_url='lp:~cisco/glance/folsom').save()
+
+        c = self._get_client('user1')
+        with mock.patch.object(tasks.poll_package_source, 'delay') as delay:
+            response = c.post('/api/v1/push/',
+                              {'ref': 'refs/heads/stable/folsom',
+                               'repository': {
+                                   'url': 'https://github.com/openstack/nova',
+                                   'git_url': 'git://github.com/openstack/nova.git'}})
+            self.assertEquals(response.status_code, 202)
+            delay.assert_called_once_with(folsom.id)
+
+            delay.reset_mock()
+            response = c.post('/api/v1/push/',
+                              {'url': 'lp:~cisco/nova/folsom'})
+            self.assertEquals(response.status_code, 202)
+            self.assertEquals(delay.call_args_list,
+                              [mock.call(nova.id), mock.call(folsom.id)])
+
+            # GitHub's default, form encoded webhook payload
+            delay.reset_mock()
+            payload = json.dumps({'ref': 'refs/heads/stable/folsom',
+                                  'repository': {
+                                      'url': 'https://github.com/openstack/nova'}})
+            response = c.client.post('/api/v1/push/',
+                                     urllib.urlencode({'payload': payload}),
+                                     content_type='application/'
+                                                  'x-www-form-urlencoded')
+            self.assertEquals(response.status_code, 202)
+            delay.assert_called_once_with(folsom.id)
+
+            delay.reset_mock()
+            response = c.post('/api/v1/push/', {'foo': 'bar'})
+            self.assertEquals(response.status_code, 400)
+
+            for data in (['lp:~cisco/nova/folsom'],
+                         {'urls': 'lp:~cisco/nova/folsom'},
+                         {'urls': [['lp:~cisco/nova/folsom']]},
+                         {'ref': 'refs/heads/stable/folsom',
+                          'repository': 'https://github.com/openstack/nova'}):
+                response = c.post('/api/v1/push/', data)
+                self.assertEquals(response.status_code, 400)
+
+            response = client.Client().post('/api/v1/push/',
+                                            json.dumps({'url': 'lp:foo'}),
+                                            content_type='application/json')
+            self.assertEquals(response.status_code, 401)
+            self.assertFalse(delay.called)
+
     def test_superuser_can_create_architecture(self):
         c = self._get_client('superuser')
         response = c.post('/api/v1/architecture/', {'name': 'aarch64'})
@@ -30,6 +30,8 @@ urlpatterns = patterns('',
     # Builds
     url(r'^builds/(?P<build_id>\w+)/$', 'repomgmt.views.build_detail',
         name='build_detail'),
+    url(r'^builds/(?P<build_id>\w+)/log/$', 'repomgmt.views.build_log',
+        name='build_log'),
     url(r'^builds/$', 'repomgmt.views.build_list', name='build_list'),
 
     # Package Sources
@@ -80,6 +82,8 @@ urlpatterns = patterns('',
     url(r'^docs/workflow/$', 'repomgmt.views.docs_workflow', name='docs_workflow'),
 
     # Puppet
+    url(r'^puppet/tarball/(?P<tarball_id>\d+)/$',
+        'repomgmt.views.puppet_base_manifest'),
     url(r'^puppet/(?P<build_record_id>\w+)/$',
         'repomgmt.views.puppet_manifest'),
 
@@ -15,20 +15,28 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
 import logging
 import os
 import re
+import signal
 import subprocess
+import tempfile
+import threading
 
 from django.conf import settings
+from django.db import transaction
 
-from repomgmt.exceptions import CommandFailed
+from repomgmt.exceptions import CommandFailed, CommandTimedOut
 
 logger = logging.getLogger(__name__)
 
 
 def run_cmd(cmd, input=None, cwd=None, override_env=None,
-            discard_stderr=False):
+            discard_stderr=False, timeout=None):
     logger.debug('Executing %r with input=%r' % (cmd, input))
     if settings.TESTING:
         from repomgmt import mock_data
@@ -47,11 +55,38 @@ def run_cmd(cmd, input=None, cwd=None, override_env=None,
     else:
         stderr_arg = subprocess.STDOUT
 
+    # With a timeout, the command gets a process group of its own, so
+    # that whatever it has spawned can be killed along with it. Otherwise
+    # its children would keep our end of the pipes open.
     proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                            stderr=stderr_arg, cwd=cwd, env=environ)
-    stdout, stderr = proc.communicate(input)
+                            stderr=stderr_arg, cwd=cwd, env=environ,
+                            preexec_fn=timeout and os.setsid or None)
+
+    if timeout:
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                # It exited in the meantime
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    try:
+        stdout, stderr = proc.communicate(input)
+    finally:
+        if timeout:
+            timer.cancel()
     logger.debug('%r with input=%r returned %r' % (cmd, input, stdout))
 
+    if timeout and timed_out.is_set():
+        raise CommandTimedOut('%r timed out after %ds' % (cmd, timeout),
+                              cmd, proc.returncode, stdout, stderr)
+
     if proc.returncode != 0:
         raise CommandFailed('%r returned %d. Output: %s (stderr: %s)' %
                             (cmd, proc.returncode, stdout, stderr),
@@ -60,6 +95,139 @@ def run_cmd(cmd, input=None, cwd=None, override_env=None,
     return stdout
 
 
+@contextmanager
+def commit_on_success_unless_managed():
+    """Like transaction.commit_on_success, except that if someone is
+    already managing the transaction (e.g. repo-hook-server, which
+    commits several events at once), committing is left to them"""
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield
+
+
+def write_file_if_changed(path, contents, mode=None):
+    """Atomically replaces path with contents, unless it already holds
+    exactly that
+
+    Returns whether the file was written."""
+    try:
+        with open(path, 'r') as fp:
+            old_digest = hashlib.sha1(fp.read()).digest()
+    except IOError:
+        old_digest = None
+
+    if old_digest == hashlib.sha1(contents).digest():
+        return False
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.%s.' % (os.path.basename(path),))
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(contents)
+        os.chmod(tmp_path, mode or 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def lock_path(name):
+    """Returns the path of the lock file for name, which may be any
+    string"""
+    lock_dir = getattr(settings, 'LOCK_DIR',
+                       os.path.join(tempfile.gettempdir(), 'repomgmt-locks'))
+    if not os.path.exists(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    return os.path.join(lock_dir, re.sub(r'[^\w.-]', '_', name))
+
+
+@contextmanager
+def slot_lock(name, slots):
+    """Holds one of a fixed number of locks named after name
+
+    Yields the number of the slot that was acquired, or None if they
+    were all taken. This never waits."""
+    fds = []
+    try:
+        for slot in range(slots):
+            fd = os.open(lock_path('%s.%d' % (name, slot)),
+                         os.O_RDWR | os.O_CREAT, 0664)
+            fds.append(fd)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+            yield slot
+            break
+        else:
+            yield None
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+@contextmanager
+def file_lock(path, blocking=False, shared=False):
+    """Holds an exclusive (or, if shared is True, shared) lock on path
+    for the duration of the block
+
+    Yields whether the lock was acquired. Unless blocking is True, this
+    doesn't wait for whoever is holding the lock already."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0664)
+    try:
+        if shared:
+            flags = fcntl.LOCK_SH
+        else:
+            flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)
+
+
+def normalize_vcs_url(url):
+    """Reduces a code or packaging URL to a canonical form
+
+    Different ways of spelling the same remote (git://, https://, ssh,
+    with or without .git or a trailing slash) all map to the same
+    string. Any '#branch' suffix is dropped."""
+    url = url.split('#')[0].strip()
+    if '://' in url:
+        url = url.split('://', 1)[1]
+    elif re.match(r'^[^/]+:', url):
+        # scp-style: git@github.com:foo/bar.git
+        url = url.replace(':', '/', 1)
+
+    if '@' in url.split('/')[0]:
+        url = url.split('@', 1)[1]
+
+    url = url.rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-4]
+
+    if '/' in url:
+        host, path = url.split('/', 1)
+        return '%s/%s' % (host.lower(), path)
+    return url.lower()
+
+
 def get_image_by_regex(cl, regex):
     rx = re.compile(regex)
     for image in cl.images.list():
@@ -23,16 +23,17 @@ from django.contrib.sites.models import get_current_site
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
 from django.forms import ModelForm
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.utils import timezone
 
 
 from repomgmt import utils, tasks
-from repomgmt.models import Architecture, BuildNode, BuildRecord
+from repomgmt.models import Architecture, BuildNode, BuildQueue, BuildRecord
 from repomgmt.models import ChrootTarball, Repository, Series
 from repomgmt.models import UbuntuSeries, PackageSource, Subscription
-from repomgmt.models import PackageSourceBuildProblem
+from repomgmt.models import PackageSourceBuildProblem, PollCycle
 
 
 class NewArchitectureForm(ModelForm):
@@ -117,7 +118,8 @@ def pkg_sources_list(request):
     latest_problems = PackageSourceBuildProblem.objects.filter(timestamp__gte=t).order_by('-timestamp')
     return render(request, 'pkg_sources.html',
                           {'pkg_sources': PackageSource.objects.all(),
-                           'latest_problems': latest_problems})
+                           'latest_problems': latest_problems,
+                           'poll_cycle': PollCycle.latest()})
 
 
 def problem_detail(request, problem_id):
@@ -220,12 +222,20 @@ def promote_series(request):
 
 def puppet_manifest(request, build_record_id):
     build_record = BuildRecord.objects.get(pk=build_record_id)
-    return render(request, 'buildd.puppet.pp.tmpl',
+    return render(request, 'buildd-build.puppet.pp.tmpl',
                           {'build_record': build_record,
                            'settings': settings},
                           content_type='text/plain')
 
 
+def puppet_base_manifest(request, tarball_id):
+    tarball = ChrootTarball.objects.get(pk=tarball_id)
+    return render(request, 'buildd.puppet.pp.tmpl',
+                          {'tarball': tarball,
+                           'settings': settings},
+                          content_type='text/plain')
+
+
 def builder_detail(request, builder_name):
     bn = get_object_or_404(BuildNode, name=builder_name)
     return render(request, 'builder.html',
@@ -234,7 +244,8 @@ def builder_detail(request, builder_name):
 
 def builder_list(request):
     return render(request, 'builders.html',
-                          {'build_nodes': BuildNode.objects.all()})
+                          {'build_nodes': BuildNode.objects.all(),
+                           'build_queues': BuildQueue.all_queues()})
 
 
 def build_detail(request, build_id):
@@ -250,6 +261,13 @@ def build_detail(request, build_id):
                           {'build': br})
 
 
+def build_log(request, build_id):
+    br = get_object_or_404(BuildRecord, id=build_id)
+    if not br.has_log():
+        raise Http404
+    return StreamingHttpResponse(br.iter_log(), content_type='text/plain')
+
+
 def build_list(request):
     builds = BuildRecord.objects.order_by('-created')
     paginator = Paginator(builds, 25)